@@ -5,20 +5,26 @@ import tifffile
 import torch
 from torch.utils.data import Dataset
 from utils import utils
+from utils import feature_cache
+from utils.chip_reader import ChipReader
 import numpy as np
 
 class XViewDataset(Dataset):
     "Dataset for xView"
 
-    def __init__(self, pairs, mode, return_geo=False):
+    def __init__(self, pairs, mode, return_geo=False, cache_keys=False):
         """
         :param pre_chips: List of pre-damage chip filenames
         :param post_chips: List of post_damage chip filenames
         :param transform: PyTorch transforms to be used on each example
+        :param cache_keys: If True, return a key identifying the pre image for the pre-image feature cache
         """
         self.pairs = pairs
         self.return_geo=return_geo
         self.mode = mode
+        self.cache_keys = cache_keys
+        # Chips planned as windows are read straight from the mosaics
+        self.reader = ChipReader()
 
 
     def __len__(self):
@@ -26,8 +32,12 @@ class XViewDataset(Dataset):
 
     def __getitem__(self, idx, return_img=False):
         fl = self.pairs[idx]
-        pre_image = cv2.imread(str(fl.opts.in_pre_path), cv2.IMREAD_COLOR)
-        post_image = cv2.imread(str(fl.opts.in_post_path), cv2.IMREAD_COLOR)
+        if fl.opts.windows is None:
+            pre_image = cv2.imread(str(fl.opts.in_pre_path), cv2.IMREAD_COLOR)
+            post_image = cv2.imread(str(fl.opts.in_post_path), cv2.IMREAD_COLOR)
+        else:
+            pre_image = self.reader.read_bgr(fl.opts.in_pre_path, fl.opts.windows[0])
+            post_image = self.reader.read_bgr(fl.opts.in_post_path, fl.opts.windows[1])
         if self.mode == 'cls':
             img = np.concatenate([pre_image, post_image], axis=2)
         elif self.mode == 'loc':
@@ -53,9 +63,8 @@ class XViewDataset(Dataset):
             out_dict['post_image'] = post_image
         out_dict['img'] = inp
         out_dict['idx'] = idx
-        out_dict['out_cls_path'] = str(fl.opts.out_cls_path)
-        out_dict['out_loc_path'] = str(fl.opts.out_loc_path)
-        out_dict['out_overlay_path'] = str(fl.opts.out_overlay_path)
         out_dict['is_vis'] = fl.opts.is_vis
+        if self.cache_keys:
+            out_dict['pre_key'] = feature_cache.get_key(pre_image)
 
         return out_dict
@@ -0,0 +1,522 @@
+import os
+os.environ["MKL_NUM_THREADS"] = "2"
+os.environ["NUMEXPR_NUM_THREADS"] = "2"
+os.environ["OMP_NUM_THREADS"] = "2"
+
+from os import path, makedirs, listdir
+import argparse
+import json
+import numpy as np
+np.random.seed(1)
+import random
+random.seed(1)
+
+import torch
+from torch import nn
+from torch.backends import cudnn
+from torch.utils.data import Dataset
+from torch.utils.data import DataLoader
+import torch.optim.lr_scheduler as lr_scheduler
+
+from apex import amp
+
+from adamw import AdamW
+
+from tqdm import tqdm
+import timeit
+import cv2
+
+from zoo.models import Res34_Unet_Student
+from models import XViewFirstPlaceLocModel, XViewFirstPlaceClsModel, XViewStudentModel
+
+from utils.utils import AverageMeter, preprocess_inputs, get_masks
+
+from sklearn.model_selection import train_test_split
+
+import gc
+
+cv2.setNumThreads(0)
+cv2.ocl.setUseOpenCL(False)
+
+train_dirs = ['train', 'tier3']
+
+models_folder = 'weights'
+
+targets_folder = 'soft_targets'
+
+input_shape = (608, 608)
+
+sizes = ['34', '50', '92', '154']
+
+
+all_files = []
+for d in train_dirs:
+    if not path.isdir(path.join(d, 'images')):
+        continue
+    for f in sorted(listdir(path.join(d, 'images'))):
+        if '_pre_disaster.png' in f:
+            all_files.append(path.join(d, 'images', f))
+train_len = len(all_files)
+
+
+def target_paths(fn, folder=targets_folder):
+
+    """
+    Paths of the soft target images for a training image.
+    :param fn: Pre disaster image filename
+    :param folder: Soft target folder
+    :return: Tuple of paths to the loc target and the two cls target parts
+    """
+
+    name = fn.split('/')[-1].replace('.png', '')
+    return (path.join(folder, f'{name}_loc.png'),
+            path.join(folder, f'{name}_cls_part1.png'),
+            path.join(folder, f'{name}_cls_part2.png'))
+
+
+def write_targets(fn, loc, cls, folder=targets_folder):
+
+    """
+    Write uint8 probability maps. Damage has 5 channels, so it is split into two 3 channel PNGs sharing channel 2.
+    """
+
+    loc_path, cls_path1, cls_path2 = target_paths(fn, folder)
+    cv2.imwrite(loc_path, loc, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    cv2.imwrite(cls_path1, cls[..., :3], [cv2.IMWRITE_PNG_COMPRESSION, 9])
+    cv2.imwrite(cls_path2, cls[..., 2:], [cv2.IMWRITE_PNG_COMPRESSION, 9])
+
+
+def read_targets(fn, folder=targets_folder):
+
+    """
+    Read uint8 probability maps written by write_targets.
+    :return: Tuple of loc (H, W) and cls (H, W, 5) uint8 arrays
+    """
+
+    loc_path, cls_path1, cls_path2 = target_paths(fn, folder)
+    loc = cv2.imread(loc_path, cv2.IMREAD_UNCHANGED)
+    cls = np.concatenate([cv2.imread(cls_path1, cv2.IMREAD_UNCHANGED),
+                          cv2.imread(cls_path2, cv2.IMREAD_UNCHANGED)[..., 1:]], axis=2)
+    return loc, cls
+
+
+class TTAData(Dataset):
+    "Full size pre/post pairs with the same 4 view test-time augmentation as XViewDataset"
+
+    def __init__(self, image_idxs):
+        super().__init__()
+        self.image_idxs = image_idxs
+
+    def __len__(self):
+        return len(self.image_idxs)
+
+    def __getitem__(self, idx):
+        fn = all_files[self.image_idxs[idx]]
+
+        img = cv2.imread(fn, cv2.IMREAD_COLOR)
+        img2 = cv2.imread(fn.replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_COLOR)
+        img = preprocess_inputs(np.concatenate([img, img2], axis=2))
+
+        inp = np.asarray([img, img[::-1, ...], img[:, ::-1, ...], img[::-1, ::-1, ...]], dtype='float')
+        inp = torch.from_numpy(inp.transpose((0, 3, 1, 2))).float()
+
+        return {'img': inp, 'fn': fn}
+
+
+class TrainData(Dataset):
+    def __init__(self, train_idxs):
+        super().__init__()
+        self.train_idxs = train_idxs
+
+    def __len__(self):
+        return len(self.train_idxs)
+
+    def __getitem__(self, idx):
+        fn = all_files[self.train_idxs[idx]]
+
+        img = cv2.imread(fn, cv2.IMREAD_COLOR)
+        img2 = cv2.imread(fn.replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_COLOR)
+        loc, cls = read_targets(fn)
+        msk = np.concatenate([loc[..., np.newaxis], cls], axis=2)
+
+        if random.random() > 0.5:
+            img = img[::-1, ...]
+            img2 = img2[::-1, ...]
+            msk = msk[::-1, ...]
+
+        if random.random() > 0.05:
+            rot = random.randrange(4)
+            if rot > 0:
+                img = np.rot90(img, k=rot)
+                img2 = np.rot90(img2, k=rot)
+                msk = np.rot90(msk, k=rot)
+
+        crop_size = input_shape[0]
+        x0 = random.randint(0, img.shape[1] - crop_size)
+        y0 = random.randint(0, img.shape[0] - crop_size)
+        img = img[y0:y0+crop_size, x0:x0+crop_size, :]
+        img2 = img2[y0:y0+crop_size, x0:x0+crop_size, :]
+        msk = msk[y0:y0+crop_size, x0:x0+crop_size, :]
+
+        img = preprocess_inputs(np.concatenate([img, img2], axis=2))
+        msk = np.asarray(msk, dtype='float32') / 255
+
+        img = torch.from_numpy(img.transpose((2, 0, 1))).float()
+        msk = torch.from_numpy(msk.transpose((2, 0, 1))).float()
+
+        return {'img': img, 'msk': msk, 'fn': fn}
+
+
+class ValData(Dataset):
+    "Full size pairs with soft targets"
+
+    def __init__(self, image_idxs):
+        super().__init__()
+        self.image_idxs = image_idxs
+
+    def __len__(self):
+        return len(self.image_idxs)
+
+    def __getitem__(self, idx):
+        fn = all_files[self.image_idxs[idx]]
+
+        img = cv2.imread(fn, cv2.IMREAD_COLOR)
+        img2 = cv2.imread(fn.replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_COLOR)
+        loc, cls = read_targets(fn)
+        msk = np.concatenate([loc[..., np.newaxis], cls], axis=2)
+
+        img = preprocess_inputs(np.concatenate([img, img2], axis=2))
+        msk = np.asarray(msk, dtype='float32') / 255
+
+        img = torch.from_numpy(img.transpose((2, 0, 1))).float()
+        msk = torch.from_numpy(msk.transpose((2, 0, 1))).float()
+
+        return {'img': img, 'msk': msk, 'fn': fn}
+
+
+def generate_targets(batch_size=2, num_workers=6):
+
+    """
+    Run the full ensemble over every training pair and store the averaged loc and cls probabilities as soft targets.
+    Each architecture is run separately and accumulated so only one loc and one cls wrapper is in memory at a time.
+    """
+
+    makedirs(targets_folder, exist_ok=True)
+    data_loader = DataLoader(TTAData(np.arange(train_len)), batch_size=batch_size, num_workers=num_workers,
+                             shuffle=False, pin_memory=True)
+
+    # Running sums per image, stored as uint16 to stay compact between architectures
+    sums_folder = path.join(targets_folder, 'sums')
+    makedirs(sums_folder, exist_ok=True)
+
+    for sz in sizes:
+        print(f'Generating soft targets with models of size {sz}...')
+        loc_wrapper = XViewFirstPlaceLocModel(sz, devices=[0, 0, 0])
+        cls_wrapper = XViewFirstPlaceClsModel(sz, devices=[0, 0, 0])
+
+        with torch.no_grad():
+            for sample in tqdm(data_loader):
+                loc = loc_wrapper.forward(sample['img'][:, :, :3, ...]).numpy()
+                cls = cls_wrapper.forward(sample['img']).numpy()
+                for j, fn in enumerate(sample['fn']):
+                    out = np.concatenate([loc[j][..., np.newaxis], cls[j]], axis=2).astype('uint16')
+                    sum_file = path.join(sums_folder, fn.split('/')[-1].replace('.png', '.npy'))
+                    if path.isfile(sum_file) and sz != sizes[0]:
+                        out += np.load(sum_file)
+                    if sz == sizes[-1]:
+                        out = (out / len(sizes)).astype('uint8')
+                        write_targets(fn, out[..., 0], out[..., 1:])
+                        if path.isfile(sum_file):
+                            os.remove(sum_file)
+                    else:
+                        np.save(sum_file, out)
+
+        del loc_wrapper
+        del cls_wrapper
+        gc.collect()
+        torch.cuda.empty_cache()
+
+
+def distill_loss(out, msk, loc_weight=1.0, cls_weight=1.0):
+
+    """
+    Soft binary cross entropy against the ensemble probabilities. The ensemble applies a sigmoid to every channel,
+    so the student is trained the same way.
+    """
+
+    loss_loc = nn.functional.binary_cross_entropy_with_logits(out[:, :1, ...], msk[:, :1, ...])
+    loss_cls = nn.functional.binary_cross_entropy_with_logits(out[:, 1:, ...], msk[:, 1:, ...])
+    return loc_weight * loss_loc + cls_weight * loss_cls
+
+
+def load_student_init(model, seed):
+
+    """
+    Initialize the student from the tuned ResNet34 classification model. The damage head is copied into channels
+    1-5 and channel 0 starts from the mean of the damage head.
+    """
+
+    snap_to_load = 'res34_cls2_{}_tuned_best'.format(seed)
+    print("=> loading checkpoint '{}'".format(snap_to_load))
+    checkpoint = torch.load(path.join(models_folder, snap_to_load), map_location='cpu')
+    loaded_dict = {key.replace("module.", ""): value for key, value in checkpoint['state_dict'].items()}
+    sd = model.state_dict()
+    for k in model.state_dict():
+        if k in loaded_dict and sd[k].size() == loaded_dict[k].size():
+            sd[k] = loaded_dict[k]
+    sd['res.weight'][1:] = loaded_dict['res.weight']
+    sd['res.bias'][1:] = loaded_dict['res.bias']
+    sd['res.weight'][:1] = loaded_dict['res.weight'].mean(dim=0, keepdim=True)
+    model.load_state_dict(sd)
+    del loaded_dict
+    del checkpoint
+    gc.collect()
+
+
+def score(tp, fp, fn):
+
+    """
+    xView2 competition score from accumulated counts. Index 4 holds localization, 0-3 the damage classes.
+    :return: Tuple of score, localization F1 and damage F1
+    """
+
+    d0 = 2 * tp[4] / (2 * tp[4] + fp[4] + fn[4] + 1e-6)
+
+    f1_sc = np.zeros((4,))
+    for c in range(4):
+        f1_sc[c] = 2 * tp[c] / (2 * tp[c] + fp[c] + fn[c] + 1e-6)
+
+    f1 = 4 / np.sum(1.0 / (f1_sc + 1e-6))
+
+    return 0.3 * d0 + 0.7 * f1, d0, f1
+
+
+def update_counts(counts, msk_loc, msk_dmg, targ_loc, targ_dmg):
+
+    """
+    Accumulate true positives, false positives and false negatives for the competition metric.
+    :param counts: Tuple of (tp, fp, fn) arrays
+    :param msk_loc: Predicted localization mask
+    :param msk_dmg: Predicted damage mask with classes 1-4
+    :param targ_loc: Target localization mask
+    :param targ_dmg: Target damage mask with classes 1-4
+    """
+
+    tp, fp, fn = counts
+    tp[4] += np.logical_and(targ_loc > 0, msk_loc > 0).sum()
+    fp[4] += np.logical_and(targ_loc < 1, msk_loc > 0).sum()
+    fn[4] += np.logical_and(targ_loc > 0, msk_loc < 1).sum()
+
+    targ = targ_dmg[targ_loc > 0] - 1
+    pred = msk_dmg[targ_loc > 0] - 1
+    for c in range(4):
+        tp[c] += np.logical_and(pred == c, targ == c).sum()
+        fn[c] += np.logical_and(pred != c, targ == c).sum()
+        fp[c] += np.logical_and(pred == c, targ != c).sum()
+
+
+def validate(model, data_loader):
+    counts = (np.zeros((5,)), np.zeros((5,)), np.zeros((5,)))
+
+    with torch.no_grad():
+        for i, sample in enumerate(tqdm(data_loader)):
+            out = torch.sigmoid(model(sample["img"].cuda(non_blocking=True))).cpu().numpy()
+            msks = sample["msk"].numpy()
+            for j in range(out.shape[0]):
+                msk_loc, msk_dmg = get_masks(out[j, 0], out[j, 1:].transpose(1, 2, 0))
+                targ_loc, targ_dmg = get_masks(msks[j, 0], msks[j, 1:].transpose(1, 2, 0))
+                update_counts(counts, msk_loc, msk_dmg, targ_loc, targ_dmg)
+
+    sc, d0, f1 = score(*counts)
+    print("Val Score (vs ensemble): {}, Dice: {}, F1: {}".format(sc, d0, f1))
+    return sc
+
+
+def evaluate_val(data_val, best_score, model, snapshot_name, current_epoch):
+    model = model.eval()
+    d = validate(model, data_loader=data_val)
+
+    if d > best_score:
+        torch.save({
+            'epoch': current_epoch + 1,
+            'state_dict': model.state_dict(),
+            'best_score': d,
+        }, path.join(models_folder, snapshot_name + '_best'))
+        best_score = d
+
+    print("score: {}\tscore_best: {}".format(d, best_score))
+    return best_score
+
+
+def train_epoch(current_epoch, model, optimizer, scheduler, train_data_loader):
+    losses = AverageMeter()
+
+    iterator = tqdm(train_data_loader)
+    model.train()
+    for i, sample in enumerate(iterator):
+        imgs = sample["img"].cuda(non_blocking=True)
+        msks = sample["msk"].cuda(non_blocking=True)
+
+        out = model(imgs)
+
+        loss = distill_loss(out, msks)
+
+        losses.update(loss.item(), imgs.size(0))
+
+        iterator.set_description(
+            "epoch: {}; lr {:.7f}; Loss {loss.val:.4f} ({loss.avg:.4f})".format(
+                current_epoch, scheduler.get_lr()[-1], loss=losses))
+
+        optimizer.zero_grad()
+        with amp.scale_loss(loss, optimizer) as scaled_loss:
+            scaled_loss.backward()
+        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), 0.999)
+        optimizer.step()
+
+    scheduler.step(current_epoch)
+
+    print("epoch: {}; lr {:.7f}; Loss {loss.avg:.4f}".format(
+                current_epoch, scheduler.get_lr()[-1], loss=losses))
+
+
+def train(seed, epochs=20, batch_size=12, val_batch_size=4):
+
+    cudnn.benchmark = True
+
+    snapshot_name = 'student_res34_{}'.format(seed)
+
+    train_idxs, val_idxs = train_test_split(np.arange(train_len), test_size=0.1, random_state=seed)
+
+    np.random.seed(seed + 545)
+    random.seed(seed + 545)
+
+    data_train = TrainData(train_idxs)
+    data_val = ValData(val_idxs)
+
+    train_data_loader = DataLoader(data_train, batch_size=batch_size, num_workers=6, shuffle=True, pin_memory=False, drop_last=True)
+    val_data_loader = DataLoader(data_val, batch_size=val_batch_size, num_workers=6, shuffle=False, pin_memory=False)
+
+    model = Res34_Unet_Student(pretrained=False)
+    load_student_init(model, seed)
+    model = model.cuda()
+
+    params = model.parameters()
+
+    optimizer = AdamW(params, lr=0.0002, weight_decay=1e-6)
+
+    model, optimizer = amp.initialize(model, optimizer, opt_level="O1")
+
+    scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=[2, 4, 6, 8, 10, 12, 14, 16, 18], gamma=0.5)
+
+    best_score = 0
+    torch.cuda.empty_cache()
+    for epoch in range(epochs):
+        train_epoch(epoch, model, optimizer, scheduler, train_data_loader)
+        torch.cuda.empty_cache()
+        best_score = evaluate_val(val_data_loader, best_score, model, snapshot_name, epoch)
+
+
+def evaluate(seed, report_file='distill_report.json'):
+
+    """
+    Compare the student with the full ensemble on the validation split. Both are scored against the ground truth
+    masks with the competition metric, the student is also scored against the ensemble, and inference time per
+    image is measured with test-time augmentation for both.
+    """
+
+    _, val_idxs = train_test_split(np.arange(train_len), test_size=0.1, random_state=seed)
+    data_loader = DataLoader(TTAData(val_idxs), batch_size=1, num_workers=6, shuffle=False, pin_memory=True)
+
+    student_counts = (np.zeros((5,)), np.zeros((5,)), np.zeros((5,)))
+    ensemble_counts = (np.zeros((5,)), np.zeros((5,)), np.zeros((5,)))
+    agreement_counts = (np.zeros((5,)), np.zeros((5,)), np.zeros((5,)))
+
+    student = XViewStudentModel(seed=seed, devices=[0])
+    student_time = 0
+    with torch.no_grad():
+        for sample in tqdm(data_loader):
+            fn = sample['fn'][0]
+
+            torch.cuda.synchronize()
+            t0 = timeit.default_timer()
+            out = student.forward(sample['img'])[0].numpy()
+            torch.cuda.synchronize()
+            student_time += timeit.default_timer() - t0
+
+            targ_loc = cv2.imread(fn.replace('/images/', '/masks/'), cv2.IMREAD_UNCHANGED) > 127
+            targ_dmg = cv2.imread(fn.replace('/images/', '/masks/').replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_UNCHANGED)
+
+            msk_loc, msk_dmg = get_masks(out[..., 0] / 255, out[..., 1:] / 255)
+            update_counts(student_counts, msk_loc, msk_dmg, targ_loc, targ_dmg)
+
+            loc, cls = read_targets(fn)
+            ens_loc, ens_dmg = get_masks(loc / 255, cls / 255)
+            update_counts(ensemble_counts, ens_loc, ens_dmg, targ_loc, targ_dmg)
+            update_counts(agreement_counts, msk_loc, msk_dmg, ens_loc, ens_dmg)
+    del student
+
+    # Time the ensemble on a subset, loading one architecture at a time like handler.py in dp_mode
+    ensemble_time = 0
+    n_timed = min(len(val_idxs), 20)
+    for sz in sizes:
+        loc_wrapper = XViewFirstPlaceLocModel(sz, devices=[0, 0, 0])
+        cls_wrapper = XViewFirstPlaceClsModel(sz, devices=[0, 0, 0])
+        with torch.no_grad():
+            for i, sample in enumerate(data_loader):
+                if i >= n_timed:
+                    break
+                torch.cuda.synchronize()
+                t0 = timeit.default_timer()
+                loc_wrapper.forward(sample['img'][:, :, :3, ...])
+                cls_wrapper.forward(sample['img'])
+                torch.cuda.synchronize()
+                ensemble_time += timeit.default_timer() - t0
+        del loc_wrapper
+        del cls_wrapper
+        torch.cuda.empty_cache()
+
+    report = {}
+    for name, counts in [('student', student_counts), ('ensemble', ensemble_counts), ('student_vs_ensemble', agreement_counts)]:
+        sc, d0, f1 = score(*counts)
+        report[name] = {'score': sc, 'loc_f1': d0, 'dmg_f1': f1}
+    report['student']['sec_per_image'] = student_time / len(val_idxs)
+    report['ensemble']['sec_per_image'] = ensemble_time / n_timed
+    report['speedup'] = report['ensemble']['sec_per_image'] / report['student']['sec_per_image']
+    report['n_images'] = len(val_idxs)
+
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for k, v in report.items():
+        print(f'{k}: {v}')
+
+    return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Distill the xView2 ensemble into a single student model.')
+    parser.add_argument('stage', choices=['targets', 'train', 'evaluate'], help='targets: create soft targets with the full ensemble. train: train the student. evaluate: compare student and ensemble on the validation split.')
+    parser.add_argument('--seed', default=0, type=int, help='Seed for the train/validation split and the student initialization')
+    parser.add_argument('--epochs', default=20, type=int, help='Number of training epochs')
+    parser.add_argument('--batch_size', default=12, type=int, help='Training batch size')
+    parser.add_argument('--report', default='distill_report.json', help='Path for the evaluation report')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    t0 = timeit.default_timer()
+
+    makedirs(models_folder, exist_ok=True)
+
+    args = parse_args()
+
+    if args.stage == 'targets':
+        generate_targets()
+    elif args.stage == 'train':
+        train(args.seed, epochs=args.epochs, batch_size=args.batch_size)
+    else:
+        evaluate(args.seed, report_file=args.report)
+
+    elapsed = timeit.default_timer() - t0
+    print('Time: {:.3f} min'.format(elapsed / 60))
@@ -1,4 +1,5 @@
 import cv2
+import time
 import timeit
 import argparse
 import os
@@ -8,58 +9,91 @@ import numpy as np
 from utils import to_shapefile, raster_processing
 from utils import to_agol
 from utils import features
+from utils import utils
+from utils import coarse_scan
+from utils import profiling
+from utils import priority
+from utils.feature_cache import FeatureCache
+from utils.work_queue import WorkQueue
+from utils.failures import FailureReport
+from utils.manifest import RunManifest
+from utils.vector_writer import VectorWriter
+from utils.catalog import InputCatalog
+from utils.chip_reader import ChipReader
+from utils.mosaic_writer import MosaicWriter
+from utils.staging_cache import StagingCache
+from utils import web_tiles
 import rasterio.warp
 import torch
+from shapely.geometry import box
 #import ray
+from functools import partial
+from contextlib import nullcontext
 from collections import defaultdict
 from os import makedirs, path
 from pathlib import Path
 from torch.utils.data import DataLoader
-from skimage.morphology import square, dilation
 from tqdm import tqdm
 from dataset import XViewDataset
-from models import XViewFirstPlaceLocModel, XViewFirstPlaceClsModel
+from models import XViewFirstPlaceLocModel, XViewFirstPlaceClsModel, XViewStudentModel
 from loguru import logger
-from sys import stderr
+from sys import stderr, exit
 from PIL import Image
 
 
 class Options(object):
 
     def __init__(self, pre_path='input/pre', post_path='input/post',
-                 out_loc_path='output/loc', out_dmg_path='output/dmg', out_overlay_path='output/over',
+                 out_loc_path='output/loc', out_dmg_path='output/dmg',
                  model_config='configs/model.yaml', model_weights='weights/weight.pth',
-                 geo_profile=None, use_gpu=False, vis=False):
+                 geo_profile=None, use_gpu=False, vis=False, windows=None, crop=None):
         self.in_pre_path = pre_path
         self.in_post_path = post_path
         self.out_loc_path = out_loc_path
         self.out_cls_path = out_dmg_path
-        self.out_overlay_path = out_overlay_path
         self.model_config_path = model_config
         self.model_weight_path = model_weights
         self.geo_profile = geo_profile
         self.is_use_gpu = use_gpu
         self.is_vis = vis
+        self.windows = windows
+        self.crop = crop
         
 class Files(object):
 
-    def __init__(self, ident, pre_directory, post_directory, output_directory, pre, post):
+    def __init__(self, ident, pre_directory, post_directory, output_directory, pre, post, windows=None, profile=None,
+                 crop=None, chip_outputs=True):
+        """
+        :param windows: optional tuple of pre and post windows (col_off, row_off, width, height). pre and post are then
+        the mosaics the chip is read from.
+        :param profile: chip profile. Read from the pre chip if None.
+        :param crop: optional (col_off, row_off, width, height) of the chip that outputs are written for
+        :param chip_outputs: write loc and dmg files for the chip as well as the output mosaics
+        """
         self.ident = ident
+        self.windows = windows
+        self.crop = crop
         self.pre = pre_directory.joinpath(pre).resolve()
         self.post = post_directory.joinpath(post).resolve()
         self.loc = output_directory.joinpath('loc').joinpath(f'{self.ident}.tif').resolve()
         self.dmg = output_directory.joinpath('dmg').joinpath(f'{self.ident}.tif').resolve()
-        self.over = output_directory.joinpath('over').joinpath(f'{self.ident}.tif').resolve()
-        self.profile = self.get_profile()
+        self.profile = self.get_profile() if profile is None else profile
+        if crop is not None:
+            # Outputs only cover the crop so overlapping edge chips do not write the same area twice
+            self.profile = self.profile.copy()
+            self.profile.update(transform=rasterio.windows.transform(rasterio.windows.Window(*crop), self.profile['transform']),
+                                width=crop[2],
+                                height=crop[3])
         self.transform = self.profile["transform"]
         self.opts = Options(pre_path=self.pre,
                                       post_path=self.post,
-                                      out_loc_path=self.loc,
-                                      out_dmg_path=self.dmg,
-                                      out_overlay_path=self.over,
+                                      out_loc_path=self.loc if chip_outputs else None,
+                                      out_dmg_path=self.dmg if chip_outputs else None,
                                       geo_profile=self.profile,
                                       vis=True,
-                                      use_gpu=True
+                                      use_gpu=True,
+                                      windows=self.windows,
+                                      crop=self.crop
                                       )
 
     def get_profile(self):
@@ -93,7 +127,6 @@ def make_output_structure(output_path):
     Path(f"{output_path}/chips/post").mkdir(parents=True, exist_ok=True)
     Path(f"{output_path}/loc").mkdir(parents=True, exist_ok=True)
     Path(f"{output_path}/dmg").mkdir(parents=True, exist_ok=True)
-    Path(f"{output_path}/over").mkdir(parents=True, exist_ok=True)
     Path(f"{output_path}/shapes").mkdir(parents=True, exist_ok=True)
 
     return True
@@ -118,25 +151,114 @@ def get_files(dirname, extensions=['.png', '.tif', '.jpg']):
     return match
 
 
-def reproject_helper(args, raster_tuple, procnum, return_dict, resolution):
+# Set in main when --catalog_file is given
+catalog = None
+
+
+def list_inputs(dirname):
+
+    """
+    Gathers input files, reusing cached directory listings when a catalog is set.
+    :param dirname: path to parse
+    :return: list of files
+    """
+
+    if catalog is None:
+        return get_files(dirname)
+
+    return catalog.list_files(dirname)
+
+
+def get_input_footprints(in_files, in_crs):
+
     """
-    Helper function for reprojection
+    Get footprints of input files in the destination CRS, from the catalog when set.
+    :param in_files: list of rasters
+    :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+    :return: list of (file, bounds)
     """
-    (pre_post, src_crs, raster_file) = raster_tuple
-    basename = raster_file.stem
-    dest_file = args.staging_directory.joinpath('pre').joinpath(f'{basename}.tif')
+
+    if catalog is None:
+        return raster_processing.get_footprints(in_files, in_crs, args.destination_crs)
+
+    return catalog.get_footprints(in_files, in_crs, args.destination_crs)
+
+
+def reproject_helper(args, raster_tuple, procnum, return_dict, resolution, cache):
+    """
+    Helper function for reprojection. Re-projected files are taken from or added to the staging cache.
+    """
+    (pre_post, src_crs, raster_file, bounds) = raster_tuple
     try:
-        return_dict[procnum] = (pre_post, raster_processing.reproject(raster_file, dest_file, src_crs, args.destination_crs, resolution))
-    except ValueError:
-        return None
+        key = cache.get_key(raster_file, src_crs, args.destination_crs, resolution, bounds)
+        dest_file = cache.get_or_create(key, lambda f: raster_processing.reproject(raster_file, f, src_crs, args.destination_crs, resolution, bounds))
+        return_dict[procnum] = (pre_post, dest_file, None)
+    except Exception as ex:
+        # Reported by the parent so one bad input does not stop the run
+        return_dict[procnum] = (pre_post, None, str(ex))
+
+
+# Reads windowed chips in postprocessing workers. Each process keeps its own open mosaics.
+chip_reader = ChipReader()
+
+
+def read_base(in_pre_path, windows, crop, shape):
+    """
+    Read the pre image under a chip's outputs to composite the damage overlay on
+    :param in_pre_path: pre chip, or pre mosaic for windowed chips
+    :param windows: pre and post windows or None
+    :param crop: crop of the chip that outputs are written for or None
+    :param shape: (height, width) of the outputs
+    :return: array of (bands, height, width)
+    """
+    if crop is None:
+        crop = (0, 0, shape[1], shape[0])
+
+    window = crop if windows is None else (windows[0][0] + crop[0], windows[0][1] + crop[1], crop[2], crop[3])
+    return chip_reader.read(in_pre_path, window, crop[2], crop[3])
+
+
+def crop_output(arr, crop):
+    """
+    Crop a chip output to the part of the chip that outputs are written for
+    :param arr: array of (height, width)
+    :param crop: (col_off, row_off, width, height) or None
+    :return: cropped array
+    """
+    if crop is None:
+        return arr
+
+    return arr[crop[1]:crop[1] + crop[3], crop[0]:crop[0] + crop[2]]
+
+
+def save_chips(pair, output_directory):
+    """
+    Get chip files of a pair, writing windowed chips from the mosaics
+    :param pair: Files object for the chip
+    :param output_directory: directory for output files
+    :return: list of pre and post chip files
+    """
+    if pair.windows is None:
+        return [pair.pre, pair.post]
+
+    chips = []
+    for pre_post, in_raster, window in (('pre', pair.pre, pair.windows[0]), ('post', pair.post, pair.windows[1])):
+        out_dir = output_directory.joinpath('chips').joinpath(pre_post)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with rasterio.open(in_raster) as src:
+            chips.append(raster_processing.write_chip(src, rasterio.windows.Window(*window),
+                                                      out_dir.joinpath(f'{pair.ident.split("_")[0]}_{pre_post}.tif')))
+
+    return chips
 
 
 def postprocess_and_write(result_dict):
     """
-    Postprocess results from inference and write results to file
+    Postprocess results from inference and write chip outputs to file if they have output paths
     :param result_dict: dictionary containing all required opts for each example
+    :return: tuple of loc and damage arrays and RGB overlay array of (3, height, width) or None, to write to the
+    output mosaics
     """
-    _thr = [0.38, 0.13, 0.14]
     pred_coefs = [1.0] * 4 # not 12, b/c already took mean over 3 in each subset 
     loc_coefs = [1.0] * 4 
 
@@ -149,7 +271,7 @@ def postprocess_and_write(result_dict):
             msk = v['cls'].numpy()
             preds.append(msk * pred_coefs[_i])
     
-    preds = np.asarray(preds).astype('float').sum(axis=0) / np.sum(pred_coefs) / 255
+    preds = np.asarray(preds).astype('float').sum(axis=0) / np.sum(pred_coefs[:len(preds)]) / 255
     
     loc_preds = []
     _i = -1
@@ -159,68 +281,221 @@ def postprocess_and_write(result_dict):
             msk = v['loc'].numpy()
             loc_preds.append(msk * loc_coefs[_i])
     
-    loc_preds = np.asarray(loc_preds).astype('float').sum(axis=0) / np.sum(loc_coefs) / 255
+    loc_preds = np.asarray(loc_preds).astype('float').sum(axis=0) / np.sum(loc_coefs[:len(loc_preds)]) / 255
     
-    msk_dmg = preds[..., 1:].argmax(axis=2) + 1
-    msk_loc = (1 * ((loc_preds > _thr[0]) | ((loc_preds > _thr[1]) & (msk_dmg > 1) & (msk_dmg < 4)) | ((loc_preds > _thr[2]) & (msk_dmg > 1)))).astype('uint8')
+    loc, cls = utils.get_masks(loc_preds, preds)
     
-    msk_dmg = msk_dmg * msk_loc
-    _msk = (msk_dmg == 2)
-    if _msk.sum() > 0:
-        _msk = dilation(_msk, square(5))
-        msk_dmg[_msk & msk_dmg == 1] = 2
+    sample_result_dict = next(v for k, v in result_dict.items() if 'loc' in k)
+    loc = crop_output(loc, sample_result_dict['crop'])
+    cls = crop_output(cls, sample_result_dict['crop'])
+    sample_result_dict['geo_profile'].update(dtype=rasterio.uint8)
 
-    msk_dmg = msk_dmg.astype('uint8')
+    write_chip_outputs(sample_result_dict['out_loc_path'], sample_result_dict['out_cls_path'],
+                       sample_result_dict['geo_profile'], loc, cls)
 
-    loc = msk_loc
-    cls = msk_dmg
-    
-    sample_result_dict = result_dict['34loc']
-    sample_result_dict['geo_profile'].update(dtype=rasterio.uint8)
+    overlay = None
+    if sample_result_dict['is_vis']:
+        overlay = raster_processing.blend_overlay(read_base(sample_result_dict['in_pre_path'],
+                                                            sample_result_dict['windows'],
+                                                            sample_result_dict['crop'],
+                                                            cls.shape),
+                                                  cls)
+
+    return loc, cls, overlay
 
-    with rasterio.open(sample_result_dict['out_loc_path'], 'w', **sample_result_dict['geo_profile']) as dst:
+
+def write_chip_outputs(loc_path, cls_path, profile, loc, cls):
+    """
+    Write loc and damage outputs of a chip to file. Nothing is written without paths.
+    :param loc_path: loc output path or None
+    :param cls_path: damage output path or None
+    :param profile: chip output profile
+    :param loc: loc array
+    :param cls: damage array
+    """
+    if loc_path is None:
+        return
+
+    with rasterio.open(loc_path, 'w', **profile) as dst:
         dst.write(loc, 1)
 
-    with rasterio.open(sample_result_dict['out_cls_path'], 'w', **sample_result_dict['geo_profile']) as dst:
+    with rasterio.open(cls_path, 'w', **profile) as dst:
         dst.write(cls, 1)
 
-    if sample_result_dict['is_vis']:
-        raster_processing.create_composite(sample_result_dict['in_pre_path'],
-                                           cls,
-                                           sample_result_dict['out_overlay_path'],
-                                           sample_result_dict['geo_profile'],
-                                           )
 
+def isolate(func, item):
+    """
+    Call func on item in a pool worker without letting one failure stop the pool
+    :param func: function to call
+    :param item: argument for func
+    :return: tuple of the return value of func and error message or None if successful
+    """
+    try:
+        return func(item), None
+    except Exception as ex:
+        return None, str(ex)
+
+
+def postprocess_chip(result_dict):
+    """
+    Postprocess a chip and polygonize its damage output
+    :param result_dict: dictionary containing all required opts for each example
+    :return: tuple of list of polygons and damage values, loc and damage arrays and overlay array or None
+    """
+    loc, cls, overlay = postprocess_and_write(result_dict)
+    sample_result_dict = next(v for k, v in result_dict.items() if 'loc' in k)
+
+    return features.polygonize(cls, sample_result_dict['geo_profile']['transform']), loc, cls, overlay
+
+
+def resume_chip(pair, damage_mosaic):
+    """
+    Polygonize a chip completed in an earlier run from the damage mosaic
+    :param pair: Files object for the chip
+    :param damage_mosaic: damage mosaic of the earlier run
+    :return: list of polygons and damage values
+    """
+    with rasterio.open(damage_mosaic) as src:
+        col, row = ~src.transform * (pair.transform.c, pair.transform.f)
+        window = rasterio.windows.Window(int(round(col)), int(round(row)), pair.profile['width'], pair.profile['height'])
+        cls = src.read(1, window=window)
+
+    return features.polygonize(cls, pair.transform)
+
+
+def write_empty(pair):
+    """
+    Write empty outputs for a chip that was skipped by the coarse scan
+    :param pair: Files object for the chip
+    :return: tuple of empty polygons, loc and damage arrays and overlay array of the pre image alone or None
+    """
+    profile = pair.opts.geo_profile.copy()
+    profile.update(dtype=rasterio.uint8)
+    empty = np.zeros((profile['height'], profile['width']), dtype=np.uint8)
+
+    write_chip_outputs(pair.opts.out_loc_path, pair.opts.out_cls_path, profile, empty, empty)
+
+    overlay = None
+    if pair.opts.is_vis:
+        overlay = raster_processing.blend_overlay(read_base(pair.opts.in_pre_path, pair.windows, pair.crop, empty.shape), empty)
+
+    return [], empty, empty, overlay
+
+
+def split_batch(batch, start, stop):
+    """
+    Slice a collated batch
+    :param batch: batch dictionary from the dataloader
+    :param start: first sample
+    :param stop: end sample (exclusive)
+    :return: batch dictionary with samples start to stop
+    """
+    return {k: v[start:stop] for k, v in batch.items()}
+
+
+def is_oom(ex):
+    """
+    Check if an exception is CUDA running out of memory
+    :param ex: exception
+    :return: True if out of memory
+    """
+    oom_error = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if oom_error is not None and isinstance(ex, oom_error):
+        return True
+
+    # Older torch versions raise a RuntimeError
+    return isinstance(ex, RuntimeError) and 'out of memory' in str(ex)
+
+
+def forward_batch(model_wrapper, batch, debug=False):
+    """
+    Run a batch through the model. If CUDA runs out of memory the batch is split in half and each half is retried.
+    Chips that still run out of memory on their own are logged and dropped, and are quarantined once inference
+    finishes. Other errors are raised.
+    :param model_wrapper: model wrapper
+    :param batch: batch dictionary from the dataloader
+    :param debug: passed to the model wrapper
+    :return: list of (batch, output) tuples
+    """
+    try:
+        with profiling.annotate('forward'):
+            out = model_wrapper.forward(batch['img'], debug=debug, keys=batch.get('pre_key'))
+        return [(batch, out.detach().cpu())]
+    except Exception as ex:
+        if not is_oom(ex):
+            raise
 
-def run_inference(loader, model_wrapper, write_output=False, mode='loc', return_dict=None):
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+        size = len(batch['idx'])
+        if size == 1:
+            logger.error(f'Inference failed for {batch["in_pre_path"][0]}: {ex}')
+            return []
+
+        half = size // 2
+        logger.warning(f'Out of memory for batch of {size}. Retrying at batch size {half}')
+        return (forward_batch(model_wrapper, split_batch(batch, 0, half), debug=debug) +
+                forward_batch(model_wrapper, split_batch(batch, half, size), debug=debug))
+
+
+def collect_batch(loader, result_dict, out, mode, results):
+    """
+    Add model outputs for a batch to the results
+    :param loader: dataloader the batch came from
+    :param result_dict: batch dictionary
+    :param out: model output for the batch
+    :param mode: loc, cls or fast
+    :param results: dictionary of lists to extend
+    """
+    del result_dict['img']
+
+    if 'pre_image' in result_dict:
+        result_dict['pre_image'] = result_dict['pre_image'].cpu().numpy()
+    if 'post_img' in result_dict:
+        result_dict['post_image'] = result_dict['post_image'].cpu().numpy()
+    if mode == 'loc':
+        result_dict['loc'] = out
+    elif mode == 'cls':
+        result_dict['cls'] = out
+    elif mode == 'fast':
+        # Student outputs localization in channel 0 followed by the damage channels
+        result_dict['loc'] = out[..., 0]
+        result_dict['cls'] = out[..., 1:]
+    else:
+        raise ValueError('Incorrect mode -- must be loc, cls or fast')
+    # Do this one separately because you can't return a class from a dataloader
+    result_dict['geo_profile'] = [loader.dataset.pairs[idx].opts.geo_profile
+                                  for idx in result_dict['idx']]
+    result_dict['windows'] = [loader.dataset.pairs[idx].opts.windows
+                              for idx in result_dict['idx']]
+    result_dict['crop'] = [loader.dataset.pairs[idx].opts.crop
+                           for idx in result_dict['idx']]
+    # Output paths are None when chip outputs are only written to the output mosaics
+    result_dict['out_loc_path'] = [loader.dataset.pairs[idx].opts.out_loc_path
+                                   for idx in result_dict['idx']]
+    result_dict['out_cls_path'] = [loader.dataset.pairs[idx].opts.out_cls_path
+                                   for idx in result_dict['idx']]
+    for k,v in result_dict.items():
+        results[k] = results[k] + list(v)
+
+
+def run_inference(loader, model_wrapper, write_output=False, mode='loc', return_dict=None, profiler=None):
     results = defaultdict(list)
-    with torch.no_grad(): # This is really important to not explode memory with gradients!
-        for ii, result_dict in tqdm(enumerate(loader), total=len(loader)):
-            #print(result_dict['in_pre_path'])
+    name = f'{model_wrapper.model_size}{mode}'
+    session = profiler.profile(name, model_wrapper) if profiler is not None else nullcontext()
+    with torch.no_grad(), session as prof: # no_grad is really important to not explode memory with gradients!
+        for ii, batch in tqdm(enumerate(profiling.timed(loader)), total=len(loader)):
+            #print(batch['in_pre_path'])
             debug=False
-            #if '116' in result_dict['in_pre_path'][0]:
+            #if '116' in batch['in_pre_path'][0]:
             #    import ipdb; ipdb.set_trace()
             #    debug=True
-            out = model_wrapper.forward(result_dict['img'],debug=debug)
-            out = out.detach().cpu()
-            
-            del result_dict['img']
-
-            if 'pre_image' in result_dict:
-                result_dict['pre_image'] = result_dict['pre_image'].cpu().numpy()
-            if 'post_img' in result_dict:
-                result_dict['post_image'] = result_dict['post_image'].cpu().numpy()
-            if mode == 'loc':
-                result_dict['loc'] = out
-            elif mode == 'cls':
-                result_dict['cls'] = out
-            else:
-                raise ValueError('Incorrect mode -- must be loc or cls')
-            # Do this one separately because you can't return a class from a dataloader
-            result_dict['geo_profile'] = [loader.dataset.pairs[idx].opts.geo_profile
-                                          for idx in result_dict['idx']]
-            for k,v in result_dict.items():
-                results[k] = results[k] + list(v)
+            for result_dict, out in forward_batch(model_wrapper, batch, debug=debug):
+                collect_batch(loader, result_dict, out, mode, results)
+
+            if prof is not None:
+                prof.step()
                 
     # Making a list
     results_list = [dict(zip(results,t)) for t in zip(*results.values())]
@@ -235,31 +510,24 @@ def run_inference(loader, model_wrapper, write_output=False, mode='loc', return_
                                   result['in_pre_path'].split('/')[-1].replace('.tif', '_part1.png')),
                                    np.array(result['loc'])[...], 
                                    [cv2.IMWRITE_PNG_COMPRESSION, 9])
-            elif mode == 'cls':
+            else:
+                if mode == 'fast':
+                    cv2.imwrite(path.join(pred_folder, result['in_pre_path'].split('/')[-1].replace('.tif', '_loc.png')),
+                                          np.array(result['loc'])[...], [cv2.IMWRITE_PNG_COMPRESSION, 9])
                 cv2.imwrite(path.join(pred_folder, result['in_pre_path'].split('/')[-1].replace('.tif', '_part1.png')),
                                       np.array(result['cls'])[..., :3], [cv2.IMWRITE_PNG_COMPRESSION, 9])
                 cv2.imwrite(path.join(pred_folder, result['in_pre_path'].split('/')[-1].replace('.tif', '_part2.png')),
                                       np.array(result['cls'])[..., 2:], [cv2.IMWRITE_PNG_COMPRESSION, 9])    
     if return_dict is None:
         return results_list
+    elif mode == 'fast':
+        # Each result holds both outputs so postprocessing sees a single loc and cls member
+        return_dict[f'{model_wrapper.model_size}loc'] = results_list
+        return_dict[f'{model_wrapper.model_size}cls'] = results_list
     else:
         return_dict[f'{model_wrapper.model_size}{mode}'] = results_list
 
 
-def check_data(images):
-    """
-    Check that our image pairs contain useful data. Note: This only check the first band of each file.
-    :param images: Images to check for data
-    :return: True if both images contain useful data. False if either contains no useful date.
-    """
-    for image in images:
-        with rasterio.open(image) as src:
-            layer = src.read(1)
-            if layer.sum() == 0:
-                return False
-
-    return True
-
 def parse_args():
     parser = argparse.ArgumentParser(description='Create arguments for xView 2 handler.')
 
@@ -274,133 +542,192 @@ def parse_args():
     parser.add_argument('--post_crs', help='The Coordinate Reference System (CRS) for the post-disaster imagery. This will only be utilized if images lack CRS data.')
     parser.add_argument('--destination_crs', default='EPSG:4326', help='The Coordinate Reference System (CRS) for the output overlays.')
     parser.add_argument('--dp_mode', default=False, action='store_true', help='Run models serially, but using DataParallel')
+    parser.add_argument('--fast', default=False, action='store_true', help='Run the single distilled student model (see distill.py) instead of the full ensemble')
+    parser.add_argument('--soup', default=False, action='store_true', help='Use a single weight-averaged soup per architecture (see soup.py) instead of the three seed checkpoints')
+    parser.add_argument('--coarse_scan', default=None, type=int, choices=[2, 4], help='Run the ResNet34 localization model at 1/2 or 1/4 resolution first and only run the full ensemble on chips with building signal. Skipped chips get empty outputs.')
+    parser.add_argument('--coarse_threshold', default=0.1, type=float, help='Minimum coarse localization probability that counts as building signal')
+    parser.add_argument('--coarse_margin', default=256, type=int, help='Safety margin in pixels around each chip when checking the coarse scan')
+    parser.add_argument('--coarse_validate', default=False, action='store_true', help='Run the full ensemble on every chip and report recall of the coarse scan against it')
+    parser.add_argument('--warp_memory', default=2048, type=int, help='GDAL warp buffer size in MB when building mosaics')
+    parser.add_argument('--warp_threads', default='ALL_CPUS', help='Number of GDAL warp and compression threads when building mosaics or ALL_CPUS')
+    parser.add_argument('--staged_reproject', default=False, action='store_true', help='Re-project each input file to the staging cache before mosaicking instead of warping all inputs straight to the mosaic')
+    parser.add_argument('--staging_cache_directory', metavar='/path/to/cache/', type=Path, default=None, help='Cache of re-projected inputs for --staged_reproject. Share between runs to reuse inputs re-projected with the same parameters. Defaults to staging_directory/cache.')
+    parser.add_argument('--staging_cache_size', default=100, type=float, help='Size limit of the staging cache in GB. The least recently used files are removed first.')
     parser.add_argument('--output_resolution', default=None, help='Override minimum resolution calculator. This should be a lower resolution (higher number) than source imagery for decreased inference time. Must be in units of destinationCRS.')
-    parser.add_argument('--save_intermediates', default=False, action='store_true', help='Store intermediate runfiles')
+    parser.add_argument('--profile', default=False, action='store_true', help='Profile a window of inference batches for each model wrapper. Chrome traces are written to output_directory/profile.')
+    parser.add_argument('--profile_start', default=2, type=int, help='Number of batches to skip before profiling')
+    parser.add_argument('--profile_batches', default=5, type=int, help='Number of batches to profile')
+    parser.add_argument('--profile_top', default=20, type=int, help='Number of operators in the logged profiler summary')
+    parser.add_argument('--vrt_outputs', default=False, action='store_true', help='With --distributed, stitch the overlay, loc and damage mosaics of super-tiles as VRTs instead of merging them')
+    parser.add_argument('--chip_outputs', default=False, action='store_true', help='Also write the loc and damage outputs of each chip to output_directory/loc and dmg. By default they are only written to the loc and damage mosaics.')
+    parser.add_argument('--mosaic_format', default='cog', choices=['cog', 'gtiff'], help='Format of the pre, post and overlay mosaics. cog writes Cloud-Optimized GeoTIFFs with internal overviews. gtiff writes tiled GeoTIFFs without overviews.')
+    parser.add_argument('--materialize', default=False, action='store_true', help='With --vrt_outputs, also write each VRT as a Cloud-Optimized GeoTIFF with overviews in a background process')
+    parser.add_argument('--web_tiles', default=None, choices=['overlay', 'damage'], help='Create a Web Mercator XYZ tile pyramid in output_directory/web_tiles from the overlay mosaic, or from the damage mosaic with the damage colors. Resumed runs only update the tiles of chips postprocessed in that run.')
+    parser.add_argument('--web_tile_format', default='png', choices=['png', 'webp'], help='Format of web tiles')
+    parser.add_argument('--web_tile_min_zoom', default=None, type=int, help='Lowest web tile zoom. Defaults to the highest zoom covering the mosaic with a single tile.')
+    parser.add_argument('--web_tile_max_zoom', default=None, type=int, help='Highest web tile zoom. Defaults to the first zoom at or above the mosaic resolution.')
+    parser.add_argument('--pad_edges', default=False, action='store_true', help='Zero pad the ragged right and bottom chips instead of shifting edge chips inside the imagery and choosing the chip grid anchor that needs the fewest chips')
+    parser.add_argument('--chip_compress', default='deflate', choices=raster_processing.CHIP_COMPRESSION + ['auto'], help='Compression of chips written with --save_intermediates. auto times writing and reading a sample of chips with each option and uses the fastest.')
+    parser.add_argument('--chip_block_size', default=256, type=int, choices=[256, 512], help='Internal tile size of compressed chips')
+    parser.add_argument('--save_intermediates', default=False, action='store_true', help='Store intermediate runfiles. Chips are only written to disk with this set. Otherwise they are read straight from the mosaics.')
+    parser.add_argument('--pre_cache_directory', metavar='/path/to/cache/', type=Path, default=None, help='Directory to cache localization outputs and pre-image features. Reuse between runs sharing the same pre imagery to only compute the post branch. Requires substantial disk space.')
+    parser.add_argument('--distributed', default=None, choices=['plan', 'work', 'reduce', 'all'], help='Run across nodes sharing queue_directory. plan splits the imagery intersect into super-tiles, work claims and processes super-tiles, reduce stitches the outputs once all super-tiles are finished. all does each in turn and is safe to start on every node.')
+    parser.add_argument('--queue_directory', metavar='/path/to/queue/', type=Path, default=None, help='Work queue directory on a filesystem shared by all nodes. Required with --distributed.')
+    parser.add_argument('--super_tile_size', default=16384, type=int, help='Super-tile edge length in output pixels for --distributed')
+    parser.add_argument('--queue_timeout', default=3600, type=int, help='Seconds without a heartbeat before a claimed super-tile is returned to the queue')
+    parser.add_argument('--priority_file', metavar='/path/to/aoi.geojson', type=Path, default=None, help='Points or polygons of interest. Chips are processed in order of distance to them.')
+    parser.add_argument('--priority_raster', metavar='/path/to/priority.tif', type=Path, default=None, help='Raster of processing priority. Chips with higher values at their center are processed first. Ignored with --priority_file.')
+    parser.add_argument('--catalog_file', metavar='/path/to/catalog.sqlite', type=Path, default=None, help='SQLite catalog of input footprints, CRS and resolution. Reuse between runs over the same imagery to skip reopening unchanged inputs.')
+    parser.add_argument('--no_resume', default=False, action='store_true', help='Ignore the run manifest in output_directory and redo every stage')
+    parser.add_argument('--chip_group_size', default=2048, type=int, help='Number of chips inferred and postprocessed at a time. Completed chips are recorded after each group so an interrupted run only redoes the group in progress.')
+    parser.add_argument('--vector_commit_every', default=50, type=int, help='Number of postprocessed chips between flushes of the damage shapefile')
+    parser.add_argument('--agol_incremental', default=False, action='store_true', help='Push damage polygons to AGOL each time the damage shapefile is flushed instead of at the end of the run')
     parser.add_argument('--agol_user', default=None, help='ArcGIS online username')
     parser.add_argument('--agol_password', default=None, help='ArcGIS online password')
     parser.add_argument('--agol_feature_service', default=None, help='ArcGIS online feature service to append damage polygons.')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.distributed and args.queue_directory is None:
+        parser.error('--queue_directory is required with --distributed')
 
+    return args
 
-@logger.catch()
-def main():
 
-    t0 = timeit.default_timer()
+def report_input_errors(errors, report):
 
-    # Determine if items are being pushed to AGOL
-    agol_push = to_agol.agol_arg_check(args.agol_user, args.agol_password, args.agol_feature_service)
+    """
+    Report inputs that could not be used. Inputs with no CRS are skipped with a debug message instead.
+    :param errors: list of (file, error)
+    :param report: FailureReport
+    """
 
-    make_staging_structure(args.staging_directory)
-    make_output_structure(args.output_directory)
+    for in_file, error in errors:
+        if error == raster_processing.NO_CRS:
+            logger.debug(f'Skipping {in_file} with no CRS')
+        else:
+            report.add('reproject', in_file, error)
 
-    logger.info('Retrieving files...')
-    pre_files = get_files(args.pre_directory)
-    logger.debug(f'Retrieved {len(pre_files)} pre files from {args.pre_directory}')
-    post_files = get_files(args.post_directory)
-    logger.debug(f'Retrieved {len(post_files)} pre files from {args.post_directory}')
 
-    logger.info('Re-projecting...')
-    # Todo: test for overridden resolution and log a warning with calculated resolution.
-    if not args.output_resolution:
-        reproj_res = raster_processing.get_reproj_res(pre_files, post_files, args)
-    else:
-        # Create tuple from passed resolution
-        reproj_res = (args.output_resolution, args.output_resolution)
+def reproject_files(pre_files, post_files, reproj_res, report=None, footprints=None, clip=None):
 
-    print(f'Re-projecting. Resolution (x, y): {reproj_res}')
+    """
+    Re-project input files in parallel processes. Files re-projected with the same parameters by an earlier run are
+    reused from the staging cache.
+    :param pre_files: pre-disaster files
+    :param post_files: post-disaster files
+    :param reproj_res: tuple -- output resolution
+    :param report: FailureReport to record inputs that could not be re-projected
+    :param footprints: dict of file to bounds in the destination crs, used with clip
+    :param clip: bounds to limit each re-projected file to
+    :return: tuple of lists of re-projected pre and post files
+    """
+
+    def get_bounds(f):
+        if clip is None or f not in footprints:
+            return None
+        return raster_processing.get_warp_bounds(footprints[f], clip, reproj_res)
 
-    # Run reprojection in parallel processes
+    cache = StagingCache(args.staging_cache_directory or Path(args.staging_directory).joinpath('cache'),
+                         max_gb=args.staging_cache_size)
     manager = mp.Manager()
     return_dict = manager.dict()
     jobs = []
 
     # Some data hacking to make it more efficient for multiprocessing
-    pre_files = [("pre", args.pre_crs, x) for x in pre_files]
-    post_files = [("post", args.post_crs, x) for x in post_files]
+    pre_files = [("pre", args.pre_crs, x, get_bounds(x)) for x in pre_files]
+    post_files = [("post", args.post_crs, x, get_bounds(x)) for x in post_files]
     files = pre_files + post_files
 
     # Launch multiprocessing jobs for reprojection
     for idx, f in enumerate(files):
-        p = mp.Process(target=reproject_helper, args=(args, f, idx, return_dict, reproj_res))
+        p = mp.Process(target=reproject_helper, args=(args, f, idx, return_dict, reproj_res, cache))
         jobs.append(p)
         p.start()
     for proc in jobs:
         proc.join()
 
+    errors = []
+    for idx, (pre_post, _, raster_file, _) in enumerate(files):
+        if idx not in return_dict:
+            errors.append((raster_file, f'Re-projection process exited with code {jobs[idx].exitcode}'))
+        elif return_dict[idx][1] is None:
+            errors.append((raster_file, return_dict[idx][2]))
+    if report is not None:
+        report_input_errors(errors, report)
+
     reproj = [x for x in return_dict.values() if x[1] is not None]
     pre_reproj = [x[1] for x in reproj if x[0] == "pre"]
     post_reproj = [x[1] for x in reproj if x[0] == "post"]
+    cache.evict(keep=pre_reproj + post_reproj)
 
-    logger.info("Creating pre mosaic...")
-    pre_mosaic = raster_processing.create_mosaic(pre_reproj, Path(f"{args.output_directory}/mosaics/pre.tif"))
-    logger.info("Creating post mosaic...")
-    post_mosaic = raster_processing.create_mosaic(post_reproj, Path(f"{args.output_directory}/mosaics/post.tif"))
-
-    extent = raster_processing.get_intersect(pre_mosaic, post_mosaic)
+    return pre_reproj, post_reproj
 
-    logger.info('Chipping...')
-    # Todo: fix the use of logging with tqdm (doc pages for loguru)
-    pre_chips = raster_processing.create_chips(pre_mosaic, args.output_directory.joinpath('chips').joinpath('pre'), extent)
-    logger.debug(f'Num pre chips: {len(pre_chips)}')
-    post_chips = raster_processing.create_chips(post_mosaic, args.output_directory.joinpath('chips').joinpath('post'), extent)
-    logger.debug(f'Num post chips: {len(post_chips)}')
 
-    assert len(pre_chips) == len(post_chips), logger.error('Chip numbers mismatch')
+def run_models(pairs, cache=None, profiler=None):
 
-    # Defining dataset and dataloader
-    pairs = []
-    for idx, (pre, post) in enumerate(zip(pre_chips, post_chips)):
-        if not check_data([pre, post]):
-            continue
+    """
+    Run the model ensemble (or student) over chip pairs
+    :param pairs: list of Files objects
+    :param cache: FeatureCache or None
+    :param profiler: InferenceProfiler or None
+    :return: dict of results lists keyed by model size and task (ie. 34loc)
+    """
 
-        pairs.append(Files(
-            pre.stem,
-            args.pre_directory,
-            args.post_directory,
-            args.output_directory,
-            pre,
-            post)
-            )
-    
-    eval_loc_dataset = XViewDataset(pairs, 'loc')
+    eval_loc_dataset = XViewDataset(pairs, 'loc', cache_keys=cache is not None)
     eval_loc_dataloader = DataLoader(eval_loc_dataset, 
                                      batch_size=args.batch_size, 
                                      num_workers=args.num_workers,
                                      shuffle=False,
                                      pin_memory=True)
     
-    eval_cls_dataset = XViewDataset(pairs, 'cls')
+    eval_cls_dataset = XViewDataset(pairs, 'cls', cache_keys=cache is not None)
     eval_cls_dataloader = DataLoader(eval_cls_dataset, 
                                      batch_size=args.batch_size,
                                      num_workers=args.num_workers,
                                      shuffle=False,
                                      pin_memory=True)
 
+    if args.fast:
+        logger.info('Running distilled student model...')
+        return_dict = {}
+        student_wrapper = XViewStudentModel(dp_mode=args.dp_mode)
+
+        run_inference(eval_cls_dataloader,
+                            student_wrapper,
+                            args.save_intermediates,
+                            'fast',
+                            return_dict,
+                            profiler)
+
+        del student_wrapper
 
-    if args.dp_mode:
+        results_dict = {k:v for k,v in return_dict.items()}
+
+    elif args.dp_mode:
         results_dict = {}
 
         for sz in ['34', '50', '92', '154']:
             logger.info(f'Running models of size {sz}...')
             return_dict = {}
-            loc_wrapper = XViewFirstPlaceLocModel(sz, dp_mode=args.dp_mode)
+            loc_wrapper = XViewFirstPlaceLocModel(sz, dp_mode=args.dp_mode, cache=cache, soup=args.soup)
 
             run_inference(eval_loc_dataloader,
                                 loc_wrapper,
                                 args.save_intermediates,
                                 'loc',
-                                return_dict)
+                                return_dict,
+                            profiler)
 
             del loc_wrapper
 
-            cls_wrapper = XViewFirstPlaceClsModel(sz, dp_mode=args.dp_mode)
+            cls_wrapper = XViewFirstPlaceClsModel(sz, dp_mode=args.dp_mode, cache=cache, soup=args.soup)
 
             run_inference(eval_cls_dataloader,
                                 cls_wrapper,
                                 args.save_intermediates,
                                 'cls',
-                                return_dict)
+                                return_dict,
+                            profiler)
 
             del cls_wrapper
 
@@ -428,8 +755,8 @@ def main():
 
         for sz in loc_gpus.keys():
             logger.info(f'Running models of size {sz}...')
-            loc_wrapper = XViewFirstPlaceLocModel(sz, devices=loc_gpus[sz])
-            cls_wrapper = XViewFirstPlaceClsModel(sz, devices=cls_gpus[sz])
+            loc_wrapper = XViewFirstPlaceLocModel(sz, devices=loc_gpus[sz], cache=cache, soup=args.soup)
+            cls_wrapper = XViewFirstPlaceClsModel(sz, devices=cls_gpus[sz], cache=cache, soup=args.soup)
 
             # Running inference
             logger.info('Running inference...')
@@ -445,13 +772,15 @@ def main():
                                 cls_wrapper,
                                 args.save_intermediates,
                                 'cls',
-                                return_dict))
+                                return_dict,
+                                profiler))
             p2 = mp.Process(target=run_inference,
                             args=(eval_loc_dataloader,
                                 loc_wrapper,
                                 args.save_intermediates,
                                 'loc',
-                                return_dict))
+                                return_dict,
+                                profiler))
             p1.start()
             p2.start()
             jobs.append(p1)
@@ -484,8 +813,8 @@ def main():
 
         for sz in loc_gpus.keys():
             logger.info(f'Adding jobs for size {sz}...')
-            loc_wrapper = XViewFirstPlaceLocModel(sz, devices=loc_gpus[sz])
-            cls_wrapper = XViewFirstPlaceClsModel(sz, devices=cls_gpus[sz])
+            loc_wrapper = XViewFirstPlaceLocModel(sz, devices=loc_gpus[sz], cache=cache, soup=args.soup)
+            cls_wrapper = XViewFirstPlaceClsModel(sz, devices=cls_gpus[sz], cache=cache, soup=args.soup)
 
             # DEBUG
             #run_inference(eval_loc_dataloader,
@@ -502,14 +831,16 @@ def main():
                                 cls_wrapper,
                                 args.save_intermediates, # Don't write intermediate outputs
                                 'cls',
-                                return_dict))
+                                return_dict,
+                                profiler))
                             )
             jobs.append(mp.Process(target=run_inference,
                             args=(eval_loc_dataloader,
                                 loc_wrapper,
                                 args.save_intermediates, # Don't write intermediate outputs
                                 'loc',
-                                return_dict))
+                                return_dict,
+                                profiler))
                             )
 
         logger.info('Running inference...')
@@ -523,42 +854,856 @@ def main():
 
     else:
         raise ValueError('Must use either 2 or 8 GPUs')
-       
-    # Quick check to make sure the samples in cls and loc are in the same order
-    #assert(results_dict['34loc'][4]['in_pre_path'] == results_dict['34cls'][4]['in_pre_path'])
 
-    results_list = [{k:v[i] for k,v in results_dict.items()} for i in range(len(results_dict['34cls'])) ]
+    return results_dict
+
+
+# Output mosaic name and overview resampling
+OUTPUT_MOSAICS = (('overlay', 'average'), ('loc', 'nearest'), ('damage', 'nearest'))
+
+# Background processes materializing VRT mosaics. Joined before the run completes.
+materialize_jobs = []
+
+
+def materialize(vrt, resampling):
+
+    """
+    Materialize a VRT mosaic as a COG next to it in a background process
+    :param vrt: path to VRT
+    :param resampling: overview resampling
+    :return: background process
+    """
+
+    logger.info(f'Materializing {vrt.name} in the background')
+    job = mp.Process(target=raster_processing.create_cog, args=(vrt, vrt.with_suffix('.tif'), resampling))
+    job.start()
+    materialize_jobs.append(job)
+
+    return job
+
+
+def create_output_mosaics(output_directory, tile_dirs, materialize_vrt=False):
+
+    """
+    Stitch the overlay, loc and damage mosaics of super-tiles. By default they are merged into COGs. With
+    --vrt_outputs, VRTs are created instead.
+    :param output_directory: output directory of the run
+    :param tile_dirs: super-tile output directories
+    :param materialize_vrt: materialize the VRTs as COGs in background processes
+    :return: list of paths to mosaics
+    """
+
+    mosaics = []
+    for name, resampling in OUTPUT_MOSAICS:
+        in_files = [d.joinpath('mosaics').joinpath(f'{name}.tif') for d in tile_dirs]
+        in_files = [f for f in in_files if f.is_file()]
+        if not in_files:
+            continue
+
+        logger.info(f"Creating {name} mosaic")
+        if args.vrt_outputs:
+            mosaic = raster_processing.create_vrt(in_files, Path(f"{output_directory}/mosaics/{name}.vrt"))
+            if materialize_vrt:
+                materialize(mosaic, resampling)
+        else:
+            mosaic = finish_mosaic(raster_processing.create_mosaic(in_files, Path(f"{output_directory}/mosaics/{name}.tif")),
+                                   resampling)
+        mosaics.append(mosaic)
+
+    return mosaics
+
+
+def create_web_tiles(output_directory, changed=None):
+
+    """
+    Create the XYZ web tile pyramid of the overlay or damage mosaic
+    :param output_directory: output directory of the run
+    :param changed: bounds of chips postprocessed in this run to only update their tiles, or None to render all tiles
+    :return: path to the TileJSON metadata of the pyramid or None if there is no mosaic to tile
+    """
+
+    mosaics = Path(output_directory).joinpath('mosaics')
+    in_raster = next((f for f in (mosaics / f'{args.web_tiles}.tif', mosaics / f'{args.web_tiles}.vrt') if f.is_file()), None)
+    if in_raster is None:
+        logger.warning(f'No {args.web_tiles} mosaic to create web tiles from')
+        return None
+
+    logger.info(f'Creating web tiles from {in_raster.name}')
+    return web_tiles.create_tiles(in_raster,
+                                  Path(output_directory).joinpath('web_tiles'),
+                                  source=args.web_tiles,
+                                  tile_format=args.web_tile_format,
+                                  min_zoom=args.web_tile_min_zoom,
+                                  max_zoom=args.web_tile_max_zoom,
+                                  changed=changed,
+                                  workers=args.n_procs)
+
+
+def run_pipeline(pre_files, post_files, staging_directory, output_directory, reproj_res=None, bounds=None, report=None, push=None):
+
+    """
+    Run reproject, chip, inference, postprocessing and polygonization over a set of input files
+    :param pre_files: pre-disaster files
+    :param post_files: post-disaster files
+    :param staging_directory: directory for intermediate working files
+    :param output_directory: directory for output files
+    :param reproj_res: tuple -- output resolution. Calculated from the inputs if None
+    :param bounds: bounds (left, bottom, right, top) to limit processing to. Uses the full intersect if None
+    :param report: FailureReport to record failed inputs and chips
+    :param push: optional function called with each committed batch of polygons (ie. an AGOL append)
+    :return: list of polygons and damage values
+    """
+
+    if report is None:
+        report = FailureReport()
+    quarantine_directory = output_directory.joinpath('chips').joinpath('quarantine')
+
+    make_staging_structure(staging_directory)
+    make_output_structure(output_directory)
+
+    # Completed stages and chips from an earlier run with the same arguments are validated and skipped
+    manifest = RunManifest(output_directory.joinpath('manifest.json'), enabled=not args.no_resume)
+
+    logger.info('Re-projecting...')
+    # Todo: test for overridden resolution and log a warning with calculated resolution.
+    if reproj_res is None:
+        reproj_res = get_resolution(pre_files, post_files)
+
+    print(f'Re-projecting. Resolution (x, y): {reproj_res}')
+
+    # Plan from footprints so only inputs and areas where pre and post overlap are warped
+    pre_footprints = dict(get_input_footprints(pre_files, args.pre_crs))
+    post_footprints = dict(get_input_footprints(post_files, args.post_crs))
+    for files, footprints, in_crs in ((pre_files, pre_footprints, args.pre_crs), (post_files, post_footprints, args.post_crs)):
+        report_input_errors(raster_processing.get_sources([f for f in files if f not in footprints], in_crs)[1], report)
+    assert pre_footprints and post_footprints, logger.critical('No readable pre or post files with a CRS')
+    # Warps are limited to the clip, which is on the global pixel grid so super-tiles warped by different workers line
+    # up when stitched
+    clip = raster_processing.get_footprint_intersect(list(pre_footprints.items()), list(post_footprints.items()))
+    clip = raster_processing.snap_bounds(clip, reproj_res)
+
+    if bounds is not None:
+        if not raster_processing.bounds_intersect(clip, bounds):
+            logger.info(f'No imagery intersect inside {bounds}')
+            return []
+        clip = raster_processing.snap_bounds(raster_processing.clip_bounds(clip, bounds), reproj_res)
+
+    n_files = len(pre_files) + len(post_files)
+    pre_files = [f for f, b in pre_footprints.items() if raster_processing.bounds_intersect(b, clip)]
+    post_files = [f for f, b in post_footprints.items() if raster_processing.bounds_intersect(b, clip)]
+    logger.info(f'Warping {len(pre_files) + len(post_files)} of {n_files} files overlapping {clip}')
+
+    reproj_params = {'resolution': reproj_res,
+                     'destination_crs': args.destination_crs,
+                     'pre_crs': args.pre_crs,
+                     'post_crs': args.post_crs,
+                     'bounds': clip}
+    if args.staged_reproject:
+        pre_mosaic, post_mosaic = create_staged_mosaics(pre_files, post_files, reproj_res, reproj_params,
+                                                        output_directory, manifest, report,
+                                                        footprints={**pre_footprints, **post_footprints}, clip=clip)
+    else:
+        logger.info("Warping pre mosaic...")
+        pre_mosaic = create_warped_mosaic('pre', pre_files, args.pre_crs, reproj_res, reproj_params,
+                                          output_directory, manifest, report, clip=clip)
+        logger.info("Warping post mosaic...")
+        post_mosaic = create_warped_mosaic('post', post_files, args.post_crs, reproj_res, reproj_params,
+                                           output_directory, manifest, report, clip=clip)
 
-    # Running postprocessing
+    extent = raster_processing.get_intersect(pre_mosaic, post_mosaic)
+
+    if bounds is not None:
+        extent = raster_processing.clip_bounds(extent, bounds)
+
+    # Only chip where both mosaics have data. Strip imagery leaves large nodata areas inside the bounding intersect.
+    coverage = raster_processing.get_coverage_intersect(pre_mosaic, post_mosaic)
+    if coverage.is_empty:
+        logger.info('Pre and post imagery have no valid data in common')
+        return []
+    logger.info(f'Valid data covers {coverage.intersection(box(*extent)).area / box(*extent).area:.1%} of the intersect')
+
+    # Edge chips are shifted inside the imagery so inference is spent on real pixels rather than zero padding
+    shift_edges = not args.pad_edges
+    anchor = raster_processing.plan_chip_layout(pre_mosaic, extent, coverage=coverage) if shift_edges else (0, 0)
+
+    if args.save_intermediates:
+        logger.info('Chipping...')
+        if args.chip_compress == 'auto':
+            creation_options, _ = raster_processing.benchmark_chip_options(pre_mosaic, Path(staging_directory).joinpath('chip_benchmark'), extent)
+        else:
+            creation_options = raster_processing.get_chip_creation_options(args.chip_compress, args.chip_block_size)
+
+        # Todo: fix the use of logging with tqdm (doc pages for loguru)
+        chip_params = {'extent': extent, 'coverage': True, 'creation_options': creation_options,
+                       'anchor': anchor, 'shift_edges': shift_edges}
+        chip_directory = output_directory.joinpath('chips')
+
+        def chip():
+            records = raster_processing.create_chip_pairs(pre_mosaic, post_mosaic, chip_directory, extent,
+                                                          coverage=coverage,
+                                                          creation_options=creation_options,
+                                                          workers=args.n_procs,
+                                                          anchor=anchor,
+                                                          shift_edges=shift_edges)
+            index = raster_processing.write_chip_index(records, chip_directory.joinpath('chips.json'))
+            return [index] + [f for r in records for f in (r.pre, r.post)]
+
+        # Chip records are kept in an index so a resumed run does not reopen the chips
+        chip_files = run_stage(manifest, 'chips', [pre_mosaic, post_mosaic], chip_params, chip)
+        chip_pairs = raster_processing.read_chip_index(chip_files[0])
+        logger.debug(f'Num chip pairs: {len(chip_pairs)}')
+    else:
+        # Chips are read straight from the mosaics by the dataset so nothing is written
+        chip_pairs = plan_chips(pre_mosaic, post_mosaic, extent, coverage, anchor=anchor, shift_edges=shift_edges)
+        logger.debug(f'Num chip windows: {len(chip_pairs)}')
+
+    # Outputs of chips completed in an earlier run are kept in the output mosaics, so those chips can only be skipped if
+    # the mosaics are intact, on the same grid and not yet finished
+    output_profile = get_output_profile(pre_mosaic, extent)
+    output_mosaics = {name: (output_directory.joinpath('mosaics').joinpath(f'{name}.tif'), dict(output_profile, count=count))
+                      for name, count in (('overlay', 3), ('loc', 1), ('damage', 1))}
+    resume = all(MosaicWriter.can_update(*v) for v in output_mosaics.values())
+
+    # Defining dataset and dataloader
+    model_params = get_model_params()
+    pairs = []
+    completed_chips = []
+    for record in chip_pairs:
+        # Written chips are checked for data as they are chipped and windowed chips are inside the coverage intersect
+        try:
+            pair = Files(
+                record.ident,
+                args.pre_directory,
+                args.post_directory,
+                output_directory,
+                record.pre,
+                record.post,
+                windows=record.windows,
+                profile=record.profile,
+                crop=record.crop,
+                chip_outputs=args.chip_outputs)
+        except Exception as ex:
+            report.quarantine('chip', record.ident, [record.pre, record.post] if record.windows is None else [], quarantine_directory, ex)
+            continue
+
+        if resume and manifest.get(f'chip_{record.ident}', [record.pre, record.post], get_chip_params(model_params, record.windows, record.crop)) is not None:
+            completed_chips.append(pair)
+        else:
+            pairs.append(pair)
+
+    if completed_chips:
+        logger.info(f'Skipping {len(completed_chips)} chips completed in an earlier run')
+
+    if not pairs and not completed_chips:
+        logger.info('No chips with data')
+        return []
+
+    # Chips nearest the areas of interest are inferred and postprocessed first
+    if pairs and (args.priority_file or args.priority_raster):
+        order = priority.get_order([rasterio.transform.array_bounds(pair.profile['height'], pair.profile['width'], pair.transform)
+                                    for pair in pairs],
+                                   args.destination_crs,
+                                   priority_file=args.priority_file,
+                                   priority_raster=args.priority_raster)
+        pairs = [pairs[i] for i in order]
+        logger.info(f'Ordered chips by priority starting with {pairs[0].ident}')
+    
+    # Find chips with any building signal at reduced resolution and only run the full ensemble on those
+    skipped = []
+    if args.coarse_scan and pairs:
+        logger.info(f'Running coarse scan at 1/{args.coarse_scan} resolution...')
+        coarse_wrapper = XViewFirstPlaceLocModel('34', dp_mode=args.dp_mode, soup=args.soup)
+        probs, coarse_transform = coarse_scan.scan(pre_mosaic, extent, coarse_wrapper,
+                                                   factor=args.coarse_scan, batch_size=args.batch_size)
+        del coarse_wrapper
+
+        selected = coarse_scan.select_chips([pair.opts.geo_profile for pair in pairs],
+                                            probs,
+                                            coarse_transform,
+                                            threshold=args.coarse_threshold,
+                                            margin=args.coarse_margin,
+                                            factor=args.coarse_scan)
+        logger.info(f'Coarse scan selected {sum(selected)} of {len(pairs)} chips')
+
+        # When validating, every chip is still inferred so the coarse selection can be compared with the full pass
+        all_pairs = pairs
+        if not args.coarse_validate:
+            skipped = [pair for pair, keep in zip(pairs, selected) if not keep]
+            pairs = [pair for pair, keep in zip(pairs, selected) if keep]
+
+    # Cache pre-image results so later runs with new post imagery skip the loc ensemble and pre branch
+    if args.pre_cache_directory:
+        logger.info(f'Using pre-image cache at {args.pre_cache_directory}')
+        cache = FeatureCache(args.pre_cache_directory)
+    else:
+        cache = None
+
+    if args.profile:
+        profiler = profiling.InferenceProfiler(output_directory / 'profile',
+                                               start=args.profile_start,
+                                               batches=args.profile_batches,
+                                               top=args.profile_top)
+    else:
+        profiler = None
+
+    # Running inference and postprocessing. Damage polygons are appended to the shapefile and loc, damage and overlay
+    # outputs are written into the output mosaics as each chip finishes.
     p = mp.Pool(args.n_procs)
     #postprocess_and_write(results_list[0])
-    f_p = postprocess_and_write
-    p.map(f_p, results_list)
-    
+    f_p = partial(isolate, postprocess_chip)
+    postprocessed = []
+    logger.info('Creating shapefile')
+    with VectorWriter(output_directory.joinpath('shapes') / 'damage.shp',
+                      args.destination_crs,
+                      commit_every=args.vector_commit_every,
+                      push=push) as writer:
+
+        # Chips completed in an earlier run are polygonized from the damage mosaic before it is opened for writing
+        resume_damage = partial(resume_chip, damage_mosaic=output_mosaics['damage'][0])
+        for pair, (polygons, error) in zip(completed_chips, p.imap(partial(isolate, resume_damage), completed_chips, chunksize=4)):
+            if error is not None:
+                report.add('postprocess', pair.ident, error)
+            else:
+                writer.write(polygons)
+
+        # Only this process writes to the mosaics so writes from the pool are serialized
+        with MosaicWriter(*output_mosaics['overlay'], update=bool(completed_chips), mask=True) as overlay_writer, \
+                MosaicWriter(*output_mosaics['loc'], update=bool(completed_chips)) as loc_writer, \
+                MosaicWriter(*output_mosaics['damage'], update=bool(completed_chips)) as dmg_writer:
+
+            def write_outputs(pair, polygons, loc, cls, overlay):
+                writer.write(polygons)
+                loc_writer.write(loc, pair.transform)
+                dmg_writer.write(cls, pair.transform)
+                if overlay is not None:
+                    overlay_writer.write(overlay, pair.transform)
+
+            def commit():
+                # Written chips are flushed before they are recorded as complete
+                for mosaic_writer in (overlay_writer, loc_writer, dmg_writer):
+                    mosaic_writer.commit()
+                manifest.save()
+
+            # Chips are inferred and postprocessed in groups and recorded after each group, so an interrupted run only
+            # redoes the group in progress. Groups follow the priority order so outputs of the areas of interest are
+            # written before the remaining chips are inferred.
+            for start in range(0, len(pairs), args.chip_group_size):
+                group = pairs[start:start + args.chip_group_size]
+                logger.info(f'Running chips {start + 1} to {start + len(group)} of {len(pairs)}')
+                # Only the first group is profiled
+                results_dict = run_models(group, cache, profiler if start == 0 else None)
+
+                # Match results by chip. Chips dropped by any model after failed inference are left out and quarantined.
+                results_by_idx = {k: {int(r['idx']): r for r in v} for k, v in results_dict.items()}
+                completed = set.intersection(*[set(v) for v in results_by_idx.values()]) if results_by_idx else set()
+                results_list = [{k: v[i] for k, v in results_by_idx.items()} for i in sorted(completed)]
+
+                for idx, pair in enumerate(group):
+                    if idx not in completed:
+                        report.quarantine('inference', pair.ident, save_chips(pair, output_directory), quarantine_directory, 'Inference failed')
+
+                for idx, (result, error) in zip(sorted(completed), p.imap(f_p, results_list, chunksize=1)):
+                    if error is not None:
+                        report.add('postprocess', group[idx].ident, error)
+                    else:
+                        write_outputs(group[idx], *result)
+                        record_chip(manifest, group[idx], model_params)
+                        postprocessed.append(group[idx])
+                        if writer.chips % args.vector_commit_every == 0:
+                            commit()
+                commit()
+
+            for pair, (result, error) in zip(skipped, p.imap(partial(isolate, write_empty), skipped, chunksize=4)):
+                if error is not None:
+                    report.add('postprocess', pair.ident, error)
+                else:
+                    write_outputs(pair, *result)
+                    record_chip(manifest, pair, model_params)
+                    postprocessed.append(pair)
+            commit()
+
+    logger.debug(f'Polygons created: {len(writer.polygons)}')
+
+    # Distributed super-tile mosaics are only converted once stitched
+    if not args.distributed:
+        for name, (mosaic, _) in output_mosaics.items():
+            finish_mosaic(mosaic, 'average' if name == 'overlay' else 'nearest', compress=True)
+
+    if args.coarse_scan and args.coarse_validate and pairs:
+        pixel_recall, chip_fraction = coarse_scan.recall(selected, output_mosaics['loc'][0],
+                                                         [rasterio.transform.array_bounds(pair.profile['height'], pair.profile['width'], pair.transform)
+                                                          for pair in all_pairs])
+        logger.info(f'Coarse scan recall: {pixel_recall:.4f} of building pixels with {chip_fraction:.2%} of chips selected')
+
+    if args.web_tiles and not args.distributed:
+        # Resumed runs only update the web tiles of chips postprocessed in this run
+        changed = None
+        if completed_chips:
+            changed = [rasterio.transform.array_bounds(pair.profile['height'], pair.profile['width'], pair.transform)
+                       for pair in postprocessed]
+        create_web_tiles(output_directory, changed)
+
+    return writer.polygons
+
+
+def create_staged_mosaics(pre_files, post_files, reproj_res, reproj_params, output_directory, manifest, report,
+                          footprints=None, clip=None):
+
+    """
+    Re-project each input file to the staging cache and then mosaic them
+    :param pre_files: pre-disaster files
+    :param post_files: post-disaster files
+    :param reproj_res: tuple -- output resolution
+    :param reproj_params: dict of re-projection parameters recorded in the manifest
+    :param output_directory: directory for output files
+    :param manifest: RunManifest
+    :param report: FailureReport to record inputs that could not be re-projected
+    :param footprints: dict of file to bounds in the destination crs, used with clip
+    :param clip: bounds to limit each re-projected file to
+    :return: tuple of paths to pre and post mosaics
+    """
+
+    reproj = manifest.get('reproject', pre_files + post_files, reproj_params)
+    if reproj is None:
+        n_failures = len(report)
+        pre_reproj, post_reproj = reproject_files(pre_files, post_files, reproj_res, report,
+                                                  footprints=footprints, clip=clip)
+        # Only record complete re-projections so failed inputs are retried on restart
+        if len(report) == n_failures:
+            manifest.record('reproject', pre_files + post_files, reproj_params, {'pre': pre_reproj, 'post': post_reproj})
+            manifest.save()
+    else:
+        pre_reproj, post_reproj = reproj['pre'], reproj['post']
+    assert pre_reproj and post_reproj, logger.critical('No pre or post files could be re-projected')
+
+    logger.info("Creating pre mosaic...")
+    pre_mosaic, = run_stage(manifest, 'mosaic_pre', pre_reproj, {'mosaic_format': args.mosaic_format},
+                            lambda: [finish_mosaic(raster_processing.create_mosaic(pre_reproj, Path(f"{output_directory}/mosaics/pre.tif")))])
+    logger.info("Creating post mosaic...")
+    post_mosaic, = run_stage(manifest, 'mosaic_post', post_reproj, {'mosaic_format': args.mosaic_format},
+                             lambda: [finish_mosaic(raster_processing.create_mosaic(post_reproj, Path(f"{output_directory}/mosaics/post.tif")))])
+
+    return pre_mosaic, post_mosaic
+
+
+def create_warped_mosaic(pre_post, in_files, in_crs, reproj_res, reproj_params, output_directory, manifest, report, clip=None):
+
+    """
+    Re-project and mosaic input files in a single warp straight to the output mosaic
+    :param pre_post: pre or post
+    :param in_files: input files
+    :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+    :param reproj_res: tuple -- output resolution
+    :param reproj_params: dict of re-projection parameters recorded in the manifest
+    :param output_directory: directory for output files
+    :param manifest: RunManifest
+    :param report: FailureReport to record inputs that could not be used
+    :param clip: bounds to limit the mosaic to
+    :return: path to mosaic
+    """
+
+    stage = f'warp_{pre_post}'
+    params = dict(reproj_params, warp_memory=args.warp_memory, warp_threads=args.warp_threads, mosaic_format=args.mosaic_format)
+    outputs = manifest.get(stage, in_files, params)
+    if outputs is not None:
+        logger.info(f'Using {stage} from an earlier run')
+        return outputs['files'][0]
+
+    sources, errors = raster_processing.get_sources(in_files, in_crs)
+    report_input_errors(errors, report)
+    assert sources, logger.critical(f'No {pre_post} files could be re-projected')
+
+    mosaic = raster_processing.warp_mosaic(sources,
+                                           Path(f"{output_directory}/mosaics/{pre_post}.tif"),
+                                           in_crs,
+                                           args.destination_crs,
+                                           reproj_res,
+                                           warp_memory=args.warp_memory,
+                                           threads=args.warp_threads,
+                                           bounds=clip)
+    mosaic = finish_mosaic(mosaic)
+
+    # Only record complete mosaics so failed inputs are retried on restart
+    if not errors:
+        manifest.record(stage, in_files, params, {'files': [mosaic]})
+        manifest.save()
+
+    return mosaic
+
+
+def finish_mosaic(mosaic, resampling='average', compress=False):
+
+    """
+    Convert a tiled mosaic to the --mosaic_format
+    :param mosaic: path to mosaic
+    :param resampling: overview resampling. Use nearest for categorical rasters.
+    :param compress: compress an uncompressed mosaic from MosaicWriter when it is not converted to COG
+    :return: path to mosaic
+    """
+
+    if args.mosaic_format == 'cog':
+        logger.info(f'Converting {Path(mosaic).name} to COG')
+        raster_processing.convert_to_cog(mosaic, resampling, threads=args.warp_threads)
+    elif compress:
+        logger.info(f'Compressing {Path(mosaic).name}')
+        raster_processing.compress_mosaic(mosaic, threads=args.warp_threads)
+
+    return Path(mosaic)
+
+
+def run_stage(manifest, stage, inputs, params, func):
+
+    """
+    Run a pipeline stage unless it was completed in an earlier run
+    :param manifest: RunManifest
+    :param stage: stage name
+    :param inputs: list of input files
+    :param params: dict of parameters that affect the outputs
+    :param func: function to run the stage. Returns a list of output paths.
+    :return: list of output paths
+    """
+
+    outputs = manifest.get(stage, inputs, params)
+    if outputs is not None:
+        logger.info(f'Using {stage} from an earlier run')
+        return outputs['files']
+
+    files = func()
+    manifest.record(stage, inputs, params, {'files': files})
+    manifest.save()
+
+    return files
+
+
+def get_model_params():
+
+    """
+    Get arguments that change inference outputs, used to check if chips from an earlier run can be reused
+    :return: dict of arguments
+    """
+
+    return {k: getattr(args, k) for k in ('fast', 'soup', 'coarse_scan', 'coarse_threshold', 'coarse_margin')}
+
+
+def record_chip(manifest, pair, params):
+
+    """
+    Record a chip whose outputs are written in the manifest
+    :param manifest: RunManifest
+    :param pair: Files object for the chip
+    :param params: model parameters from get_model_params
+    """
+
+    # Outputs written only to the mosaics are checked through MosaicWriter.can_update instead
+    outputs = [f for f in (pair.opts.out_loc_path, pair.opts.out_cls_path) if f is not None]
+    manifest.record(f'chip_{pair.ident}', [pair.pre, pair.post], get_chip_params(params, pair.windows, pair.crop), {'files': outputs})
+
+
+def get_chip_params(params, windows, crop=None):
+
+    """
+    Get manifest parameters of a chip. Windowed chips share their mosaic inputs so the window is part of the params.
+    :param params: model parameters from get_model_params
+    :param windows: pre and post windows or None
+    :param crop: crop of the chip that outputs are written for or None
+    :return: dict of parameters
+    """
+
+    if crop is not None:
+        params = {**params, 'crop': crop}
+
+    if windows is None:
+        return params
 
-    logger.info("Creating overlay mosaic")
-    p = Path(args.output_directory) / "over"
-    overlay_files = get_files(p)
-    overlay_files = [x for x in overlay_files]
-    overlay_mosaic = raster_processing.create_mosaic(overlay_files, Path(f"{args.output_directory}/mosaics/overlay.tif"))
+    return {**params, 'windows': windows}
 
-    # Get files for creating shapefile and/or pushing to AGOL
-    dmg_files = get_files(Path(args.output_directory) / 'dmg')
-    polygons = features.create_polys(dmg_files)
-    logger.debug(f'Polygons created: {len(polygons)}')
 
-    # Create shapefile
+def get_output_profile(pre_mosaic, extent, count=1):
+
+    """
+    Get the profile of an output mosaic covering the extent on the pre mosaic pixel grid
+    :param pre_mosaic: pre mosaic
+    :param extent: bounds of the chips
+    :param count: number of bands
+    :return: profile
+    """
+
+    with rasterio.open(pre_mosaic) as src:
+        # Same window as the chip layout in raster_processing.get_chip_windows
+        row_off, col_off = rasterio.transform.rowcol(src.transform, extent[0], extent[3])
+        row_end, col_end = rasterio.transform.rowcol(src.transform, extent[2], extent[1])
+        window = rasterio.windows.Window(col_off, row_off, col_end - col_off, row_end - row_off)
+        profile = src.profile
+        profile.update(transform=src.window_transform(window),
+                       width=int(window.width),
+                       height=int(window.height),
+                       count=count,
+                       dtype=rasterio.uint8,
+                       nodata=None)
+
+    return profile
+
+
+def plan_chips(pre_mosaic, post_mosaic, extent, coverage, anchor=(0, 0), shift_edges=False):
+
+    """
+    Plan chip windows of both mosaics without writing chips
+    :param pre_mosaic: pre mosaic
+    :param post_mosaic: post mosaic
+    :param extent: bounds of chips to create
+    :param coverage: shapely geometry of valid data in both mosaics
+    :param anchor: chip grid anchor. See raster_processing.get_chip_windows.
+    :param shift_edges: shift edge chips inside the extent. See raster_processing.get_chip_windows.
+    :return: list of ChipRecord paired by grid index
+    """
+
+    def to_tuple(window):
+        return (int(window.col_off), int(window.row_off), int(window.width), int(window.height))
+
+    pre_windows = raster_processing.get_chip_windows(pre_mosaic, extent, coverage=coverage, anchor=anchor, shift_edges=shift_edges)
+    post_windows = {idx: window for idx, window, _, _ in raster_processing.get_chip_windows(post_mosaic, extent, coverage=coverage,
+                                                                                            anchor=anchor, shift_edges=shift_edges)}
+
+    with rasterio.open(pre_mosaic) as src:
+        base_profile = src.profile
+
+    chips = []
+    for idx, window, transform, crop in pre_windows:
+        if idx not in post_windows:
+            continue
+
+        # Chips are padded to full size like written chips
+        profile = base_profile.copy()
+        profile.update(transform=transform, width=1024, height=1024)
+        chips.append(raster_processing.ChipRecord(f'{idx}_pre', pre_mosaic, post_mosaic,
+                                                  (to_tuple(window), to_tuple(post_windows[idx])), profile, None, crop))
+
+    return chips
+
+
+def get_resolution(pre_files, post_files):
+
+    """
+    Get the re-projection resolution from args or calculate it from the inputs
+    :param pre_files: pre-disaster files
+    :param post_files: post-disaster files
+    :return: tuple -- output resolution
+    """
+
+    if not args.output_resolution:
+        if catalog is not None:
+            return catalog.get_reproj_res(pre_files, post_files, args)
+        return raster_processing.get_reproj_res(pre_files, post_files, args)
+
+    # Create tuple from passed resolution
+    return (args.output_resolution, args.output_resolution)
+
+
+def plan_work(queue):
+
+    """
+    Split the imagery intersect into super-tiles and register them as work items
+    :param queue: WorkQueue
+    :return: True if the queue was created by this call
+    """
+
+    pre_files = list_inputs(args.pre_directory)
+    post_files = list_inputs(args.post_directory)
+
+    pre_footprints = get_input_footprints(pre_files, args.pre_crs)
+    post_footprints = get_input_footprints(post_files, args.post_crs)
+    # Resolution and pixel grid are fixed for the whole run so super-tile outputs line up when stitched
+    reproj_res = get_resolution(pre_files, post_files)
+    intersect = raster_processing.snap_bounds(raster_processing.get_footprint_intersect(pre_footprints, post_footprints), reproj_res)
+    size = (args.super_tile_size * reproj_res[0], args.super_tile_size * reproj_res[1])
+    tiles = raster_processing.get_super_tiles(intersect, *size)
+    # Items are claimed in id order so super-tiles covering the areas of interest are processed first
+    order = priority.get_order(tiles, args.destination_crs, priority_file=args.priority_file, priority_raster=args.priority_raster)
+    tiles = [tiles[i] for i in order]
+    logger.info(f'Planned {len(tiles)} super-tiles of {args.super_tile_size} pixels over {intersect}')
+
+    items = [{'id': f'{idx:06d}', 'bounds': bounds} for idx, bounds in enumerate(tiles)]
+    meta = {'resolution': [float(r) for r in reproj_res], 'intersect': intersect, 'destination_crs': args.destination_crs}
+
+    # A plan left unfinished by a crashed planner is taken over after the queue timeout
+    return queue.create(items, meta, stale=args.queue_timeout)
+
+
+def work(queue, report, push=None):
+
+    """
+    Claim super-tiles from the queue and run the pipeline on each until none are left
+    :param queue: WorkQueue
+    :param report: FailureReport to record failures in this worker's super-tiles
+    :param push: optional function called with each committed batch of polygons (ie. an AGOL append)
+    :return: number of items processed by this worker
+    """
+
+    meta = queue.wait_for_plan(stale=args.queue_timeout)
+    reproj_res = tuple(meta['resolution'])
+
+    pre_footprints = get_input_footprints(list_inputs(args.pre_directory), args.pre_crs)
+    post_footprints = get_input_footprints(list_inputs(args.post_directory), args.post_crs)
+
+    count = 0
+    while True:
+        queue.requeue_stale(args.queue_timeout)
+        item = queue.claim()
+        if item is None:
+            break
+
+        logger.info(f'Processing super-tile {item["id"]}: {item["bounds"]}')
+        pre_files = [f for f, b in pre_footprints if raster_processing.bounds_intersect(b, item['bounds'])]
+        post_files = [f for f, b in post_footprints if raster_processing.bounds_intersect(b, item['bounds'])]
+
+        if not pre_files or not post_files:
+            queue.complete(item['id'], {'polygons': 0})
+            continue
+
+        # Items requeued after missed heartbeats are finished by the worker that claimed them again, so results of a
+        # lost claim are not reported
+
+        tile_report = FailureReport()
+        try:
+            with queue.keep_alive(item['id'], args.queue_timeout / 4):
+                polygons = run_pipeline(pre_files,
+                                        post_files,
+                                        args.staging_directory.joinpath('tiles').joinpath(item['id']),
+                                        args.output_directory.joinpath('tiles').joinpath(item['id']),
+                                        reproj_res=reproj_res,
+                                        bounds=item['bounds'],
+                                        report=tile_report,
+                                        push=push)
+        except Exception as ex:
+            logger.exception(f'Super-tile {item["id"]} failed')
+            if queue.fail(item['id'], ex):
+                report.add('super-tile', item['id'], ex)
+        else:
+            if queue.complete(item['id'], {'polygons': len(polygons), 'failures': tile_report.failures}):
+                report.extend(tile_report.failures)
+                count += 1
+
+    return count
+
+
+def reduce_work(queue):
+
+    """
+    Stitch super-tile outputs into the final overlay mosaic and shapefile once all items are finished. Only one
+    reducer runs per queue.
+    :param queue: WorkQueue
+    :return: tuple of list of polygons and damage values and FailureReport for all super-tiles, or None if another
+    process is reducing
+    """
+
+    meta = queue.wait_for_plan(stale=args.queue_timeout)
+    while not queue.is_finished():
+        queue.requeue_stale(args.queue_timeout)
+        time.sleep(10)
+
+    if not queue.lock('reduce'):
+        logger.info('Another process is reducing this queue')
+        return None
+
+    report = FailureReport()
+    for item in queue.items('failed'):
+        report.add('super-tile', item['id'], item['error'])
+
+    done = queue.items('done')
+    for item in done:
+        report.extend(item.get('failures', []))
+
+    make_output_structure(args.output_directory)
+    tile_dirs = [args.output_directory.joinpath('tiles').joinpath(item['id']) for item in done]
+
+    create_output_mosaics(args.output_directory, tile_dirs=tile_dirs, materialize_vrt=args.materialize)
+    if args.web_tiles:
+        create_web_tiles(args.output_directory)
+
+    polygons = []
+    for d in tile_dirs:
+        shp = d.joinpath('shapes').joinpath('damage.shp')
+        if shp.is_file():
+            polygons += to_shapefile.read_shapefile(shp)
+
+    # Buildings on super-tile borders are split between tiles
+    n_polygons = len(polygons)
+    polygons = features.merge_border_polygons(polygons, [item['bounds'] for item in done], min(meta['resolution']) / 4)
+    logger.debug(f'Polygons merged: {len(polygons)} from {n_polygons}')
+
     logger.info('Creating shapefile')
     to_shapefile.create_shapefile(polygons,
                      Path(args.output_directory).joinpath('shapes') / 'damage.shp',
                      args.destination_crs)
 
-    if agol_push:
+    return polygons, report
+
+
+@logger.catch()
+def main():
+
+    global catalog
+
+    t0 = timeit.default_timer()
+
+    # Footprints, CRS and resolution of unchanged inputs are read from the catalog instead of reopening every file
+    catalog = InputCatalog(args.catalog_file, workers=args.n_procs) if args.catalog_file else None
+
+    # Determine if items are being pushed to AGOL
+    agol_push = to_agol.agol_arg_check(args.agol_user, args.agol_password, args.agol_feature_service)
+
+    # Push each committed batch of polygons as chips finish instead of everything at the end
+    push = partial(to_agol.agol_helper, args) if agol_push and args.agol_incremental else None
+
+    report = FailureReport()
+    if args.distributed:
+        queue = WorkQueue(args.queue_directory)
+        polygons = None
+        # Workers record failures with each super-tile in the queue. Only the reducer writes the run report.
+        write_report = False
+
+        if args.distributed in ('plan', 'all'):
+            plan_work(queue)
+        if args.distributed in ('work', 'all'):
+            logger.success(f'Worker processed {work(queue, report, push)} super-tiles')
+        if args.distributed in ('reduce', 'all'):
+            reduced = reduce_work(queue)
+            if reduced is not None:
+                polygons, report = reduced
+                write_report = True
+
+    else:
+        make_staging_structure(args.staging_directory)
+        make_output_structure(args.output_directory)
+
+        logger.info('Retrieving files...')
+        pre_files = list_inputs(args.pre_directory)
+        logger.debug(f'Retrieved {len(pre_files)} pre files from {args.pre_directory}')
+        post_files = list_inputs(args.post_directory)
+        logger.debug(f'Retrieved {len(post_files)} pre files from {args.post_directory}')
+
+        polygons = run_pipeline(pre_files, post_files, args.staging_directory, args.output_directory, report=report, push=push)
+        write_report = True
+
+    if agol_push and push is None and polygons is not None:
         to_agol.agol_helper(args, polygons)
 
+    for job in materialize_jobs:
+        job.join()
+        if job.exitcode != 0:
+            report.add('materialize', job.name, f'Exited with code {job.exitcode}')
+
+    if write_report:
+        report.write(args.output_directory.joinpath('failures.json'))
+
     # Complete
     elapsed = timeit.default_timer() - t0
+    if len(report):
+        logger.warning(f'Run completed with {len(report)} failures in {elapsed / 60:.3f} min. Results are partial.')
+        return 2
+
     logger.success(f'Run complete in {elapsed / 60:.3f} min')
+    return 0
 
 
 def init():
@@ -599,9 +1744,11 @@ def init():
         from multiprocessing import freeze_support
         freeze_support()
 
-    main()
+    return main()
 
 
 if __name__ == '__main__':
 
-    init()
+    # 0 on success, 2 when the run finished with partial results and 1 when it failed
+    status = init()
+    exit(1 if status is None else status)
@@ -5,18 +5,35 @@ from torch.autograd import Variable
 
 from os import path, makedirs, listdir
 from zoo.models import *
+from utils.profiling import annotate
 
 import numpy as np
 np.random.seed(1)
 import random
 random.seed(1)
 
+
+class ModelMethod(nn.Module):
+    """
+    Exposes one method of a model as forward so it can be wrapped in DataParallel
+    """
+    def __init__(self, model, method):
+        super(ModelMethod, self).__init__()
+        self.model = model
+        self.method = method
+
+    def forward(self, x):
+        return getattr(self.model, self.method)(x)
+
+
 class XViewFirstPlaceLocModel(nn.Module):
     def __init__(self, model_size, models_folder='weights', devices=[0,0,0],
-                 load_models=True, dp_mode=False):
+                 load_models=True, dp_mode=False, cache=None, soup=False):
         super(XViewFirstPlaceLocModel, self).__init__()
         self.models = []
         self.dp_mode = dp_mode
+        self.cache = cache
+        self.soup = soup
         self.model_size = model_size
         self.models_folder = models_folder
         self.devices = devices
@@ -34,13 +51,15 @@ class XViewFirstPlaceLocModel(nn.Module):
             '154':'se154_loc_{}_1_best',
 
         }
+        # A soup (see soup.py) replaces the three seeds with a single weight-averaged member
+        self.seeds = ['soup'] if soup else [0, 1, 2]
         self.pred_folder = f'pred{model_size}_loc'
         # Allows subclassing without loading models twice
         if load_models:
             self.load_models()
 
     def load_models(self):
-        for ii, seed in enumerate([0, 1, 2]):
+        for ii, seed in enumerate(self.seeds):
             snap_to_load = self.checkpoint_dict[self.model_size].replace('{}',str(seed))
             model = self.model_dict[self.model_size]()
             print("=> loading checkpoint '{}'".format(snap_to_load))
@@ -67,14 +86,29 @@ class XViewFirstPlaceLocModel(nn.Module):
             self.models.append(model)
 
 
-    def execute_model(self, x, model):
+    def execute_model(self, x, model, member=None, keys=None):
         model_device = next(model.parameters()).device # Hack to get device
-        inp = Variable(x).to(model_device)
+        with annotate('h2d_copy'):
+            inp = Variable(x).to(model_device)
         msk = model(inp)
         return msk
 
 
-    def forward(self,x, debug=False):
+    def forward(self, x, debug=False, keys=None):
+        # Localization only looks at the pre image so whole outputs can be reused from the cache
+        kind = f'loc{self.model_size}_soup' if self.soup else f'loc{self.model_size}'
+        if self.cache is not None and keys is not None and self.cache.has(kind, keys):
+            return self.cache.load(kind, keys)
+
+        msk_out = self.ensemble(x, debug=debug, keys=keys)
+
+        if self.cache is not None and keys is not None:
+            self.cache.save(kind, keys, msk_out)
+
+        return msk_out
+
+
+    def ensemble(self, x, debug=False, keys=None):
         if debug:
             import ipdb; ipdb.set_trace()
         msk_out = []
@@ -82,19 +116,19 @@ class XViewFirstPlaceLocModel(nn.Module):
         # Because this model actually executes something along the batch dimension, compress
         # the batch dimension, then uncompress at the end
         x = x.reshape([-1]+list(x.shape[-3:]))
-        msk0 = self.execute_model(x, self.models[0]).cpu()
-        msk1 = self.execute_model(x, self.models[1]).cpu()
-        msk2 = self.execute_model(x, self.models[2]).cpu()
+        msks = []
+        for ii, model in enumerate(self.models):
+            msk = self.execute_model(x, model, ii, keys)
+            with annotate('d2h_copy'):
+                msks.append(msk.cpu())
 
         # Separating back into correct batch size for first dim
-        new_shape = [x_shape[0],-1] + list(msk0.shape[1:])
-        msk0 = msk0.reshape(new_shape)
-        msk1 = msk1.reshape(new_shape)
-        msk2 = msk2.reshape(new_shape)
+        new_shape = [x_shape[0],-1] + list(msks[0].shape[1:])
+        msks = [msk.reshape(new_shape) for msk in msks]
 
-        for i in range(msk0.shape[0]):
+        for i in range(x_shape[0]):
             pred = []
-            for msk in [msk0, msk1, msk2]:
+            for msk in msks:
                 tmp = torch.sigmoid(msk[i]).numpy()
                 # This is test-time augmentation, flipping on different axes
                 pred.append(tmp[0, ...])
@@ -111,12 +145,14 @@ class XViewFirstPlaceLocModel(nn.Module):
 
 class XViewFirstPlaceClsModel(XViewFirstPlaceLocModel):
     def __init__(self, model_size, models_folder='weights',
-                 devices=[0,0,0], dp_mode=False):
+                 devices=[0,0,0], dp_mode=False, cache=None, soup=False, load_models=True):
         super(XViewFirstPlaceClsModel, self).__init__(model_size,
                                                       models_folder=models_folder,
                                                       devices=devices,
                                                       load_models=False,
-                                                      dp_mode=dp_mode)
+                                                      dp_mode=dp_mode,
+                                                      cache=cache,
+                                                      soup=soup)
         self.models = []
         self.model_dict = {
             '34':Res34_Unet_Double,
@@ -134,6 +170,73 @@ class XViewFirstPlaceClsModel(XViewFirstPlaceLocModel):
         }
 
         self.pred_folder = f'pred{model_size}_cls'
-        self.load_models()
+        # DataParallel wrappers of the Siamese branches per ensemble member, used with the pre-image cache
+        self.branches = {}
+        if load_models:
+            self.load_models()
+
+
+    def get_branches(self, model, member):
+        if not isinstance(model, nn.DataParallel):
+            return model.forward1, model.res
 
+        # forward1 and res are not exposed through the DataParallel wrapper so each is wrapped on its own
+        if member not in self.branches:
+            self.branches[member] = (nn.DataParallel(ModelMethod(model.module, 'forward1')),
+                                     nn.DataParallel(ModelMethod(model.module, 'res')))
 
+        return self.branches[member]
+
+
+    def execute_model(self, x, model, member=None, keys=None):
+        if self.cache is None or keys is None:
+            return super(XViewFirstPlaceClsModel, self).execute_model(x, model)
+
+        # Run the Siamese halves separately so the pre branch (dec10_0) can be reused between post-event runs
+        forward1, res = self.get_branches(model, member)
+        model_device = next(model.parameters()).device
+        kind = f'cls{self.model_size}_{self.seeds[member]}'
+
+        if self.cache.has(kind, keys):
+            with annotate('h2d_copy'):
+                dec10_0 = self.cache.load(kind, keys).to(model_device).float()
+            dec10_0 = dec10_0.reshape([-1] + list(dec10_0.shape[-3:]))
+        else:
+            with annotate('h2d_copy'):
+                pre = Variable(x[:, :3, ...]).to(model_device)
+            dec10_0 = forward1(pre)
+            # Batch dimension holds the test-time augmentations of every chip so split it back out per key
+            self.cache.save(kind, keys, dec10_0.reshape([len(keys), -1] + list(dec10_0.shape[1:])))
+
+        with annotate('h2d_copy'):
+            post = Variable(x[:, 3:, ...]).to(model_device)
+        dec10_1 = forward1(post)
+
+        return res(torch.cat([dec10_0, dec10_1], 1))
+
+
+    def forward(self, x, debug=False, keys=None):
+        # Damage outputs depend on the post image and are never cached as a whole
+        return self.ensemble(x, debug=debug, keys=keys)
+
+
+class XViewStudentModel(XViewFirstPlaceLocModel):
+    """
+    Single joint localization and damage model distilled from the full ensemble (see distill.py). Outputs
+    have 6 channels: localization followed by the 5 damage channels.
+    """
+    def __init__(self, seed=0, models_folder='weights', devices=[0], dp_mode=False):
+        super(XViewStudentModel, self).__init__('34',
+                                                models_folder=models_folder,
+                                                devices=devices,
+                                                load_models=False,
+                                                dp_mode=dp_mode)
+        self.model_dict = {
+            '34':Res34_Unet_Student,
+        }
+        self.checkpoint_dict = {
+            '34':'student_res34_{}_best',
+        }
+        self.seeds = [seed]
+        self.pred_folder = 'pred_fast'
+        self.load_models()
@@ -0,0 +1,287 @@
+import os
+os.environ["MKL_NUM_THREADS"] = "2"
+os.environ["NUMEXPR_NUM_THREADS"] = "2"
+os.environ["OMP_NUM_THREADS"] = "2"
+
+from os import path, listdir
+import argparse
+import copy
+import json
+import numpy as np
+np.random.seed(1)
+import random
+random.seed(1)
+
+import torch
+from torch import nn
+from torch.backends import cudnn
+from torch.utils.data import Dataset
+from torch.utils.data import DataLoader
+
+from tqdm import tqdm
+import timeit
+import cv2
+
+from models import XViewFirstPlaceLocModel, XViewFirstPlaceClsModel
+
+from utils.utils import preprocess_inputs, dice
+
+from sklearn.model_selection import train_test_split
+
+cv2.setNumThreads(0)
+cv2.ocl.setUseOpenCL(False)
+
+train_dirs = ['train', 'tier3']
+
+models_folder = 'weights'
+
+
+all_files = []
+for d in train_dirs:
+    if not path.isdir(path.join(d, 'images')):
+        continue
+    for f in sorted(listdir(path.join(d, 'images'))):
+        if '_pre_disaster.png' in f:
+            all_files.append(path.join(d, 'images', f))
+train_len = len(all_files)
+
+
+class SoupData(Dataset):
+    "Full size training pairs with ground truth masks"
+
+    def __init__(self, image_idxs, task):
+        super().__init__()
+        self.image_idxs = image_idxs
+        self.task = task
+
+    def __len__(self):
+        return len(self.image_idxs)
+
+    def __getitem__(self, idx):
+        fn = all_files[self.image_idxs[idx]]
+
+        img = cv2.imread(fn, cv2.IMREAD_COLOR)
+        if self.task == 'cls':
+            img2 = cv2.imread(fn.replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_COLOR)
+            img = np.concatenate([img, img2], axis=2)
+
+        msk0 = cv2.imread(fn.replace('/images/', '/masks/'), cv2.IMREAD_UNCHANGED)
+        lbl_msk = cv2.imread(fn.replace('/images/', '/masks/').replace('_pre_disaster', '_post_disaster'), cv2.IMREAD_UNCHANGED)
+
+        img = preprocess_inputs(img)
+        img = torch.from_numpy(img.transpose((2, 0, 1))).float()
+
+        return {'img': img, 'msk': (msk0 > 127) * 1, 'lbl_msk': lbl_msk, 'fn': fn}
+
+
+def get_wrapper(size, task):
+
+    """
+    Get an unloaded ensemble wrapper to reuse its model classes and checkpoint names.
+    """
+
+    if task == 'loc':
+        return XViewFirstPlaceLocModel(size, load_models=False)
+    return XViewFirstPlaceClsModel(size, load_models=False)
+
+
+def load_ingredients(size, task):
+
+    """
+    Load the state dicts of the three seed checkpoints.
+    :return: List of (checkpoint name, state dict)
+    """
+
+    wrapper = get_wrapper(size, task)
+    ingredients = []
+    for seed in [0, 1, 2]:
+        snap_to_load = wrapper.checkpoint_dict[size].replace('{}', str(seed))
+        print("=> loading checkpoint '{}'".format(snap_to_load))
+        checkpoint = torch.load(path.join(models_folder, snap_to_load), map_location='cpu')
+        loaded_dict = {key.replace("module.", ""): value for key, value in checkpoint['state_dict'].items()}
+        ingredients.append((snap_to_load, loaded_dict))
+    return ingredients
+
+
+def average_state_dicts(state_dicts):
+
+    """
+    Uniformly average state dicts. Integer buffers (BatchNorm num_batches_tracked) are taken from the first.
+    """
+
+    avg = {}
+    for k, v in state_dicts[0].items():
+        if v.is_floating_point():
+            avg[k] = torch.stack([sd[k].float() for sd in state_dicts]).mean(dim=0).to(v.dtype)
+        else:
+            avg[k] = v.clone()
+    return avg
+
+
+def build_model(size, task, state_dict):
+    model = get_wrapper(size, task).model_dict[size](pretrained=None)
+    sd = model.state_dict()
+    for k in sd:
+        if k in state_dict and sd[k].size() == state_dict[k].size():
+            sd[k] = state_dict[k]
+    model.load_state_dict(sd)
+    return model.cuda().eval()
+
+
+def reestimate_bn(model, data_loader):
+
+    """
+    Recompute BatchNorm running statistics with a cumulative average over the data. Averaged weights no longer
+    match the running statistics of any single ingredient.
+    """
+
+    bns = [m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    if not bns:
+        return model
+
+    for m in bns:
+        m.reset_running_stats()
+        m.momentum = None
+
+    model.train()
+    with torch.no_grad():
+        for sample in tqdm(data_loader):
+            model(sample['img'].cuda(non_blocking=True))
+    model.eval()
+
+    return model
+
+
+def validate(models, data_loader, task):
+
+    """
+    Score the averaged sigmoid output of models. Localization is scored with dice. Damage is scored with the
+    harmonic mean of the per class F1 over ground truth building pixels, so localization errors do not mix in.
+    """
+
+    dices = []
+    tp = np.zeros((4,))
+    fp = np.zeros((4,))
+    fn = np.zeros((4,))
+
+    with torch.no_grad():
+        for sample in tqdm(data_loader):
+            imgs = sample['img'].cuda(non_blocking=True)
+            out = torch.stack([torch.sigmoid(model(imgs)) for model in models]).mean(dim=0).cpu().numpy()
+            msks = sample['msk'].numpy()
+            lbl_msks = sample['lbl_msk'].numpy()
+
+            for j in range(out.shape[0]):
+                if task == 'loc':
+                    dices.append(dice(msks[j], out[j, 0] > 0.5))
+                    continue
+                targ = lbl_msks[j][msks[j] > 0] - 1
+                pred = out[j, 1:].argmax(axis=0)[msks[j] > 0]
+                for c in range(4):
+                    tp[c] += np.logical_and(pred == c, targ == c).sum()
+                    fn[c] += np.logical_and(pred != c, targ == c).sum()
+                    fp[c] += np.logical_and(pred == c, targ != c).sum()
+
+    if task == 'loc':
+        return float(np.mean(dices))
+
+    f1_sc = 2 * tp / (2 * tp + fp + fn + 1e-6)
+    return float(4 / np.sum(1.0 / (f1_sc + 1e-6)))
+
+
+def make_soup(size, task, method, bn_loader, val_loader):
+
+    """
+    Build a uniform or greedy soup from the seed checkpoints of one architecture.
+    :return: Tuple of (soup state dict, ingredient names, report)
+    """
+
+    ingredients = load_ingredients(size, task)
+
+    individual = []
+    for name, sd in ingredients:
+        individual.append(validate([build_model(size, task, sd)], val_loader, task))
+        print(f'{name}: {individual[-1]}')
+
+    ensemble = validate([build_model(size, task, sd) for _, sd in ingredients], val_loader, task)
+    print(f'3 model average: {ensemble}')
+
+    def evaluate_soup(sds):
+        model = reestimate_bn(build_model(size, task, average_state_dicts(sds)), bn_loader)
+        return model, validate([model], val_loader, task)
+
+    if method == 'uniform':
+        selected = list(range(len(ingredients)))
+        model, soup_score = evaluate_soup([sd for _, sd in ingredients])
+    else:
+        # Greedy soup: add ingredients in order of their own score and keep them only if the soup improves
+        order = list(np.argsort(individual)[::-1])
+        selected = [order[0]]
+        model = reestimate_bn(build_model(size, task, ingredients[order[0]][1]), bn_loader)
+        soup_score = validate([model], val_loader, task)
+        for idx in order[1:]:
+            candidate, candidate_score = evaluate_soup([ingredients[i][1] for i in selected + [idx]])
+            print(f'Adding {ingredients[idx][0]}: {candidate_score} (current {soup_score})')
+            if candidate_score >= soup_score:
+                selected.append(idx)
+                model, soup_score = candidate, candidate_score
+
+    report = {
+        'size': size,
+        'task': task,
+        'method': method,
+        'ingredients': [ingredients[i][0] for i in selected],
+        'individual_scores': {name: sc for (name, _), sc in zip(ingredients, individual)},
+        'ensemble_score': ensemble,
+        'soup_score': soup_score,
+    }
+
+    return copy.deepcopy(model.state_dict()), report['ingredients'], report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build weight-averaged soups from the seed checkpoints of one architecture.')
+    parser.add_argument('--size', choices=['34', '50', '92', '154'], required=True, help='Model architecture')
+    parser.add_argument('--task', choices=['loc', 'cls'], required=True, help='Localization or classification checkpoints')
+    parser.add_argument('--method', choices=['uniform', 'greedy'], default='greedy', help='Uniform average of all seeds, or greedily add seeds that improve the validation score')
+    parser.add_argument('--bn_samples', default=200, type=int, help='Number of training chips to re-estimate BatchNorm statistics on')
+    parser.add_argument('--val_seed', default=0, type=int, help='Seed of the train/validation split to score on')
+    parser.add_argument('--batch_size', default=2, type=int, help='Batch size for BatchNorm re-estimation and validation')
+    parser.add_argument('--report', default=None, help='Path for the JSON report. Defaults to the soup checkpoint name with .json')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    t0 = timeit.default_timer()
+
+    args = parse_args()
+
+    cudnn.benchmark = True
+
+    train_idxs, val_idxs = train_test_split(np.arange(train_len), test_size=0.1, random_state=args.val_seed)
+    bn_idxs = np.random.choice(train_idxs, min(args.bn_samples, len(train_idxs)), replace=False)
+
+    bn_loader = DataLoader(SoupData(bn_idxs, args.task), batch_size=args.batch_size, num_workers=6, shuffle=True, pin_memory=False)
+    val_loader = DataLoader(SoupData(val_idxs, args.task), batch_size=args.batch_size, num_workers=6, shuffle=False, pin_memory=False)
+
+    state_dict, ingredients, report = make_soup(args.size, args.task, args.method, bn_loader, val_loader)
+
+    # Saved under the seed checkpoint name with 'soup' as the seed so the ensemble wrappers can load it with soup=True
+    snapshot_name = get_wrapper(args.size, args.task).checkpoint_dict[args.size].replace('{}', 'soup')
+    torch.save({
+        'epoch': 0,
+        'state_dict': state_dict,
+        'best_score': report['soup_score'],
+        'ingredients': ingredients,
+    }, path.join(models_folder, snapshot_name))
+
+    report_file = args.report if args.report else path.join(models_folder, snapshot_name + '.json')
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for k, v in report.items():
+        print(f'{k}: {v}')
+
+    elapsed = timeit.default_timer() - t0
+    print('Time: {:.3f} min'.format(elapsed / 60))
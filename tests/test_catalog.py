@@ -0,0 +1,65 @@
+import os
+import shutil
+import pytest
+import handler
+from utils import raster_processing
+from utils.catalog import InputCatalog
+
+
+class Args():
+
+    def __init__(self, pre_crs=None, post_crs=None, dst_crs=None):
+        self.pre_crs = pre_crs
+        self.post_crs = post_crs
+        self.destination_crs = dst_crs
+
+
+class TestInputCatalog:
+
+    def test_footprints_match(self, tmp_path):
+        files = handler.get_files('tests/data/input/pre')
+        catalog = InputCatalog(tmp_path / 'catalog.sqlite')
+        test = dict(catalog.get_footprints(files, None, 'EPSG:4326'))
+        expected = dict(raster_processing.get_footprints(files, None, 'EPSG:4326'))
+        assert test.keys() == expected.keys()
+        for f, bounds in expected.items():
+            assert test[f] == pytest.approx(bounds)
+
+    def test_reproj_res_match(self, tmp_path):
+        pre = ['tests/data/input/pre/tile_337-9136.tif']
+        post = ['tests/data/misc/no_crs/may24C350000e4102500n.jpg']
+        args = Args(post_crs='EPSG:26915', dst_crs='EPSG:4326')
+        test = InputCatalog(tmp_path / 'catalog.sqlite').get_reproj_res(pre, post, args)
+        assert test == pytest.approx(raster_processing.get_reproj_res(pre, post, args))
+
+    def test_cached_until_changed(self, tmp_path):
+        f = tmp_path / 'pre.tif'
+        shutil.copy2('tests/data/input/pre/tile_337-9136.tif', f)
+        catalog = InputCatalog(tmp_path / 'catalog.sqlite')
+        first = catalog.get([f])[f]
+
+        # A new catalog on the same file reads the stored record
+        assert InputCatalog(tmp_path / 'catalog.sqlite').get([f])[f] == first
+
+        os.utime(f, ns=(0, 0))
+        assert catalog.get([f])[f].mtime == 0
+
+    def test_unreadable(self, tmp_path):
+        f = tmp_path / 'bad.tif'
+        f.write_bytes(b'not a raster')
+        catalog = InputCatalog(tmp_path / 'catalog.sqlite')
+        assert catalog.get([f])[f].error is not None
+        assert catalog.get_footprints([f], None, 'EPSG:4326') == []
+
+    def test_list_files(self, tmp_path):
+        catalog = InputCatalog(tmp_path / 'catalog.sqlite')
+        expected = sorted(handler.get_files('tests/data/input/pre'))
+        assert catalog.list_files('tests/data/input/pre') == expected
+        # Second listing comes from the cache
+        assert catalog.list_files('tests/data/input/pre') == expected
+
+        new = tmp_path / 'input'
+        shutil.copytree('tests/data/input/pre', new)
+        assert len(catalog.list_files(new)) == len(expected)
+        shutil.copy2(expected[0], new / 'extra.tif')
+        assert len(catalog.list_files(new)) == len(expected) + 1
@@ -0,0 +1,48 @@
+import pickle
+import numpy as np
+import rasterio
+from rasterio import windows
+from utils import raster_processing
+from utils.chip_reader import ChipReader
+
+
+def write_mosaic(out_file):
+    arr = np.random.RandomState(0).randint(0, 255, (3, 40, 50)).astype(np.uint8)
+    profile = {'driver': 'GTiff', 'width': 50, 'height': 40, 'count': 3, 'dtype': 'uint8', 'crs': 'EPSG:4326',
+               'transform': rasterio.transform.from_origin(0, 40, 1, 1)}
+    with rasterio.open(out_file, 'w', **profile) as dst:
+        dst.write(arr)
+    return out_file
+
+
+class TestChipReader:
+
+    def test_matches_written_chips(self, tmp_path):
+        mosaic = write_mosaic(tmp_path / 'pre.tif')
+        out_dir = tmp_path / 'pre'
+        out_dir.mkdir()
+        chips = raster_processing.create_chips(mosaic, out_dir, (0, 0, 50, 40), tile_width=16, tile_height=16)
+        plan = raster_processing.get_chip_windows(mosaic, (0, 0, 50, 40), tile_width=16, tile_height=16)
+        assert len(plan) == len(chips) == 12
+
+        reader = ChipReader()
+        for (idx, window, _, _), chip in zip(plan, chips):
+            assert chip.name == f'{idx}_pre.tif'
+            with rasterio.open(chip) as src:
+                expected = src.read()
+            window = (window.col_off, window.row_off, window.width, window.height)
+            assert np.array_equal(reader.read(mosaic, window, 16, 16), expected)
+        reader.close()
+
+    def test_bgr(self, tmp_path):
+        mosaic = write_mosaic(tmp_path / 'pre.tif')
+        reader = ChipReader()
+        rgb = reader.read_rgb(mosaic, (0, 0, 16, 16), 16, 16)
+        bgr = reader.read_bgr(mosaic, (0, 0, 16, 16), 16, 16)
+        assert rgb.shape == (16, 16, 3)
+        assert np.array_equal(bgr, rgb[..., ::-1])
+
+    def test_pickle_without_handles(self, tmp_path):
+        reader = ChipReader()
+        reader.read(write_mosaic(tmp_path / 'pre.tif'), (0, 0, 8, 8), 8, 8)
+        assert pickle.loads(pickle.dumps(reader)).datasets == {}
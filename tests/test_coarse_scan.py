@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import rasterio
+from pathlib import Path
+from rasterio.transform import from_origin
+from utils import coarse_scan
+
+
+def make_profile(col, row, size=1024):
+    return {'transform': from_origin(col, -row, 1, 1), 'width': size, 'height': size}
+
+
+class TestSelectChips:
+
+    def test_select(self):
+        # Coarse grid at 1/4 resolution covering 2 x 2 chips with signal in the upper left chip only
+        probs = np.zeros((512, 512), dtype=np.uint8)
+        probs[10, 10] = 255
+        coarse_transform = from_origin(0, 0, 4, 4)
+        profiles = [make_profile(0, 0), make_profile(1024, 0), make_profile(0, 1024), make_profile(1024, 1024)]
+        test = coarse_scan.select_chips(profiles, probs, coarse_transform, margin=0, factor=4)
+        assert test == [True, False, False, False]
+
+    def test_margin(self):
+        # Signal just across the chip boundary is only picked up with a margin
+        probs = np.zeros((512, 512), dtype=np.uint8)
+        probs[10, 260] = 255
+        coarse_transform = from_origin(0, 0, 4, 4)
+        profiles = [make_profile(0, 0)]
+        assert coarse_scan.select_chips(profiles, probs, coarse_transform, margin=0, factor=4) == [False]
+        assert coarse_scan.select_chips(profiles, probs, coarse_transform, margin=64, factor=4) == [True]
+
+    def test_threshold(self):
+        probs = np.full((512, 512), 10, dtype=np.uint8)
+        coarse_transform = from_origin(0, 0, 4, 4)
+        profiles = [make_profile(0, 0)]
+        assert coarse_scan.select_chips(profiles, probs, coarse_transform, threshold=0.1, factor=4) == [False]
+
+
+class TestCoarseGrid:
+
+    def test_grid(self):
+        in_file = Path('tests/data/output/chips/pre/0_pre.tif')
+        with rasterio.open(in_file) as src:
+            bounds = src.bounds
+            res = src.res
+        window, coarse_transform, shape = coarse_scan.get_coarse_grid(in_file, bounds, 4)
+        assert shape == (256, 256)
+        assert coarse_transform.a == pytest.approx(res[0] * 4)
+
+    def test_read_coarse_tile(self):
+        with rasterio.open(Path('tests/data/output/chips/pre/0_pre.tif')) as src:
+            test = coarse_scan.read_coarse_tile(src, rasterio.windows.Window(0, 0, 1024, 1024), 4, 256)
+        assert tuple(test.shape) == (4, 3, 256, 256)
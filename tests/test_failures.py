@@ -0,0 +1,21 @@
+import json
+from utils.failures import FailureReport
+
+
+class TestFailureReport:
+
+    def test_add_and_write(self, tmp_path):
+        report = FailureReport()
+        assert len(report) == 0
+        report.add('reproject', 'a.tif', ValueError('No CRS set'))
+        out = report.write(tmp_path / 'failures.json')
+        assert len(report) == 1
+        assert json.loads(out.read_text()) == [{'stage': 'reproject', 'item': 'a.tif', 'error': 'No CRS set'}]
+
+    def test_quarantine(self, tmp_path):
+        chip = tmp_path / '0_pre.tif'
+        chip.write_bytes(b'corrupt')
+        report = FailureReport()
+        report.quarantine('chip', '0_pre', [chip, tmp_path / 'missing.tif'], tmp_path / 'quarantine', 'bad chip')
+        assert (tmp_path / 'quarantine' / '0_pre.tif').is_file()
+        assert report.failures[0]['item'] == '0_pre'
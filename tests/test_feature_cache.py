@@ -0,0 +1,41 @@
+import numpy as np
+import torch
+from utils import feature_cache
+from utils.feature_cache import FeatureCache
+
+
+class TestGetKey:
+
+    def test_same_content(self):
+        arr = np.arange(48, dtype=np.uint8).reshape(4, 4, 3)
+        assert feature_cache.get_key(arr) == feature_cache.get_key(arr.copy())
+
+    def test_different_content(self):
+        arr = np.zeros((4, 4, 3), dtype=np.uint8)
+        other = arr.copy()
+        other[0, 0, 0] = 1
+        assert feature_cache.get_key(arr) != feature_cache.get_key(other)
+
+
+class TestFeatureCache:
+
+    def test_miss(self, tmp_path):
+        cache = FeatureCache(tmp_path)
+        assert not cache.has('loc34', ['a'])
+
+    def test_roundtrip_uint8(self, tmp_path):
+        cache = FeatureCache(tmp_path)
+        batch = torch.randint(0, 255, (2, 8, 8), dtype=torch.uint8)
+        cache.save('loc34', ['a', 'b'], batch)
+        assert cache.has('loc34', ['a', 'b'])
+        test = cache.load('loc34', ['a', 'b'])
+        assert test.dtype == torch.uint8
+        assert torch.equal(test, batch)
+
+    def test_features_fp16(self, tmp_path):
+        cache = FeatureCache(tmp_path)
+        batch = torch.rand((1, 4, 2, 8, 8))
+        cache.save('cls34_0', ['a'], batch)
+        test = cache.load('cls34_0', ['a'])
+        assert test.dtype == torch.float16
+        assert torch.allclose(test.float(), batch, atol=1e-3)
@@ -1,4 +1,7 @@
+import pytest
+import rasterio
 from pathlib import Path
+from shapely.geometry import box
 from utils import features
 
 class TestCreatePolys:
@@ -6,4 +9,28 @@ class TestCreatePolys:
     def test_damage_polys(self):
         file = Path('tests/data/output/dmg/0_pre.tif')
         polys = features.create_polys([file])
-        assert len(polys) == 264
\ No newline at end of file
+        assert len(polys) == 264
+
+    def test_polygonize(self):
+        file = Path('tests/data/output/dmg/0_pre.tif')
+        with rasterio.open(file) as src:
+            polys = features.polygonize(src.read(1), src.transform)
+        assert len(polys) == 264
+
+
+class TestMergeBorderPolygons:
+
+    def test_merge(self):
+        tiles = [(0, 0, 10, 10), (10, 0, 20, 10)]
+        polygons = [(box(8, 2, 10, 4), 2), (box(10, 2, 12, 4), 2), (box(10, 6, 12, 8), 3), (box(2, 2, 4, 4), 1)]
+        test = features.merge_border_polygons(polygons, tiles, 0.01)
+        assert len(test) == 3
+        merged = [poly for poly, val in test if val == 2]
+        assert len(merged) == 1
+        assert merged[0].area == pytest.approx(8)
+        assert merged[0].bounds == pytest.approx((8, 2, 12, 4))
+
+    def test_different_damage(self):
+        tiles = [(0, 0, 10, 10), (10, 0, 20, 10)]
+        polygons = [(box(8, 2, 10, 4), 2), (box(10, 2, 12, 4), 3)]
+        assert len(features.merge_border_polygons(polygons, tiles, 0.01)) == 2
@@ -1,4 +1,5 @@
 import pytest
+import torch
 
 import handler
 
@@ -15,6 +16,47 @@ class TestGetFiles:
             handler.get_files('tests/data/empty_test_dir')
 
 
+class MockWrapper:
+
+    def __init__(self, max_batch, poison=None, error='CUDA out of memory'):
+        self.max_batch = max_batch
+        self.poison = poison
+        self.error = error
+
+    def forward(self, img, debug=False, keys=None):
+        if len(img) > self.max_batch:
+            raise RuntimeError('CUDA out of memory')
+        if self.poison is not None and self.poison in img:
+            raise RuntimeError(self.error)
+        return img
+
+
+class TestForwardBatch:
+
+    @staticmethod
+    def get_batch(size):
+        return {'img': torch.arange(size), 'idx': torch.arange(size), 'in_pre_path': [f'{i}_pre.tif' for i in range(size)]}
+
+    def test_split_on_failure(self):
+        test = handler.forward_batch(MockWrapper(2), self.get_batch(8))
+        assert len(test) == 4
+        assert torch.equal(torch.cat([out for _, out in test]), torch.arange(8))
+
+    def test_drop_oom_chip(self):
+        test = handler.forward_batch(MockWrapper(8, poison=3), self.get_batch(4))
+        assert [int(i) for batch, _ in test for i in batch['idx']] == [0, 1, 2]
+
+    def test_raise_other_errors(self):
+        with pytest.raises(RuntimeError, match='bad chip'):
+            handler.forward_batch(MockWrapper(8, poison=3, error='bad chip'), self.get_batch(4))
+
+
+def test_isolate():
+    assert handler.isolate(int, '1') == (1, None)
+    value, error = handler.isolate(int, 'a')
+    assert value is None and error is not None
+
+
 def test_reprojection_helper():
 
     pass
@@ -1,10 +1,15 @@
+import json
+import multiprocessing as mp
 import pickle
 from dataclasses import dataclass
 from pathlib import Path
 import pytest
+import rasterio
 import handler
 import torch
 from pytest import MonkeyPatch
+from utils.failures import FailureReport
+from utils.work_queue import WorkQueue
 
 # Todo: Return appropriate tensor for each image
 # Todo: Have args point at tests/data for tensors and use tmp_path for output/staging
@@ -37,10 +42,48 @@ class MockArgs:
                  destination_crs='EPSG:4326',
                  output_resolution=None,
                  save_intermediates=False,
+                 pad_edges=False,
+                 chip_compress='deflate',
+                 chip_block_size=256,
                  agol_user='',
                  agol_password='',
                  agol_feature_service='',
-                 dp_mode=True
+                 dp_mode=True,
+                 pre_cache_directory=None,
+                 fast=False,
+                 soup=False,
+                 coarse_scan=None,
+                 coarse_threshold=0.1,
+                 coarse_margin=256,
+                 coarse_validate=False,
+                 profile=False,
+                 profile_start=2,
+                 profile_batches=5,
+                 profile_top=20,
+                 distributed=None,
+                 queue_directory=None,
+                 super_tile_size=16384,
+                 queue_timeout=3600,
+                 no_resume=False,
+                 catalog_file=None,
+                 priority_file=None,
+                 priority_raster=None,
+                 chip_group_size=2048,
+                 vector_commit_every=50,
+                 agol_incremental=False,
+                 staged_reproject=False,
+                 staging_cache_directory=None,
+                 staging_cache_size=100,
+                 warp_memory=2048,
+                 warp_threads='ALL_CPUS',
+                 vrt_outputs=False,
+                 chip_outputs=False,
+                 mosaic_format='cog',
+                 web_tiles=None,
+                 web_tile_format='png',
+                 web_tile_min_zoom=None,
+                 web_tile_max_zoom=None,
+                 materialize=False
                  ):
 
         self.output_directory = output_path
@@ -57,10 +100,48 @@ class MockArgs:
         self.destination_crs = destination_crs
         self.output_resolution = output_resolution
         self.save_intermediates = save_intermediates
+        self.pad_edges = pad_edges
+        self.chip_compress = chip_compress
+        self.chip_block_size = chip_block_size
         self.agol_user = agol_user
         self.agol_password = agol_password
         self.agol_feature_service = agol_feature_service
         self.dp_mode = dp_mode
+        self.pre_cache_directory = pre_cache_directory
+        self.fast = fast
+        self.soup = soup
+        self.coarse_scan = coarse_scan
+        self.coarse_threshold = coarse_threshold
+        self.coarse_margin = coarse_margin
+        self.coarse_validate = coarse_validate
+        self.profile = profile
+        self.profile_start = profile_start
+        self.profile_batches = profile_batches
+        self.profile_top = profile_top
+        self.distributed = distributed
+        self.queue_directory = queue_directory
+        self.super_tile_size = super_tile_size
+        self.queue_timeout = queue_timeout
+        self.no_resume = no_resume
+        self.catalog_file = catalog_file
+        self.priority_file = priority_file
+        self.priority_raster = priority_raster
+        self.chip_group_size = chip_group_size
+        self.vector_commit_every = vector_commit_every
+        self.agol_incremental = agol_incremental
+        self.staged_reproject = staged_reproject
+        self.staging_cache_directory = staging_cache_directory
+        self.staging_cache_size = staging_cache_size
+        self.warp_memory = warp_memory
+        self.warp_threads = warp_threads
+        self.vrt_outputs = vrt_outputs
+        self.chip_outputs = chip_outputs
+        self.mosaic_format = mosaic_format
+        self.web_tiles = web_tiles
+        self.web_tile_format = web_tile_format
+        self.web_tile_min_zoom = web_tile_min_zoom
+        self.web_tile_max_zoom = web_tile_max_zoom
+        self.materialize = materialize
 
 
 class MockLocModel:
@@ -118,7 +199,9 @@ class TestGood:
         # Pass args to handler
         self.monkeypatch.setattr('argparse.ArgumentParser.parse_args', lambda x: MockArgs(
             staging_path=staging_path,
-            output_path=output_path
+            output_path=output_path,
+            save_intermediates=True,
+            chip_outputs=True
         )
                                  ),
 
@@ -142,6 +225,14 @@ class TestGood:
     def test_overlay_mosaic(self, staging_path, output_path):
         assert output_path.joinpath('mosaics/overlay.tif').is_file()
 
+    def test_loc_mosaic(self, staging_path, output_path):
+        assert output_path.joinpath('mosaics/loc.tif').is_file()
+
+    def test_damage_mosaic(self, staging_path, output_path):
+        with rasterio.open(output_path.joinpath('mosaics/damage.tif')) as src:
+            assert src.count == 1
+            assert src.dtypes[0] == 'uint8'
+
     # Todo: currently fails although the app still works. Should still be fixed at some point
     @pytest.mark.xfail
     def test_pre_reproj(self, staging_path, output_path):
@@ -153,7 +244,8 @@ class TestGood:
         assert len(list(staging_path.joinpath('post').glob('**/*'))) == 6
 
     def test_overlay(self, staging_path, output_path):
-        assert len(list(output_path.joinpath('over').glob('**/*'))) == 4
+        # Overlays are blended straight into the overlay mosaic
+        assert not output_path.joinpath('over').exists()
 
     def test_out_shapefile(self, staging_path, output_path):
         assert output_path.joinpath('shapes/damage.shp').is_file()
@@ -174,6 +266,167 @@ class TestGood:
         assert len(list(output_path.joinpath('dmg').glob('**/*'))) == 4
 
 
+class TestDefaultArgs:
+
+    @pytest.fixture(scope='class', autouse=True)
+    def setup(self, staging_path, output_path):
+        # Chips are read from the mosaics and outputs are only written to the output mosaics
+        self.monkeypatch.setattr('argparse.ArgumentParser.parse_args', lambda x: MockArgs(
+            staging_path=staging_path,
+            output_path=output_path
+        )
+                                 ),
+
+        # Mock CUDA devices
+        self.monkeypatch.setattr('torch.cuda.device_count', lambda: 2)
+        self.monkeypatch.setattr('torch.cuda.get_device_properties', lambda x: f'Mocked CUDA Device{x}')
+
+        # Mock classes to mock inference
+        self.monkeypatch.setattr('handler.XViewFirstPlaceLocModel', MockLocModel)
+        self.monkeypatch.setattr('handler.XViewFirstPlaceClsModel', MockClsModel)
+
+        # Call the handler
+        handler.init()
+
+    def test_damage_mosaic(self, output_path):
+        with rasterio.open(output_path.joinpath('mosaics/damage.tif')) as src:
+            assert src.count == 1
+            # Compressed once finished
+            assert src.compression is not None
+
+    def test_out_shapefile(self, output_path):
+        assert output_path.joinpath('shapes/damage.shp').is_file()
+
+    def test_no_chip_outputs(self, output_path):
+        assert not any(output_path.joinpath('chips/pre').glob('**/*'))
+        assert not any(output_path.joinpath('loc').glob('**/*'))
+        assert not any(output_path.joinpath('dmg').glob('**/*'))
+
+    def test_chips_recorded(self, output_path):
+        with open(output_path.joinpath('manifest.json')) as f:
+            stages = json.load(f)
+        chips = [v for k, v in stages.items() if k.startswith('chip_')]
+        assert chips
+        assert all(chip['outputs'] == {'files': []} for chip in chips)
+
+
+class TestPriority:
+
+    # Order in which chips are inferred and recorded
+    events = []
+
+    @pytest.fixture(scope='class', autouse=True)
+    def setup(self, staging_path, output_path):
+        # One chip per group so each group is inferred and written on its own
+        self.monkeypatch.setattr('argparse.ArgumentParser.parse_args', lambda x: MockArgs(
+            staging_path=staging_path,
+            output_path=output_path,
+            priority_file='aoi.geojson',
+            chip_group_size=1
+        )
+                                 ),
+
+        # Mock CUDA devices
+        self.monkeypatch.setattr('torch.cuda.device_count', lambda: 2)
+        self.monkeypatch.setattr('torch.cuda.get_device_properties', lambda x: f'Mocked CUDA Device{x}')
+
+        # Mock classes to mock inference
+        self.monkeypatch.setattr('handler.XViewFirstPlaceLocModel', MockLocModel)
+        self.monkeypatch.setattr('handler.XViewFirstPlaceClsModel', MockClsModel)
+
+        # The last chip in grid order has the highest priority
+        self.monkeypatch.setattr('handler.priority.get_order', lambda bounds, *args, **kwargs: list(range(len(bounds)))[::-1])
+
+        events = TestPriority.events
+        run_models = handler.run_models
+        record_chip = handler.record_chip
+
+        def mock_run_models(pairs, *args, **kwargs):
+            events.append(('infer', [pair.ident for pair in pairs]))
+            return run_models(pairs, *args, **kwargs)
+
+        def mock_record_chip(manifest, pair, *args, **kwargs):
+            events.append(('record', pair.ident))
+            return record_chip(manifest, pair, *args, **kwargs)
+
+        self.monkeypatch.setattr('handler.run_models', mock_run_models)
+        self.monkeypatch.setattr('handler.record_chip', mock_record_chip)
+
+        # Call the handler
+        handler.init()
+
+    def test_priority_first(self):
+        inferred = [idents for event, idents in self.events if event == 'infer']
+        assert len(inferred) > 1 and all(len(idents) == 1 for idents in inferred)
+        first = inferred[0][0]
+        # Outputs of the top priority chip are recorded before any other chip is inferred
+        assert self.events[:3] == [('infer', [first]), ('record', first), ('infer', inferred[1])]
+        # Chips are inferred in reverse grid order
+        grid = [int(idents[0].split('_')[0]) for idents in inferred]
+        assert grid == sorted(grid, reverse=True)
+
+
+def distributed_worker():
+    # Forked from the test process so the mocks and handler arguments are inherited
+    handler.work(WorkQueue(handler.args.queue_directory), FailureReport())
+
+
+class TestDistributed:
+
+    @pytest.fixture(scope='class', autouse=True)
+    def setup(self, staging_path, output_path):
+        # Small super-tiles so the inputs are split between workers
+        self.monkeypatch.setattr('argparse.ArgumentParser.parse_args', lambda x: MockArgs(
+            staging_path=staging_path,
+            output_path=output_path,
+            distributed='plan',
+            queue_directory=output_path / 'queue',
+            super_tile_size=1024
+        )
+                                 ),
+
+        # Mock CUDA devices
+        self.monkeypatch.setattr('torch.cuda.device_count', lambda: 2)
+        self.monkeypatch.setattr('torch.cuda.get_device_properties', lambda x: f'Mocked CUDA Device{x}')
+
+        # Mock classes to mock inference
+        self.monkeypatch.setattr('handler.XViewFirstPlaceLocModel', MockLocModel)
+        self.monkeypatch.setattr('handler.XViewFirstPlaceClsModel', MockClsModel)
+
+        # Plan, then run the pipeline in two worker processes and reduce
+        handler.init()
+        ctx = mp.get_context('fork')
+        jobs = [ctx.Process(target=distributed_worker) for _ in range(2)]
+        for proc in jobs:
+            proc.start()
+        for proc in jobs:
+            proc.join()
+        TestDistributed.reduced = handler.reduce_work(WorkQueue(output_path / 'queue'))
+
+    def test_items_done(self, output_path):
+        queue = WorkQueue(output_path / 'queue')
+        status = queue.status()
+        assert status['done'] > 1
+        assert status['pending'] == status['claimed'] == status['failed'] == 0
+
+    def test_reduced(self, output_path):
+        polygons, report = self.reduced
+        assert len(report) == 0
+        assert output_path.joinpath('shapes/damage.shp').is_file()
+
+    def test_stitched_mosaics(self, output_path):
+        tiles = sorted(output_path.joinpath('tiles').glob('*/mosaics/damage.tif'))
+        assert len(tiles) > 1
+        with rasterio.open(output_path.joinpath('mosaics/damage.tif')) as src:
+            res = src.res
+        # Super-tiles are on one pixel grid
+        for tile in tiles:
+            with rasterio.open(tile) as src:
+                assert src.res == pytest.approx(res)
+                assert src.transform.c / res[0] == pytest.approx(round(src.transform.c / res[0]), abs=1e-3)
+                assert src.transform.f / res[1] == pytest.approx(round(src.transform.f / res[1]), abs=1e-3)
+
+
 class TestNoCUDA:
 
     @pytest.fixture(scope='class', autouse=True)
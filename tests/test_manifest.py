@@ -0,0 +1,58 @@
+import os
+from utils.manifest import RunManifest
+
+
+class TestRunManifest:
+
+    def test_roundtrip(self, tmp_path):
+        inp = tmp_path / 'in.tif'
+        out = tmp_path / 'out.tif'
+        inp.write_bytes(b'input')
+        out.write_bytes(b'output')
+
+        manifest = RunManifest(tmp_path / 'manifest.json')
+        assert manifest.get('mosaic_pre', [inp], {}) is None
+        manifest.record('mosaic_pre', [inp], {'res': (1, 1)}, {'files': [out]})
+        manifest.save()
+
+        test = RunManifest(tmp_path / 'manifest.json').get('mosaic_pre', [inp], {'res': (1, 1)})
+        assert test == {'files': [out.resolve()]}
+
+    def test_changed_params(self, tmp_path):
+        out = tmp_path / 'out.tif'
+        out.write_bytes(b'output')
+        manifest = RunManifest(tmp_path / 'manifest.json')
+        manifest.record('chips_pre', [], {'extent': [0, 0, 1, 1]}, {'files': [out]})
+        assert manifest.get('chips_pre', [], {'extent': [0, 0, 2, 2]}) is None
+
+    def test_changed_output(self, tmp_path):
+        out = tmp_path / 'out.tif'
+        out.write_bytes(b'output')
+        manifest = RunManifest(tmp_path / 'manifest.json')
+        manifest.record('chips_pre', [], {}, {'files': [out]})
+
+        assert manifest.get('chips_pre', [], {}) is not None
+
+        # Outputs are identified by size and mtime without reading them
+        os.utime(out, (0, 0))
+        assert manifest.get('chips_pre', [], {}) is None
+
+    def test_resized_output(self, tmp_path):
+        out = tmp_path / 'out.tif'
+        out.write_bytes(b'output')
+        manifest = RunManifest(tmp_path / 'manifest.json')
+        manifest.record('chips_pre', [], {}, {'files': [out]})
+        stat = os.stat(out)
+
+        out.write_bytes(b'longer output')
+        os.utime(out, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        assert manifest.get('chips_pre', [], {}) is None
+
+    def test_disabled(self, tmp_path):
+        out = tmp_path / 'out.tif'
+        out.write_bytes(b'output')
+        manifest = RunManifest(tmp_path / 'manifest.json', enabled=False)
+        manifest.record('chips_pre', [], {}, {'files': [out]})
+        manifest.save()
+        assert manifest.get('chips_pre', [], {}) is None
+        assert not (tmp_path / 'manifest.json').exists()
@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from utils.mosaic_writer import MosaicWriter
+
+
+class TestMosaicWriter:
+
+    @staticmethod
+    def get_profile(count=1):
+        return {'driver': 'GTiff', 'width': 64, 'height': 64, 'count': count, 'dtype': 'uint8', 'nodata': None,
+                'crs': CRS.from_epsg(4326), 'transform': from_origin(0, 64, 1, 1)}
+
+    def test_window(self, tmp_path):
+        with MosaicWriter(tmp_path / 'mosaic.tif', self.get_profile(), block_size=16) as writer:
+            window = writer.get_window(from_origin(16, 32, 1, 1), 8, 4)
+        assert (window.col_off, window.row_off, window.width, window.height) == (16, 32, 8, 4)
+
+    def test_write(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        with MosaicWriter(out_file, self.get_profile(count=3), block_size=16) as writer:
+            writer.write(np.full((3, 16, 16), 1, dtype=np.uint8), from_origin(0, 64, 1, 1))
+            writer.write(np.full((3, 8, 16), 2, dtype=np.uint8), from_origin(32, 32, 1, 1))
+            assert writer.chips == 2
+
+        with rasterio.open(out_file) as src:
+            assert src.profile['tiled']
+            arr = src.read()
+        assert (arr[:, :16, :16] == 1).all()
+        assert (arr[:, 32:40, 32:48] == 2).all()
+        assert arr.sum() == 3 * (16 * 16 + 2 * 8 * 16)
+
+    def test_write_single_band(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        with MosaicWriter(out_file, self.get_profile(), block_size=16) as writer:
+            writer.write(np.full((4, 4), 5, dtype=np.uint8), from_origin(60, 4, 1, 1))
+
+        with rasterio.open(out_file) as src:
+            arr = src.read(1)
+        assert (arr[60:, 60:] == 5).all()
+
+    def test_update(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        profile = self.get_profile()
+        with MosaicWriter(out_file, profile, block_size=16) as writer:
+            writer.write(np.full((4, 4), 1, dtype=np.uint8), from_origin(0, 64, 1, 1))
+            writer.commit()
+            writer.write(np.full((4, 4), 2, dtype=np.uint8), from_origin(4, 64, 1, 1))
+
+        assert MosaicWriter.can_update(out_file, profile)
+        assert not MosaicWriter.can_update(out_file, dict(profile, width=32))
+        assert not MosaicWriter.can_update(tmp_path / 'missing.tif', profile)
+
+        with MosaicWriter(out_file, profile, update=True) as writer:
+            writer.write(np.full((4, 4), 3, dtype=np.uint8), from_origin(8, 64, 1, 1))
+
+        with rasterio.open(out_file) as src:
+            arr = src.read(1)
+        assert (arr[:4, :4] == 1).all() and (arr[:4, 4:8] == 2).all() and (arr[:4, 8:12] == 3).all()
+
+    def test_uncompressed(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        # Compression carried over from an input mosaic profile is dropped
+        with MosaicWriter(out_file, dict(self.get_profile(), compress='deflate'), block_size=16) as writer:
+            writer.write(np.full((4, 4), 1, dtype=np.uint8), from_origin(0, 64, 1, 1))
+
+        with rasterio.open(out_file) as src:
+            assert src.compression is None
+        assert not MosaicWriter.is_finished(out_file)
+
+    def test_refuse_finished(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        profile = self.get_profile()
+        with MosaicWriter(out_file, profile, block_size=16, compress='deflate') as writer:
+            writer.write(np.full((16, 16), 1, dtype=np.uint8), from_origin(0, 64, 1, 1))
+
+        assert MosaicWriter.is_finished(out_file)
+        assert not MosaicWriter.can_update(out_file, profile)
+        with pytest.raises(ValueError):
+            MosaicWriter(out_file, profile, update=True)
+
+    def test_mask(self, tmp_path):
+        out_file = tmp_path / 'mosaic.tif'
+        with MosaicWriter(out_file, self.get_profile(count=3), block_size=16, mask=True) as writer:
+            # Black chips are still valid
+            writer.write(np.zeros((3, 16, 16), dtype=np.uint8), from_origin(0, 64, 1, 1))
+
+        with rasterio.open(out_file) as src:
+            mask = src.dataset_mask()
+        assert (mask[:16, :16] == 255).all()
+        assert mask.sum() == 255 * 16 * 16
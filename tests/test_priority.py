@@ -0,0 +1,40 @@
+import json
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+from utils import priority
+
+# Three chips in a row from west to east
+BOUNDS = [(0, 0, 1, 1), (1, 0, 2, 1), (2, 0, 3, 1)]
+
+
+class TestDistancePriority:
+
+    def test_order(self):
+        test = priority.distance_priority(BOUNDS, Point(2.9, 0.5))
+        assert list(np.argsort(test)) == [2, 1, 0]
+
+    def test_read_geometries(self, tmp_path):
+        aoi = tmp_path / 'aoi.geojson'
+        aoi.write_text(json.dumps({'type': 'FeatureCollection',
+                                   'features': [{'type': 'Feature', 'properties': {},
+                                                 'geometry': {'type': 'Point', 'coordinates': [1.5, 0.5]}}]}))
+        assert priority.get_order(BOUNDS, 'EPSG:4326', priority_file=aoi)[0] == 1
+
+
+class TestRasterPriority:
+
+    def test_order(self, tmp_path):
+        out = tmp_path / 'priority.tif'
+        profile = {'driver': 'GTiff', 'height': 1, 'width': 3, 'count': 1, 'dtype': 'uint8',
+                   'crs': 'EPSG:4326', 'transform': from_origin(0, 1, 1, 1), 'nodata': 0}
+        with rasterio.open(out, 'w', **profile) as dst:
+            dst.write(np.array([[5, 0, 9]], dtype=np.uint8), 1)
+
+        # Nodata sorts last
+        assert priority.get_order(BOUNDS, 'EPSG:4326', priority_raster=out) == [2, 0, 1]
+
+
+def test_no_priority():
+    assert priority.get_order(BOUNDS, 'EPSG:4326') == [0, 1, 2]
@@ -1,4 +1,5 @@
 import rasterio
+import rasterio.merge
 import pytest
 from pathlib import Path
 from utils import raster_processing
@@ -47,6 +48,33 @@ class TestGetIntersect:
             assert raster_processing.get_intersect(one, two)
 
 
+class TestGetFootprints:
+
+    def test_footprint_intersect(self):
+        pre = raster_processing.get_footprints(handler.get_files('tests/data/input/pre'), None, 'EPSG:4326')
+        post = raster_processing.get_footprints(handler.get_files('tests/data/input/post'), None, 'EPSG:4326')
+        test = raster_processing.get_footprint_intersect(pre, post)
+        # Same as the intersect of the reprojected mosaics to within a pixel
+        assert test == pytest.approx((-94.49960529516346, 37.06631597942802, -94.48623559881267, 37.07511383680346), abs=1e-5)
+
+
+class TestGetSuperTiles:
+
+    def test_tiles_cover_bounds(self):
+        test = raster_processing.get_super_tiles((0, 0, 10, 5), 4, 4)
+        assert len(test) == 6
+        assert test[0] == (0, 1, 4, 5)
+        assert test[-1] == (8, 0, 10, 1)
+        assert sum((t[2] - t[0]) * (t[3] - t[1]) for t in test) == pytest.approx(50)
+
+    def test_bounds_intersect(self):
+        assert raster_processing.bounds_intersect((0, 0, 2, 2), (1, 1, 3, 3))
+        assert not raster_processing.bounds_intersect((0, 0, 1, 1), (1, 0, 2, 1))
+
+    def test_clip_bounds(self):
+        assert raster_processing.clip_bounds((0, 0, 2, 2), (1, 1, 3, 3)) == (1, 1, 2, 2)
+
+
 class TestReproject:
 
     def test_reproject_crs_set(self, tmp_path):
@@ -83,6 +111,63 @@ class TestReproject:
         assert test == (6.1e-06, 6.1e-06)
 
 
+class TestWarpMosaic:
+
+    def test_warp_mosaic(self, tmp_path):
+        files = handler.get_files(Path('tests/data/input/pre'))
+        result = raster_processing.warp_mosaic(files, tmp_path / 'mosaic.tif', None, 'EPSG:4326', (6e-06, 6e-06))
+        with rasterio.open(result) as src:
+            assert src.crs == 'EPSG:4326'
+            assert src.res == pytest.approx((6e-06, 6e-06))
+            assert src.block_shapes[0] == (512, 512)
+            assert src.compression is not None
+
+    def test_warp_mosaic_bounds(self, tmp_path):
+        files = handler.get_files(Path('tests/data/input/pre'))
+        bounds = (-94.4996, 37.0663, -94.4862, 37.0751)
+        result = raster_processing.warp_mosaic(files, tmp_path / 'mosaic.tif', None, 'EPSG:4326', (6e-06, 6e-06), bounds=bounds)
+        with rasterio.open(result) as src:
+            assert tuple(src.bounds) == pytest.approx(bounds, abs=6e-06)
+
+    def test_get_sources(self):
+        files = [Path('tests/data/input/pre/tile_337-10160.tif'), Path('tests/data/misc/no_crs/may24C350000e4102500n.jpg')]
+        sources, errors = raster_processing.get_sources(files, None)
+        assert sources == files[:1]
+        assert errors[0][0] == files[1]
+        sources, errors = raster_processing.get_sources(files, 'EPSG:26915')
+        assert sources == files and not errors
+
+
+class TestCreateVrt:
+
+    def test_vrt_and_cog(self, tmp_path):
+        files = handler.get_files(Path('tests/data/output/over'))
+        vrt = raster_processing.create_vrt(files, tmp_path / 'overlay.vrt')
+        cog = raster_processing.create_cog(vrt, tmp_path / 'overlay.tif')
+        with rasterio.open(vrt) as src_vrt, rasterio.open(cog) as src_cog:
+            assert src_vrt.shape == src_cog.shape
+            assert src_cog.overviews(1)
+
+    def test_overview_levels(self):
+        assert raster_processing.get_overview_levels(2048, 1000) == [2, 4, 8]
+        assert raster_processing.get_overview_levels(200, 200) == []
+
+    def test_convert_to_cog(self, tmp_path):
+        profile = {'driver': 'GTiff', 'width': 1024, 'height': 600, 'count': 3, 'dtype': 'uint8', 'crs': 'EPSG:4326',
+                   'transform': rasterio.transform.from_origin(0, 1, 1e-3, 1e-3), 'tiled': True,
+                   'blockxsize': 512, 'blockysize': 512}
+        in_file = tmp_path / 'mosaic.tif'
+        arr = np.random.randint(0, 255, (3, 600, 1024), dtype=np.uint8)
+        with rasterio.open(in_file, 'w', **profile) as dst:
+            dst.write(arr)
+        assert raster_processing.convert_to_cog(in_file) == in_file.resolve()
+        with rasterio.open(in_file) as src:
+            assert src.overviews(1) == [2]
+            assert src.compression is not None
+            assert (src.read() == arr).all()
+        assert not in_file.with_suffix('.cog.tif').exists()
+
+
 class TestCheckDims:
 
     def test_check_dims_full_size(self):
@@ -118,6 +203,19 @@ class TestCreateMosaic:
             # Test that the extent is correct
             assert src.transform * (0, 0) == (366642.60000000003, 4104511.1999999997)
 
+    def test_blocks_match_merge(self, tmp_path):
+        files = handler.get_files(Path('tests/data/input/pre'))
+        result = raster_processing.create_mosaic(files, tmp_path / 'mosaic.tif', block_size=512, workers=2)
+
+        srcs = [rasterio.open(f) for f in files]
+        expected, _ = rasterio.merge.merge(srcs)
+        for src in srcs:
+            src.close()
+
+        with rasterio.open(result) as src:
+            assert src.block_shapes[0] == (512, 512)
+            assert np.array_equal(src.read(), expected)
+
 
 class TestCreatChips:
 
@@ -136,6 +234,141 @@ class TestCreatChips:
             assert src.width == 1024
 
 
+class TestGetCoverage:
+
+    @staticmethod
+    def write_raster(out_file, arr, nodata=None):
+        profile = {'driver': 'GTiff', 'width': arr.shape[2], 'height': arr.shape[1], 'count': arr.shape[0],
+                   'dtype': arr.dtype.name, 'crs': 'EPSG:4326', 'nodata': nodata,
+                   'transform': rasterio.transform.from_origin(0, 64, 1, 1)}
+        with rasterio.open(out_file, 'w', **profile) as dst:
+            dst.write(arr)
+        return out_file
+
+    def test_zero_is_invalid(self, tmp_path):
+        arr = np.zeros((3, 64, 64), dtype=np.uint8)
+        arr[:, :, :32] = 100
+        coverage = raster_processing.get_coverage(self.write_raster(tmp_path / 'a.tif', arr), max_size=16)
+        # Grown by one mask pixel of 4 units
+        assert coverage.bounds == pytest.approx((-4, -4, 36, 68))
+
+    def test_intersect_skips_chips(self, tmp_path):
+        arr = np.full((3, 64, 64), 100, dtype=np.uint8)
+        pre = arr.copy()
+        pre[:, :, 40:] = 255
+        post = arr.copy()
+        post[:, 40:, :] = 255
+        pre = self.write_raster(tmp_path / 'pre.tif', pre, nodata=255)
+        post = self.write_raster(tmp_path / 'post.tif', post, nodata=255)
+        coverage = raster_processing.get_coverage_intersect(pre, post, max_size=64)
+
+        out_dir = tmp_path / 'chips'
+        out_dir.mkdir()
+        chips = raster_processing.create_chips(pre, out_dir, (0, 0, 64, 64), tile_width=16, tile_height=16,
+                                               coverage=coverage)
+        # 3x3 of the 4x4 chips are inside the valid intersect
+        assert len(chips) == 9
+        assert '15_chips.tif' not in [c.name for c in chips]
+
+
+class TestChipLayout:
+
+    def test_axis_layout(self):
+        assert raster_processing.get_axis_layout(0, 40, 16) == [(0, 16, 0, 16), (16, 16, 0, 16), (32, 8, 0, 8)]
+        # The ragged chip reads real pixels and only owns the pixels not owned by the chip before it
+        assert raster_processing.get_axis_layout(0, 40, 16, shift_edges=True) == [(0, 16, 0, 16), (16, 16, 0, 16), (24, 16, 8, 8)]
+        assert raster_processing.get_axis_layout(0, 40, 16, anchor=4, shift_edges=True) == [(0, 16, 0, 4), (4, 16, 0, 16), (20, 16, 0, 16), (24, 16, 12, 4)]
+        # Imagery smaller than a chip is still padded
+        assert raster_processing.get_axis_layout(0, 10, 16, shift_edges=True) == [(0, 10, 0, 10)]
+
+    def test_crops_partition_intersect(self, tmp_path):
+        arr = np.full((3, 40, 50), 100, dtype=np.uint8)
+        mosaic = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        intersect = (0, 24, 50, 64)
+        chips = raster_processing.get_chip_windows(mosaic, intersect, 16, 16, anchor=(4, 8), shift_edges=True)
+        covered = np.zeros((40, 50), dtype=int)
+        for _, window, _, crop in chips:
+            assert (window.width, window.height) == (16, 16)
+            col, row = int(window.col_off) + crop[0], int(window.row_off) + crop[1]
+            covered[row:row + crop[3], col:col + crop[2]] += 1
+        assert (covered == 1).all()
+
+    def test_plan_fewer_chips(self, tmp_path):
+        arr = np.zeros((3, 64, 64), dtype=np.uint8)
+        # Valid data that straddles the corner anchored grid lines
+        arr[:, 10:22, 10:22] = 100
+        mosaic = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        coverage = raster_processing.get_coverage(mosaic, max_size=64)
+        assert len(raster_processing.get_chip_windows(mosaic, (0, 0, 64, 64), 16, 16, coverage)) == 4
+        anchor = raster_processing.plan_chip_layout(mosaic, (0, 0, 64, 64), 16, 16, coverage)
+        assert len(raster_processing.get_chip_windows(mosaic, (0, 0, 64, 64), 16, 16, coverage, anchor, True)) == 1
+
+
+class TestChipOptions:
+
+    def test_compressed_chips_match(self, tmp_path):
+        arr = np.random.RandomState(0).randint(0, 255, (3, 64, 64)).astype(np.uint8)
+        mosaic = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        out_dir = tmp_path / 'pre'
+        out_dir.mkdir()
+        options = raster_processing.get_chip_creation_options('lzw', 256)
+        chips = raster_processing.create_chips(mosaic, out_dir, (0, 0, 64, 64), tile_width=32, tile_height=32,
+                                               creation_options=options, workers=2, chunk_size=1)
+        assert [c.name for c in chips] == [f'{i}_pre.tif' for i in range(4)]
+        with rasterio.open(chips[1]) as src:
+            assert src.compression.value == 'LZW'
+            assert np.array_equal(src.read(), arr[:, 32:, :32])
+
+    def test_benchmark(self, tmp_path):
+        arr = np.random.RandomState(0).randint(0, 255, (3, 64, 64)).astype(np.uint8)
+        mosaic = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        options, timings = raster_processing.benchmark_chip_options(mosaic, tmp_path / 'bench', (0, 0, 64, 64),
+                                                                    block_sizes=(16,), sample=2,
+                                                                    tile_width=32, tile_height=32)
+        assert 'none' in timings and 'deflate_16' in timings
+        assert options in [raster_processing.get_chip_creation_options(*name.split('_')[:1], 16) for name in timings]
+        assert not any((tmp_path / 'bench').iterdir())
+
+    def test_benchmark_fallback(self, tmp_path, monkeypatch):
+        arr = np.random.RandomState(0).randint(0, 255, (3, 64, 64)).astype(np.uint8)
+        mosaic = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        # No option can be read back
+        monkeypatch.setattr(raster_processing.cv2, 'imread', lambda *args: None)
+        options, timings = raster_processing.benchmark_chip_options(mosaic, tmp_path / 'bench', (0, 0, 64, 64),
+                                                                    block_sizes=(16,), sample=2,
+                                                                    tile_width=32, tile_height=32)
+        assert timings == {}
+        assert options == raster_processing.get_chip_creation_options()
+
+
+class TestCreateChipPairs:
+
+    def test_skip_empty(self, tmp_path):
+        pre = np.full((3, 64, 64), 100, dtype=np.uint8)
+        post = pre.copy()
+        # Empty in the left column of pre chips and the top row of post chips
+        pre[:, :, :32] = 0
+        post[:, :32, :] = 0
+        pre = TestGetCoverage.write_raster(tmp_path / 'pre.tif', pre)
+        post = TestGetCoverage.write_raster(tmp_path / 'post.tif', post)
+
+        records = raster_processing.create_chip_pairs(pre, post, tmp_path / 'chips', (0, 0, 64, 64),
+                                                      tile_width=32, tile_height=32, workers=2, chunk_size=1)
+        assert [r.ident for r in records] == ['3_pre']
+        assert records[0].valid == 1
+        assert records[0].profile['transform'] == rasterio.transform.from_origin(32, 32, 1, 1)
+        assert sorted(f.name for f in (tmp_path / 'chips' / 'pre').iterdir()) == ['3_pre.tif']
+
+    def test_index_roundtrip(self, tmp_path):
+        arr = np.full((3, 32, 32), 100, dtype=np.uint8)
+        pre = TestGetCoverage.write_raster(tmp_path / 'pre.tif', arr)
+        records = raster_processing.create_chip_pairs(pre, pre, tmp_path / 'chips', (0, 32, 32, 64),
+                                                      tile_width=32, tile_height=32)
+        assert len(records) == 1
+        index = raster_processing.write_chip_index(records, tmp_path / 'chips.json')
+        assert raster_processing.read_chip_index(index) == records
+
+
 class TestCreateComposite:
 
     def test_create_composite(self, tmp_path):
@@ -145,3 +378,33 @@ class TestCreateComposite:
         out_file = tmp_path / 'composite.tif'
         dmg_arr = np.load(open('tests/data/misc/damage_arr/cls_0.npy', 'rb'))
         assert raster_processing.create_composite(in_file, dmg_arr, out_file, transforms) == out_file
+
+    def test_blend_overlay(self):
+        base = np.full((3, 2, 2), 100, dtype=np.uint8)
+        overlay = np.array([[0, 1], [3, 4]], dtype=np.uint8)
+        result = raster_processing.blend_overlay(base, overlay, alpha=.5)
+        assert result.shape == (3, 2, 2)
+        assert result.dtype == np.uint8
+        assert tuple(result[:, 0, 0]) == (100, 100, 100)
+        assert tuple(result[:, 0, 1]) == (178, 178, 178)
+        assert tuple(result[:, 1, 0]) == (178, 130, 50)
+        assert tuple(result[:, 1, 1]) == (178, 50, 50)
+
+    def test_blend_overlay_grey(self):
+        base = np.full((1, 2, 2), 10, dtype=np.uint8)
+        result = raster_processing.blend_overlay(base, np.zeros((2, 2), dtype=np.uint8))
+        assert result.shape == (3, 2, 2)
+        assert (result == 10).all()
+
+
+class TestSnapBounds:
+
+    def test_snap(self):
+        assert raster_processing.snap_bounds((0.3, 0.3, 1.7, 2.5), (0.5, 0.5)) == (0.0, 0.0, 2.0, 2.5)
+        # Bounds on the grid are kept despite floating point error
+        assert raster_processing.snap_bounds((3 * 0.1, 0, 7 * 0.1, 0.2), (0.1, 0.1)) == pytest.approx((0.3, 0, 0.7, 0.2))
+
+    def test_warp_bounds(self):
+        # Limited to the super-tile and on the grid
+        assert raster_processing.get_warp_bounds((0.3, 0.3, 5.7, 1.7), (1, 0, 3, 2), (0.5, 0.5)) == (1, 0.0, 3, 2.0)
+        assert raster_processing.get_warp_bounds((1.3, 0.3, 1.7, 1.2), (1, 0, 3, 2), (0.5, 0.5)) == (1.0, 0.0, 2.0, 1.5)
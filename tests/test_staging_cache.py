@@ -0,0 +1,76 @@
+import os
+import pytest
+from pathlib import Path
+from utils.staging_cache import StagingCache
+
+
+class TestStagingCache:
+
+    @staticmethod
+    def write(size):
+        def func(path):
+            Path(path).write_bytes(b'0' * size)
+        return func
+
+    def test_key(self, tmp_path):
+        src = tmp_path / 'tile.tif'
+        src.write_bytes(b'1')
+        key = StagingCache.get_key(src, None, 'EPSG:4326', (1e-5, 1e-5))
+        assert key == StagingCache.get_key(src, None, 'EPSG:4326', (1e-5, 1e-5))
+        assert key != StagingCache.get_key(src, 'EPSG:26915', 'EPSG:4326', (1e-5, 1e-5))
+        assert key != StagingCache.get_key(src, None, 'EPSG:3857', (1e-5, 1e-5))
+        assert key != StagingCache.get_key(src, None, 'EPSG:4326', (2e-5, 2e-5))
+        assert key != StagingCache.get_key(src, None, 'EPSG:4326', (1e-5, 1e-5), resampling='bilinear')
+
+        # Same name in another directory is another source
+        other = tmp_path / 'post'
+        other.mkdir()
+        (other / 'tile.tif').write_bytes(b'1')
+        assert key != StagingCache.get_key(other / 'tile.tif', None, 'EPSG:4326', (1e-5, 1e-5))
+
+    def test_get_or_create(self, tmp_path):
+        cache = StagingCache(tmp_path / 'cache')
+        calls = []
+
+        def func(path):
+            calls.append(path)
+            Path(path).write_bytes(b'0')
+
+        assert cache.get('ab12') is None
+        path = cache.get_or_create('ab12', func)
+        assert path.is_file()
+        assert cache.get_or_create('ab12', func) == path
+        assert len(calls) == 1
+        assert list((tmp_path / 'cache').glob('*/*.tmp.tif')) == []
+
+    def test_failed_create(self, tmp_path):
+        cache = StagingCache(tmp_path / 'cache')
+
+        def func(path):
+            Path(path).write_bytes(b'0')
+            raise ValueError('Warp failed')
+
+        with pytest.raises(ValueError):
+            cache.get_or_create('ab12', func)
+        assert cache.get('ab12') is None
+        assert list((tmp_path / 'cache').glob('*/*')) == []
+
+    def test_evict(self, tmp_path):
+        cache = StagingCache(tmp_path / 'cache', max_gb=2500 / 2 ** 30)
+        paths = [cache.put(f'{i:02d}ff', self.write(1000)) for i in range(4)]
+        for i, path in enumerate(paths):
+            os.utime(path, ns=(i * 10 ** 9, i * 10 ** 9))
+
+        # The oldest file is in use so the next oldest are removed
+        assert cache.evict(keep=[paths[0]]) == 2
+        assert [p.is_file() for p in paths] == [True, False, False, True]
+
+    def test_get_keeps_mtime(self, tmp_path):
+        cache = StagingCache(tmp_path / 'cache')
+        path = cache.put('ab12', self.write(10))
+        os.utime(path, ns=(0, 0))
+
+        # Use is marked by the access time so manifest identities stay valid
+        assert cache.get('ab12') == path
+        assert path.stat().st_mtime_ns == 0
+        assert path.stat().st_atime_ns > 0
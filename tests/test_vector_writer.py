@@ -0,0 +1,29 @@
+import fiona
+from shapely.geometry import box
+from utils.vector_writer import VectorWriter
+
+
+class TestVectorWriter:
+
+    def test_commit_and_push(self, tmp_path):
+        pushed = []
+        out = tmp_path / 'damage.shp'
+        with VectorWriter(out, 'EPSG:4326', commit_every=2, push=pushed.append) as writer:
+            writer.write([(box(0, 0, 1, 1), 1)])
+            assert pushed == []
+            writer.write([(box(1, 1, 2, 2), 2), (box(2, 2, 3, 3), 3)])
+            assert len(pushed) == 1 and len(pushed[0]) == 3
+            writer.write([])
+
+        assert len(writer.polygons) == 3
+        with fiona.open(out) as shp:
+            assert [feat['properties']['dmg'] for feat in shp] == [1, 2, 3]
+
+    def test_failed_push(self, tmp_path):
+        def push(polygons):
+            raise ConnectionError('offline')
+
+        with VectorWriter(tmp_path / 'damage.shp', 'EPSG:4326', commit_every=1, push=push) as writer:
+            writer.write([(box(0, 0, 1, 1), 1)])
+
+        assert len(writer.polygons) == 1
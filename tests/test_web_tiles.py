@@ -0,0 +1,103 @@
+import json
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from PIL import Image
+from utils import web_tiles
+
+
+class TestTileMath:
+
+    def test_tile_range(self):
+        assert web_tiles.get_tile_range((-web_tiles.ORIGIN, -web_tiles.ORIGIN, web_tiles.ORIGIN, web_tiles.ORIGIN), 1) == (0, 0, 1, 1)
+        assert web_tiles.get_tile_range((1, 1, 2, 2), 1) == (1, 0, 1, 0)
+        # Touching the edge of the next tile does not include it
+        assert web_tiles.get_tile_range((-10, -10, 0, 0), 1) == (0, 1, 0, 1)
+
+    def test_tile_transform(self):
+        transform = web_tiles.get_tile_transform(1, 1, 1)
+        assert (transform.c, transform.f) == pytest.approx((0, 0))
+        assert transform.a == pytest.approx(web_tiles.ORIGIN / web_tiles.TILE_SIZE)
+
+    def test_blocks(self):
+        blocks = web_tiles.get_blocks([(0, 0), (15, 15), (16, 0), (1, 17)])
+        assert sorted(blocks) == [[(0, 0), (15, 15)], [(1, 17)], [(16, 0)]]
+
+
+class TestCreateTiles:
+
+    @staticmethod
+    def write_overlay(out_file, fill=200, valid=True):
+        # About 0.6m pixels near the equator
+        profile = {'driver': 'GTiff', 'width': 512, 'height': 512, 'count': 3, 'dtype': 'uint8', 'crs': 'EPSG:4326',
+                   'transform': from_origin(0.001, 0.001, 5e-06, 5e-06)}
+        arr = np.zeros((3, 512, 512), dtype=np.uint8)
+        arr[:, :256] = fill
+        # Only the top half has chips, like a mosaic from MosaicWriter
+        mask = np.zeros((512, 512), dtype=np.uint8)
+        if valid:
+            mask[:256] = 255
+        with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True), rasterio.open(out_file, 'w', **profile) as dst:
+            dst.write(arr)
+            dst.write_mask(mask)
+
+        return profile
+
+    def test_zoom_range(self, tmp_path):
+        self.write_overlay(tmp_path / 'overlay.tif')
+        (min_zoom, max_zoom), bounds = web_tiles.get_zoom_range(tmp_path / 'overlay.tif')
+        assert max_zoom == 19
+        assert len(web_tiles.get_tiles(bounds, min_zoom)) == 1
+        assert len(web_tiles.get_tiles(bounds, min_zoom + 1)) > 1
+
+    def test_create_tiles(self, tmp_path):
+        self.write_overlay(tmp_path / 'overlay.tif')
+        metadata = web_tiles.create_tiles(tmp_path / 'overlay.tif', tmp_path / 'tiles', max_zoom=18, workers=1)
+        with open(metadata) as f:
+            meta = json.load(f)
+        assert meta['maxzoom'] == 18
+        assert (tmp_path / 'tiles' / str(meta['minzoom'])).is_dir()
+
+        tiles = list((tmp_path / 'tiles' / '18').glob('*/*.png'))
+        # Only the top half has data so tiles over the bottom half are transparent and skipped
+        _, bounds = web_tiles.get_zoom_range(tmp_path / 'overlay.tif')
+        assert 0 < len(tiles) < len(web_tiles.get_tiles(bounds, 18))
+
+    def test_update_tiles(self, tmp_path):
+        profile = self.write_overlay(tmp_path / 'overlay.tif')
+        web_tiles.create_tiles(tmp_path / 'overlay.tif', tmp_path / 'tiles', max_zoom=18, workers=1)
+        before = set((tmp_path / 'tiles' / '18').glob('*/*.png'))
+
+        # Clear the overlay and only update the tiles of the top left corner
+        self.write_overlay(tmp_path / 'overlay.tif', valid=False)
+        left, top = profile['transform'].c, profile['transform'].f
+        web_tiles.create_tiles(tmp_path / 'overlay.tif', tmp_path / 'tiles', max_zoom=18, workers=1,
+                               changed=[(left, top - 1e-5, left + 1e-5, top)])
+        after = set((tmp_path / 'tiles' / '18').glob('*/*.png'))
+        assert len(after) == len(before) - 1
+        assert (tmp_path / 'tiles' / 'metadata.json').is_file()
+
+    def test_black_is_opaque(self, tmp_path):
+        self.write_overlay(tmp_path / 'overlay.tif', fill=0)
+        web_tiles.create_tiles(tmp_path / 'overlay.tif', tmp_path / 'tiles', max_zoom=18, workers=1)
+        tiles = list((tmp_path / 'tiles' / '18').glob('*/*.png'))
+        assert tiles
+        with Image.open(tiles[0]) as img:
+            assert np.asarray(img.convert('RGBA'))[..., 3].max() == 255
+
+    def test_parent_edges(self, tmp_path):
+        # A child tile half covered by white data
+        child = np.zeros((web_tiles.TILE_SIZE, web_tiles.TILE_SIZE, 4), dtype=np.uint8)
+        child[:, :web_tiles.TILE_SIZE // 2 + 1] = 255
+        path = web_tiles.get_tile_path(tmp_path, 0, 0, 1, 'png')
+        path.parent.mkdir(parents=True)
+        Image.fromarray(child, 'RGBA').save(path)
+
+        web_tiles.build_parents(tmp_path, [(0, 0)], 0)
+        with Image.open(web_tiles.get_tile_path(tmp_path, 0, 0, 0, 'png')) as img:
+            rgba = np.asarray(img.convert('RGBA'))
+        # Edge pixels blended with transparent pixels keep their color
+        edge = rgba[:64, web_tiles.TILE_SIZE // 4]
+        assert edge[:, 3].min() > 0
+        assert edge[:, :3].min() >= 250
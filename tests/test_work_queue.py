@@ -0,0 +1,101 @@
+import multiprocessing as mp
+import json
+import os
+import time
+import pytest
+from utils.work_queue import WorkQueue
+
+
+def worker(queue_directory, out_file):
+    queue = WorkQueue(queue_directory)
+    queue.wait_for_plan(poll=0.1)
+    claimed = []
+    while True:
+        item = queue.claim()
+        if item is None:
+            break
+        claimed.append(item['id'])
+        queue.complete(item['id'])
+    with open(out_file, 'w') as f:
+        json.dump(claimed, f)
+
+
+class TestWorkQueue:
+
+    def test_create_once(self, tmp_path):
+        queue = WorkQueue(tmp_path)
+        assert queue.create([{'id': 'a'}], {'resolution': [1, 1]})
+        assert not WorkQueue(tmp_path).create([{'id': 'b'}], {})
+        assert queue.status()['pending'] == 1
+        assert queue.meta == {'resolution': [1, 1]}
+
+    def test_claim_complete_fail(self, tmp_path):
+        queue = WorkQueue(tmp_path)
+        queue.create([{'id': 'a'}, {'id': 'b'}], {})
+        assert queue.claim()['id'] == 'a'
+        assert queue.claim()['id'] == 'b'
+        assert queue.claim() is None
+        queue.complete('a', {'polygons': 3})
+        queue.fail('b', ValueError('bad'))
+        assert queue.is_finished()
+        assert queue.items('done')[0]['polygons'] == 3
+        assert queue.items('failed')[0]['error'] == 'bad'
+
+    def test_requeue_stale(self, tmp_path):
+        queue = WorkQueue(tmp_path)
+        queue.create([{'id': 'a'}], {})
+        queue.claim()
+        assert queue.requeue_stale(60) == 0
+        old = time.time() - 120
+        os.utime(queue.get_dir('claimed').joinpath('a.json'), (old, old))
+        assert queue.requeue_stale(60) == 1
+        assert queue.claim()['id'] == 'a'
+
+    def test_lost_claim(self, tmp_path):
+        queue = WorkQueue(tmp_path)
+        queue.create([{'id': 'a'}], {})
+        queue.claim()
+        old = time.time() - 120
+        os.utime(queue.get_dir('claimed').joinpath('a.json'), (old, old))
+        # Requeued while the first worker was still busy, then claimed by another worker
+        assert queue.requeue_stale(60) == 1
+        assert not queue.complete('a')
+        assert queue.claim()['id'] == 'a'
+        assert queue.complete('a')
+        assert queue.status() == {'pending': 0, 'claimed': 0, 'done': 1, 'failed': 0}
+
+    def test_stale_plan_lock(self, tmp_path):
+        queue = WorkQueue(tmp_path)
+        # A planner crashed after taking the lock
+        assert queue.lock('plan')
+        with pytest.raises(TimeoutError):
+            queue.wait_for_plan(poll=0.1, timeout=0.5)
+        assert not queue.create([{'id': 'a'}], {}, stale=60)
+
+        old = time.time() - 120
+        os.utime(tmp_path / 'plan.lock', (old, old))
+        with pytest.raises(TimeoutError):
+            queue.wait_for_plan(poll=0.1, stale=60)
+        assert queue.create([{'id': 'a'}], {}, stale=60)
+        assert queue.wait_for_plan(poll=0.1, stale=60) == {}
+
+    def test_multiple_workers(self, tmp_path):
+        queue_directory = tmp_path / 'queue'
+        ctx = mp.get_context('spawn')
+        jobs = [ctx.Process(target=worker, args=(queue_directory, tmp_path / f'{i}.json')) for i in range(4)]
+        for proc in jobs:
+            proc.start()
+
+        items = [{'id': f'{i:06d}'} for i in range(50)]
+        WorkQueue(queue_directory).create(items, {})
+
+        for proc in jobs:
+            proc.join()
+
+        claimed = []
+        for i in range(4):
+            claimed += json.loads((tmp_path / f'{i}.json').read_text())
+
+        # Every item is processed exactly once
+        assert sorted(claimed) == [item['id'] for item in items]
+        assert WorkQueue(queue_directory).status()['done'] == 50
@@ -0,0 +1,194 @@
+import json
+import os
+import sqlite3
+import rasterio
+import rasterio.crs
+import rasterio.errors
+import rasterio.warp
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from loguru import logger
+
+
+CatalogRecord = namedtuple('CatalogRecord', ['path', 'size', 'mtime', 'crs', 'left', 'bottom', 'right', 'top',
+                                             'width', 'height', 'res_x', 'res_y', 'count', 'dtype', 'nodata', 'error'])
+
+
+def read_record(in_file):
+
+    """
+    Read raster metadata for the catalog.
+    :param in_file: Raster file
+    :return: CatalogRecord. Unreadable files get a record with the error set.
+    """
+
+    stat = os.stat(in_file)
+    try:
+        with rasterio.open(in_file) as src:
+            return CatalogRecord(str(in_file), stat.st_size, stat.st_mtime_ns,
+                                 src.crs.to_wkt() if src.crs else None,
+                                 *src.bounds,
+                                 src.width, src.height, *src.res, src.count, src.dtypes[0], src.nodata,
+                                 None)
+    except rasterio.errors.RasterioIOError as ex:
+        return CatalogRecord(str(in_file), stat.st_size, stat.st_mtime_ns, *[None] * 12, str(ex))
+
+
+class InputCatalog(object):
+
+    """
+    SQLite catalog of input rasters keyed by path, size and mtime. Stores footprint, CRS, native resolution, band
+    count, dtype and nodata so repeated runs over the same imagery do not reopen every file. Directory listings are
+    cached by directory mtime so unchanged trees are not re-globbed.
+    """
+
+    def __init__(self, catalog_file, workers=8):
+        self.catalog_file = Path(catalog_file)
+        self.workers = workers
+        self.catalog_file.parent.mkdir(parents=True, exist_ok=True)
+        with self.connect() as con:
+            con.execute(f'CREATE TABLE IF NOT EXISTS rasters ({", ".join(CatalogRecord._fields)}, '
+                        'PRIMARY KEY (path))')
+            con.execute('CREATE TABLE IF NOT EXISTS dirs (path PRIMARY KEY, mtime, files, subdirs)')
+
+    def connect(self):
+        # Several processes may share the catalog so wait on locks rather than failing
+        return sqlite3.connect(str(self.catalog_file), timeout=60)
+
+    def get(self, in_files):
+
+        """
+        Get records for input files, reading and storing any that are missing or changed.
+        :param in_files: List of raster files
+        :return: Dict of file to CatalogRecord
+        """
+
+        in_files = [Path(f) for f in in_files]
+        rows = []
+        with self.connect() as con:
+            # Chunked to stay under the SQLite variable limit
+            for start in range(0, len(in_files), 900):
+                chunk = [str(f) for f in in_files[start:start + 900]]
+                rows += con.execute(f'SELECT * FROM rasters WHERE path IN ({", ".join("?" * len(chunk))})', chunk).fetchall()
+        cached = {row[0]: CatalogRecord(*row) for row in rows}
+
+        records = {}
+        missing = []
+        for f in in_files:
+            stat = os.stat(f)
+            record = cached.get(str(f))
+            if record is not None and record.size == stat.st_size and record.mtime == stat.st_mtime_ns:
+                records[f] = record
+            else:
+                missing.append(f)
+
+        if missing:
+            logger.info(f'Cataloging {len(missing)} of {len(in_files)} input files')
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                new = list(executor.map(read_record, missing))
+            with self.connect() as con:
+                con.executemany(f'INSERT OR REPLACE INTO rasters VALUES ({", ".join("?" * len(CatalogRecord._fields))})', new)
+            records.update(zip(missing, new))
+
+        return records
+
+    def get_footprints(self, in_files, in_crs, dst_crs):
+
+        """
+        Computes bounds of input rasters in the destination CRS. See raster_processing.get_footprints.
+        :param in_files: list of rasters
+        :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+        :param dst_crs: destination crs
+        :return: list of (file, bounds) with bounds in (left, bottom, right, top). Unreadable and non-geospatial
+        files are skipped.
+        """
+
+        footprints = []
+        for f, record in self.get(in_files).items():
+            src_crs = self.get_crs(record, in_crs)
+            if src_crs is None:
+                logger.debug(f'Skipping {f}: {record.error or "no CRS"}')
+                continue
+
+            bounds = rasterio.warp.transform_bounds(src_crs, rasterio.crs.CRS({'init': dst_crs}),
+                                                    record.left, record.bottom, record.right, record.top,
+                                                    densify_pts=21)
+            footprints.append((f, bounds))
+
+        return footprints
+
+    def get_reproj_res(self, pre_files, post_files, args):
+
+        """
+        Calculates the re-projection resolution. See raster_processing.get_reproj_res.
+        :param pre_files: pre-disaster files
+        :param post_files: post-disaster files
+        :param args: arguments with pre_crs, post_crs and destination_crs
+        :return: tuple -- output resolution
+        """
+
+        res = []
+        for files, in_crs in ((pre_files, args.pre_crs), (post_files, args.post_crs)):
+            for record in self.get(files).values():
+                src_crs = self.get_crs(record, in_crs)
+                # Skip non-geospatial images
+                if src_crs is None:
+                    continue
+
+                transform = rasterio.warp.calculate_default_transform(
+                    src_crs,
+                    rasterio.crs.CRS({'init': args.destination_crs}),
+                    width=record.width, height=record.height,
+                    left=record.left,
+                    bottom=record.bottom,
+                    right=record.right,
+                    top=record.top,
+                    dst_width=record.width, dst_height=record.height
+                )
+                res.append((transform[0][0], -transform[0][4]))
+
+        return (max([sublist[0] for sublist in res]),
+                max([sublist[1] for sublist in res]))
+
+    @staticmethod
+    def get_crs(record, in_crs):
+        if record.error is not None:
+            return None
+        if record.crs:
+            return rasterio.crs.CRS.from_wkt(record.crs)
+        if in_crs:
+            return rasterio.crs.CRS({'init': in_crs})
+        return None
+
+    def list_files(self, dirname, extensions=['.png', '.tif', '.jpg']):
+
+        """
+        Gathers list of files recursively like handler.get_files, reusing cached listings of unchanged directories.
+        :param dirname: path to parse
+        :param extensions: extensions to match
+        :return: list of files matching extensions
+        """
+
+        match = []
+        stack = [Path(dirname).resolve()]
+        with self.connect() as con:
+            while stack:
+                d = stack.pop()
+                mtime = os.stat(d).st_mtime_ns
+                row = con.execute('SELECT files, subdirs FROM dirs WHERE path = ? AND mtime = ?', (str(d), mtime)).fetchone()
+                if row is not None:
+                    files, subdirs = json.loads(row[0]), json.loads(row[1])
+                else:
+                    entries = list(os.scandir(d))
+                    files = sorted(e.path for e in entries if e.is_file())
+                    subdirs = sorted(e.path for e in entries if e.is_dir())
+                    con.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                                (str(d), mtime, json.dumps(files), json.dumps(subdirs)))
+
+                match += [Path(f) for f in files if Path(f).suffix in extensions]
+                stack += [Path(s) for s in subdirs]
+
+        assert len(match) > 0, logger.critical(f'No image files found in {Path(dirname).resolve()}')
+
+        return sorted(match)
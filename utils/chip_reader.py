@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import rasterio
+from rasterio import windows
+
+
+class ChipReader(object):
+
+    """
+    Reads chip windows straight from the mosaics so chips do not have to be written to disk. Mosaics are opened on
+    first use in each process and kept open, so DataLoader and postprocessing workers reuse their handles and GDAL
+    block cache across chips.
+    """
+
+    def __init__(self, cache_mb=512, max_open=64):
+
+        """
+        :param cache_mb: GDAL block cache size in MB for each process
+        :param max_open: number of datasets kept open. The least recently opened is closed first.
+        """
+
+        self.cache_mb = cache_mb
+        self.max_open = max_open
+        self.datasets = {}
+
+    def __getstate__(self):
+        # Open datasets can not be sent to spawned workers. Each worker opens its own.
+        return {'cache_mb': self.cache_mb, 'max_open': self.max_open, 'datasets': {}}
+
+    def open(self, in_raster):
+        src = self.datasets.get(str(in_raster))
+        if src is None:
+            # GDAL reads the cache size when the first dataset in the process is opened
+            os.environ.setdefault('GDAL_CACHEMAX', str(self.cache_mb))
+            if len(self.datasets) >= self.max_open:
+                self.datasets.pop(next(iter(self.datasets))).close()
+            src = self.datasets[str(in_raster)] = rasterio.open(in_raster)
+
+        return src
+
+    def read(self, in_raster, window, tile_width=1024, tile_height=1024):
+
+        """
+        Read a chip window zero padded to the chip size like raster_processing.create_chips.
+        :param in_raster: mosaic
+        :param window: tuple of (col_off, row_off, width, height)
+        :param tile_width: chip width
+        :param tile_height: chip height
+        :return: array of (bands, tile_height, tile_width)
+        """
+
+        arr = self.open(in_raster).read(window=windows.Window(*window))
+        if arr.shape[1:] == (tile_height, tile_width):
+            return arr
+
+        result = np.zeros((arr.shape[0], tile_height, tile_width), dtype=arr.dtype)
+        result[:, :arr.shape[1], :arr.shape[2]] = arr
+
+        return result
+
+    def read_rgb(self, in_raster, window, tile_width=1024, tile_height=1024):
+
+        """
+        Read a chip window as an 8-bit 3 channel image.
+        :return: array of (tile_height, tile_width, 3)
+        """
+
+        arr = self.read(in_raster, window, tile_width, tile_height)
+        if arr.shape[0] < 3:
+            arr = np.repeat(arr[:1], 3, axis=0)
+
+        return np.ascontiguousarray(np.moveaxis(arr[:3], 0, -1)).astype(np.uint8)
+
+    def read_bgr(self, in_raster, window, tile_width=1024, tile_height=1024):
+
+        """
+        Read a chip window in the channel order of cv2.imread with IMREAD_COLOR.
+        :return: array of (tile_height, tile_width, 3)
+        """
+
+        return np.ascontiguousarray(self.read_rgb(in_raster, window, tile_width, tile_height)[..., ::-1])
+
+    def close(self):
+        for src in self.datasets.values():
+            src.close()
+        self.datasets = {}
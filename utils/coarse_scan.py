@@ -0,0 +1,153 @@
+import numpy as np
+import rasterio
+import rasterio.windows
+import torch
+from rasterio.enums import Resampling
+from loguru import logger
+from tqdm import tqdm
+from utils import utils
+
+
+def get_coarse_grid(in_raster, intersect, factor):
+
+    """
+    Calculate the full resolution intersect window and the transform and shape of the coarse grid covering it.
+    :param in_raster: Pre mosaic
+    :param intersect: Bounds of the intersect (left, bottom, right, top)
+    :param factor: Downsampling factor
+    :return: Tuple of full resolution window, coarse transform and coarse (height, width)
+    """
+
+    with rasterio.open(in_raster) as src:
+        window = src.window(*intersect).round_offsets().round_lengths()
+        transform = rasterio.windows.transform(window, src.transform)
+
+    coarse_transform = transform * transform.scale(factor, factor)
+    shape = (int(np.ceil(window.height / factor)), int(np.ceil(window.width / factor)))
+
+    return window, coarse_transform, shape
+
+
+def read_coarse_tile(src, window, factor, tile_size):
+
+    """
+    Read a window of the mosaic downsampled by factor and prepare it like XViewDataset does.
+    :param src: Open rasterio dataset
+    :param window: Full resolution window to read
+    :param factor: Downsampling factor
+    :param tile_size: Size of the downsampled tile
+    :return: Tensor of shape (4, 3, tile_size, tile_size) with test-time augmentations
+    """
+
+    arr = src.read([1, 2, 3],
+                   window=window,
+                   out_shape=(3, tile_size, tile_size),
+                   boundless=True,
+                   fill_value=0,
+                   resampling=Resampling.average)
+
+    # XViewDataset reads chips with cv2, so bands are in BGR order
+    img = utils.preprocess_inputs(np.moveaxis(arr, 0, 2)[..., ::-1])
+
+    inp = np.asarray([img, img[::-1, ...], img[:, ::-1, ...], img[::-1, ::-1, ...]], dtype='float')
+
+    return torch.from_numpy(inp.transpose((0, 3, 1, 2))).float()
+
+
+def scan(in_raster, intersect, loc_wrapper, factor=4, tile_size=1024, batch_size=4):
+
+    """
+    Run a localization model over the intersect at reduced resolution.
+    :param in_raster: Pre mosaic
+    :param intersect: Bounds of the intersect (left, bottom, right, top)
+    :param loc_wrapper: Localization model wrapper (ie. XViewFirstPlaceLocModel)
+    :param factor: Downsampling factor
+    :param tile_size: Size of the downsampled tiles passed to the model
+    :param batch_size: Number of tiles to run at once
+    :return: Tuple of uint8 localization probabilities on the coarse grid and the coarse transform
+    """
+
+    window, coarse_transform, shape = get_coarse_grid(in_raster, intersect, factor)
+    probs = np.zeros(shape, dtype=np.uint8)
+
+    offsets = [(row, col) for col in range(0, shape[1], tile_size) for row in range(0, shape[0], tile_size)]
+    logger.debug(f'Coarse scan grid: {shape} with {len(offsets)} tiles')
+
+    with rasterio.open(in_raster) as src, torch.no_grad():
+        for idx in tqdm(range(0, len(offsets), batch_size)):
+            batch = offsets[idx:idx + batch_size]
+            tiles = []
+            for row, col in batch:
+                tile_window = rasterio.windows.Window(window.col_off + col * factor,
+                                                      window.row_off + row * factor,
+                                                      tile_size * factor,
+                                                      tile_size * factor)
+                tiles.append(read_coarse_tile(src, tile_window, factor, tile_size))
+
+            out = loc_wrapper.forward(torch.stack(tiles)).numpy().reshape(len(batch), tile_size, tile_size)
+
+            for (row, col), tile in zip(batch, out):
+                h = min(tile_size, shape[0] - row)
+                w = min(tile_size, shape[1] - col)
+                probs[row:row + h, col:col + w] = tile[:h, :w]
+
+    return probs, coarse_transform
+
+
+def select_chips(profiles, probs, coarse_transform, threshold=0.1, margin=256, factor=4):
+
+    """
+    Select chips that contain any building signal in the coarse scan.
+    :param profiles: List of chip geo profiles (transform, width and height are used)
+    :param probs: uint8 localization probabilities on the coarse grid
+    :param coarse_transform: Transform of the coarse grid
+    :param threshold: Minimum localization probability for a building signal
+    :param margin: Safety margin around each chip in full resolution pixels
+    :param factor: Downsampling factor of the coarse grid
+    :return: List of booleans, True if the chip should be inferred at full resolution
+    """
+
+    signal = probs >= threshold * 255
+    pad = int(np.ceil(margin / factor))
+
+    selected = []
+    for profile in profiles:
+        bounds = rasterio.transform.array_bounds(profile['height'], profile['width'], profile['transform'])
+        win = rasterio.windows.from_bounds(*bounds, transform=coarse_transform)
+        row_start = max(int(np.floor(win.row_off)) - pad, 0)
+        col_start = max(int(np.floor(win.col_off)) - pad, 0)
+        row_stop = min(int(np.ceil(win.row_off + win.height)) + pad, signal.shape[0])
+        col_stop = min(int(np.ceil(win.col_off + win.width)) + pad, signal.shape[1])
+
+        if row_stop <= row_start or col_stop <= col_start:
+            selected.append(False)
+        else:
+            selected.append(bool(signal[row_start:row_stop, col_start:col_stop].any()))
+
+    return selected
+
+
+def recall(selected, loc_mosaic, bounds):
+
+    """
+    Calculate recall of the coarse scan against full resolution localization outputs.
+    :param selected: List of booleans from select_chips
+    :param loc_mosaic: Full resolution localization mosaic
+    :param bounds: List of bounds (left, bottom, right, top) of the same chips
+    :return: Tuple of building pixel recall and fraction of chips selected
+    """
+
+    found = 0
+    total = 0
+    with rasterio.open(loc_mosaic) as src:
+        for keep, chip_bounds in zip(selected, bounds):
+            window = src.window(*chip_bounds).round_offsets().round_lengths()
+            buildings = int((src.read(1, window=window) > 0).sum())
+            total += buildings
+            if keep:
+                found += buildings
+
+    pixel_recall = found / total if total else 1.0
+    chip_fraction = sum(selected) / len(selected) if selected else 0.0
+
+    return pixel_recall, chip_fraction
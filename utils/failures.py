@@ -0,0 +1,65 @@
+import json
+import shutil
+from pathlib import Path
+from loguru import logger
+
+
+class FailureReport(object):
+
+    """
+    Collects inputs, chips and batches that failed so a run can finish with partial results. Failed chips are copied
+    to a quarantine directory so they can be inspected after the run.
+    """
+
+    def __init__(self):
+        self.failures = []
+
+    def __len__(self):
+        return len(self.failures)
+
+    def add(self, stage, item, error):
+
+        """
+        Record a failure.
+        :param stage: Pipeline stage (ie. reproject, chip, inference, postprocess)
+        :param item: Failed input file or chip identifier
+        :param error: Exception or message
+        """
+
+        logger.error(f'{stage} failed for {item}: {error}')
+        self.failures.append({'stage': stage, 'item': str(item), 'error': str(error)})
+
+    def quarantine(self, stage, ident, files, quarantine_directory, error):
+
+        """
+        Record a failed chip and copy its files to the quarantine directory.
+        :param stage: Pipeline stage
+        :param ident: Chip identifier
+        :param files: Chip files to copy
+        :param quarantine_directory: Directory to copy the files to
+        :param error: Exception or message
+        """
+
+        self.add(stage, ident, error)
+        Path(quarantine_directory).mkdir(parents=True, exist_ok=True)
+        for f in files:
+            f = Path(f)
+            if f.is_file():
+                shutil.copy2(f, Path(quarantine_directory).joinpath(f.name))
+
+    def extend(self, failures):
+        self.failures += failures
+
+    def write(self, out_file):
+
+        """
+        Write the report as JSON.
+        :param out_file: Report path
+        :return: Path to report
+        """
+
+        Path(out_file).write_text(json.dumps(self.failures, indent=2))
+        if self.failures:
+            logger.warning(f'{len(self.failures)} failures written to {out_file}')
+
+        return Path(out_file)
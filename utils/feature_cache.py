@@ -0,0 +1,78 @@
+import os
+import hashlib
+import numpy as np
+import torch
+from pathlib import Path
+
+
+def get_key(img):
+
+    """
+    Create cache key from image content.
+    :param img: Numpy array of the pre image
+    :return: Hex digest identifying the image
+    """
+
+    return hashlib.sha1(np.ascontiguousarray(img).tobytes()).hexdigest()
+
+
+class FeatureCache(object):
+
+    """
+    On-disk cache of pre-image results keyed by pre chip content. Localization outputs are stored as uint8 and
+    pre-branch decoder features as fp16. Each entry is one .npy file so that concurrent inference processes can
+    share the cache.
+    """
+
+    def __init__(self, cache_directory):
+        self.cache_directory = Path(cache_directory)
+
+    def get_path(self, kind, key):
+        return self.cache_directory.joinpath(kind).joinpath(f'{key}.npy')
+
+    def has(self, kind, keys):
+
+        """
+        Check that every key is cached.
+        :param kind: Cache namespace (ie. loc34 or cls34_0)
+        :param keys: List of keys
+        :return: True if all keys are cached
+        """
+
+        return all(self.get_path(kind, key).is_file() for key in keys)
+
+    def load(self, kind, keys):
+
+        """
+        Load cached entries as a batch.
+        :param kind: Cache namespace
+        :param keys: List of keys
+        :return: Tensor of stacked entries
+        """
+
+        return torch.stack([torch.from_numpy(np.load(self.get_path(kind, key))) for key in keys])
+
+    def save(self, kind, keys, batch):
+
+        """
+        Save a batch of entries. Floating point entries are stored as fp16.
+        :param kind: Cache namespace
+        :param keys: List of keys
+        :param batch: Tensor with first dimension matching keys
+        :return: True if successful
+        """
+
+        self.cache_directory.joinpath(kind).mkdir(parents=True, exist_ok=True)
+        batch = batch.detach().cpu()
+        if batch.is_floating_point():
+            batch = batch.half()
+
+        for key, arr in zip(keys, batch.numpy()):
+            dest = self.get_path(kind, key)
+            # Write to a temporary file first so readers never see a partial entry
+            tmp = dest.with_suffix(f'.{os.getpid()}.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, dest)
+
+        return True
@@ -1,6 +1,21 @@
 import rasterio
+from collections import defaultdict
 from rasterio.features import shapes
-from shapely.geometry import Polygon, shape
+from shapely.geometry import JOIN_STYLE, Polygon, box, shape
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+def polygonize(arr, transform):
+
+    """
+    Create polygons from a damage array.
+    :param arr: Damage array of (height, width).
+    :param transform: Transform of the array.
+    :return: Shapely polygons and damage values.
+    """
+
+    return [(Polygon(shape(geom)), val) for geom, val in shapes(arr, transform=transform) if val > 0]
+
 
 def create_polys(in_files):
 
@@ -11,12 +26,36 @@ def create_polys(in_files):
     """
 
     polygons = []
-    for idx, f in enumerate(in_files):
-        src = rasterio.open(f)
-        crs = src.crs
-        transform = src.transform
+    for f in in_files:
+        with rasterio.open(f) as src:
+            polygons += polygonize(src.read(1), src.transform)
+
+    return polygons
+
+
+def merge_border_polygons(polygons, tiles, tolerance):
+
+    """
+    Merge polygons split by the borders of the tiles they were created in. Polygons with the same damage value that
+    touch across a border are dissolved into one.
+    :param polygons: Shapely polygons and damage values.
+    :param tiles: Bounds (left, bottom, right, top) of the tiles.
+    :param tolerance: Distance at which polygons touch, ie. a fraction of a pixel.
+    :return: Shapely polygons and damage values.
+    """
+
+    borders = prep(unary_union([box(*b).exterior for b in tiles]).buffer(tolerance))
+
+    merged = []
+    split = defaultdict(list)
+    for poly, val in polygons:
+        if borders.intersects(poly):
+            split[val].append(poly.buffer(tolerance, join_style=JOIN_STYLE.mitre))
+        else:
+            merged.append((poly, val))
 
-        bnd = src.read(1)
-        polys = list(shapes(bnd, transform=transform))
+    for val, polys in split.items():
+        dissolved = unary_union(polys).buffer(-tolerance, join_style=JOIN_STYLE.mitre)
+        merged += [(poly, val) for poly in getattr(dissolved, 'geoms', [dissolved]) if not poly.is_empty]
 
-    return [(Polygon(shape(geom)), val) for geom, val in polys if val > 0]
\ No newline at end of file
+    return merged
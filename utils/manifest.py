@@ -0,0 +1,112 @@
+import json
+import os
+from pathlib import Path
+from loguru import logger
+
+
+def get_identity(in_file):
+
+    """
+    Identify a file by path, size and modification time without reading it.
+    :param in_file: File to identify
+    :return: List of path, size and mtime
+    """
+
+    stat = os.stat(in_file)
+    return [str(Path(in_file).resolve()), stat.st_size, stat.st_mtime_ns]
+
+
+class RunManifest(object):
+
+    """
+    Records the inputs, parameters and output identities of each completed stage of a run so a restarted run with the
+    same arguments can skip completed stages and chips. Outputs are validated against the recorded size and mtime
+    without reading them, so multi-GB mosaics cost a stat.
+    """
+
+    def __init__(self, manifest_file, enabled=True):
+        self.manifest_file = Path(manifest_file)
+        self.enabled = enabled
+        self.stages = {}
+        if enabled and self.manifest_file.is_file():
+            self.stages = json.loads(self.manifest_file.read_text())
+            logger.info(f'Resuming from {len(self.stages)} completed stages in {self.manifest_file}')
+
+    @staticmethod
+    def get_state(out_file):
+        identity = get_identity(out_file)
+        return {'size': identity[1], 'mtime': identity[2]}
+
+    @staticmethod
+    def is_valid(out_file, state):
+
+        """
+        Check that an output file is unchanged since it was recorded.
+        :param out_file: Output file
+        :param state: Recorded state from get_state
+        :return: True if the file is unchanged
+        """
+
+        if not Path(out_file).is_file():
+            return False
+
+        _, size, mtime = get_identity(out_file)
+
+        return size == state['size'] and mtime == state['mtime']
+
+    def get(self, stage, inputs, params):
+
+        """
+        Get the outputs of a completed stage.
+        :param stage: Stage name
+        :param inputs: List of input files
+        :param params: Dict of parameters that affect the outputs
+        :return: Dict of output name to list of paths, or None if the stage has to be run
+        """
+
+        record = self.stages.get(stage)
+        if not self.enabled or record is None:
+            return None
+
+        if record['inputs'] != [get_identity(f) for f in inputs] or record['params'] != json.loads(json.dumps(params)):
+            logger.debug(f'Inputs or parameters changed for {stage}')
+            return None
+
+        if 'states' not in record:
+            logger.debug(f'Outputs of {stage} were recorded by an older version')
+            return None
+
+        for out_file, state in record['states'].items():
+            if not self.is_valid(out_file, state):
+                logger.debug(f'Output {out_file} of {stage} missing or changed')
+                return None
+
+        logger.debug(f'Skipping completed stage {stage}')
+        return {name: [Path(f) for f in files] for name, files in record['outputs'].items()}
+
+    def record(self, stage, inputs, params, outputs):
+
+        """
+        Record a completed stage. Call save to persist.
+        :param stage: Stage name
+        :param inputs: List of input files
+        :param params: Dict of parameters that affect the outputs
+        :param outputs: Dict of output name to list of paths
+        """
+
+        if not self.enabled:
+            return
+
+        outputs = {name: [str(Path(f).resolve()) for f in files] for name, files in outputs.items()}
+        self.stages[stage] = {'inputs': [get_identity(f) for f in inputs],
+                              'params': json.loads(json.dumps(params)),
+                              'outputs': outputs,
+                              'states': {f: self.get_state(f) for files in outputs.values() for f in files}}
+
+    def save(self):
+        if not self.enabled:
+            return
+
+        tmp = self.manifest_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(self.stages))
+        os.replace(tmp, self.manifest_file)
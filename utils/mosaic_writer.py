@@ -0,0 +1,128 @@
+import numpy as np
+import rasterio
+import rasterio.errors
+from rasterio import windows
+from loguru import logger
+
+
+class MosaicWriter(object):
+
+    """
+    Writes chip outputs into a pre-allocated tiled mosaic as they are produced. Blocks that are never written are left
+    sparse so the mosaic only takes space where there are chips. The mosaic is written uncompressed so chips that
+    share a block rewrite it in place, and is compressed once when it is finished. Only the process that owns the
+    writer writes to it so writes from parallel postprocessing are serialized. An unfinished mosaic can be updated so
+    a resumed run keeps the outputs of chips completed earlier.
+    """
+
+    def __init__(self, out_file, profile, block_size=512, compress=None, update=False, mask=False):
+
+        """
+        :param out_file: Destination mosaic. Overwritten if it exists unless update is set.
+        :param profile: Profile with the crs, transform, width, height, count and dtype of the mosaic.
+        :param block_size: Internal tile size.
+        :param compress: Compression. Compressed blocks are rewritten at the end of the file each time a chip
+        is written to them, so leave None unless each chip covers whole blocks.
+        :param update: Write into the existing mosaic. See can_update.
+        :param mask: Mark written chips as valid in an internal mask so areas without chips are transparent, even
+        where the chip is black.
+        """
+
+        if update and self.is_finished(out_file):
+            raise ValueError(f'{out_file} is finished and can not be updated. Rebuild it instead.')
+
+        profile = profile.copy()
+        profile.update(driver='GTiff',
+                       tiled=True,
+                       blockxsize=block_size,
+                       blockysize=block_size,
+                       bigtiff='IF_SAFER',
+                       sparse_ok=True)
+        # Profiles from the input mosaics carry their compression
+        profile.pop('compress', None)
+        profile.pop('predictor', None)
+        if compress is not None:
+            profile.update(compress=compress)
+        self.out_file = out_file
+        self.mask = mask
+        self.dst = rasterio.open(out_file, 'r+') if update else rasterio.open(out_file, 'w', **profile)
+        self.chips = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def is_finished(out_file):
+
+        """
+        Check if a mosaic was compressed or converted to COG
+        :param out_file: Mosaic
+        :return: True if the mosaic is compressed or has overviews
+        """
+
+        with rasterio.open(out_file) as src:
+            return src.compression is not None or bool(src.overviews(1))
+
+    @staticmethod
+    def can_update(out_file, profile):
+
+        """
+        Check that an existing mosaic can be updated in place
+        :param out_file: Mosaic
+        :param profile: Profile the mosaic would be created with
+        :return: True if the mosaic is readable, on the same grid and not finished
+        """
+
+        try:
+            with rasterio.open(out_file) as src:
+                same_grid = (src.crs == profile['crs'] and src.transform == profile['transform'] and
+                             (src.width, src.height, src.count) == (profile['width'], profile['height'], profile['count']))
+            return same_grid and not MosaicWriter.is_finished(out_file)
+        except rasterio.errors.RasterioIOError:
+            return False
+
+    def get_window(self, transform, width, height):
+
+        """
+        Window of the mosaic covered by a chip output
+        :param transform: Transform of the chip output. Must be on the mosaic pixel grid.
+        :param width: Chip output width
+        :param height: Chip output height
+        :return: rasterio window
+        """
+
+        col, row = ~self.dst.transform * (transform.c, transform.f)
+        return windows.Window(int(round(col)), int(round(row)), width, height)
+
+    def write(self, arr, transform):
+
+        """
+        Write a chip output.
+        :param arr: Array of (height, width) or (bands, height, width)
+        :param transform: Transform of the chip output
+        """
+
+        if arr.ndim == 2:
+            arr = arr[np.newaxis]
+        window = self.get_window(transform, arr.shape[2], arr.shape[1])
+        self.dst.write(arr, window=window)
+        if self.mask:
+            with rasterio.Env(GDAL_TIFF_INTERNAL_MASK=True):
+                self.dst.write_mask(np.full(arr.shape[1:], 255, dtype=np.uint8), window=window)
+        self.chips += 1
+
+    def commit(self):
+
+        """
+        Flush written chips to disk by reopening the mosaic, so chips recorded as complete survive a crash.
+        """
+
+        self.dst.close()
+        self.dst = rasterio.open(self.out_file, 'r+')
+
+    def close(self):
+        self.dst.close()
+        logger.debug(f'Wrote {self.chips} chips to {self.out_file}')
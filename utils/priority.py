@@ -0,0 +1,94 @@
+import fiona
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.warp
+from shapely.geometry import Point, shape
+from shapely.ops import unary_union
+from loguru import logger
+
+
+def read_priority_geometries(in_file, dst_crs):
+
+    """
+    Read points or polygons of interest and reproject them to the destination CRS.
+    :param in_file: Vector file readable by fiona (ie. GeoJSON or shapefile)
+    :param dst_crs: Destination CRS
+    :return: Union of the geometries
+    """
+
+    with fiona.open(in_file) as src:
+        src_crs = src.crs_wkt or 'EPSG:4326'
+        geoms = [shape(rasterio.warp.transform_geom(src_crs, rasterio.crs.CRS({'init': dst_crs}), feat['geometry']))
+                 for feat in src]
+
+    assert len(geoms) > 0, logger.critical(f'No features found in {in_file}')
+    logger.debug(f'Read {len(geoms)} priority features from {in_file}')
+
+    return unary_union(geoms)
+
+
+def get_centers(bounds):
+    return [((b[0] + b[2]) / 2, (b[1] + b[3]) / 2) for b in bounds]
+
+
+def distance_priority(bounds, geometry):
+
+    """
+    Priority of each area by distance of its center to the geometry of interest. Areas with their center inside a
+    polygon of interest have distance 0.
+    :param bounds: List of bounds in (left, bottom, right, top)
+    :param geometry: Shapely geometry in the same CRS as the bounds
+    :return: Array of priority keys. Lower is processed first.
+    """
+
+    return np.array([geometry.distance(Point(center)) for center in get_centers(bounds)])
+
+
+def raster_priority(bounds, priority_raster, dst_crs):
+
+    """
+    Priority of each area from the value of a priority raster at its center. Centers outside the raster or on nodata
+    get the lowest priority.
+    :param bounds: List of bounds in (left, bottom, right, top)
+    :param priority_raster: Single band raster where higher values are processed first
+    :param dst_crs: CRS of the bounds
+    :return: Array of priority keys. Lower is processed first.
+    """
+
+    centers = get_centers(bounds)
+    with rasterio.open(priority_raster) as src:
+        xs, ys = rasterio.warp.transform(rasterio.crs.CRS({'init': dst_crs}), src.crs,
+                                         [c[0] for c in centers], [c[1] for c in centers])
+        values = np.array([v[0] for v in src.sample(zip(xs, ys), indexes=1)], dtype='float')
+        left, bottom, right, top = src.bounds
+        outside = (np.array(xs) < left) | (np.array(xs) > right) | (np.array(ys) < bottom) | (np.array(ys) > top)
+        if src.nodata is not None:
+            outside |= values == src.nodata
+
+    values[outside] = -np.inf
+
+    return -values
+
+
+def get_order(bounds, dst_crs, priority_file=None, priority_raster=None):
+
+    """
+    Order areas so those of most interest are processed first. Without a priority file or raster the original order
+    is kept.
+    :param bounds: List of bounds in (left, bottom, right, top)
+    :param dst_crs: CRS of the bounds
+    :param priority_file: Vector file of points or polygons of interest
+    :param priority_raster: Raster where higher values are processed first
+    :return: List of indices into bounds in processing order
+    """
+
+    if priority_file:
+        keys = distance_priority(bounds, read_priority_geometries(priority_file, dst_crs))
+    elif priority_raster:
+        keys = raster_priority(bounds, priority_raster, dst_crs)
+    else:
+        return list(range(len(bounds)))
+
+    # Stable so equal priorities keep their spatial order
+    return [int(i) for i in np.argsort(keys, kind='stable')]
@@ -0,0 +1,167 @@
+import threading
+import torch
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from torch.autograd.profiler import record_function
+from loguru import logger
+
+
+# Module name prefixes of the zoo U-Nets grouped by part of the network
+MODULE_GROUPS = {
+    'encoder': ('conv1', 'conv2', 'conv3', 'conv4', 'conv5'),
+    'decoder': ('conv6', 'conv7', 'conv8', 'conv9', 'conv10'),
+    'head': ('res',),
+}
+
+SUMMARY_KEYS = ['data_wait', 'forward', 'h2d_copy', 'd2h_copy', 'encoder', 'decoder', 'head']
+
+# Set while InferenceProfiler.profile is active. Ranges are not recorded otherwise.
+enabled = False
+
+
+def annotate(name):
+
+    """
+    Record a block as a profiler range while profiling. A no-op context otherwise.
+    :param name: Range name
+    :return: Context manager
+    """
+
+    return record_function(name) if enabled else nullcontext()
+
+
+def timed(loader):
+
+    """
+    Iterate a dataloader and record time spent waiting on it.
+    :param loader: Dataloader
+    :return: Generator of batches
+    """
+
+    it = iter(loader)
+    while True:
+        with annotate('data_wait'):
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+        yield batch
+
+
+def attach_module_hooks(model):
+
+    """
+    Record encoder, decoder and head forward passes of a zoo model as profiler ranges.
+    :param model: Model (or DataParallel wrapped model)
+    :return: List of hook handles
+    """
+
+    net = model.module if isinstance(model, torch.nn.DataParallel) else model
+    handles = []
+
+    for name, module in net.named_children():
+        group = next((g for g, prefixes in MODULE_GROUPS.items() if name.split('_')[0] in prefixes), None)
+        if group is None:
+            continue
+
+        # Siamese models call each module twice per forward, so ranges are kept on a stack. DataParallel replicas
+        # run the same hooks in their own threads, so each thread has its own stack.
+        local = threading.local()
+
+        def pre_hook(mod, inp, group=group, local=local):
+            if not hasattr(local, 'stack'):
+                local.stack = []
+            rf = record_function(group)
+            rf.__enter__()
+            local.stack.append(rf)
+
+        def post_hook(mod, inp, out, local=local):
+            local.stack.pop().__exit__(None, None, None)
+
+        handles.append(module.register_forward_pre_hook(pre_hook))
+        handles.append(module.register_forward_hook(post_hook))
+
+    return handles
+
+
+def device_time(event):
+    # Name of the device time attribute differs between torch versions
+    return getattr(event, 'device_time_total', getattr(event, 'cuda_time_total', 0))
+
+
+class InferenceProfiler(object):
+
+    """
+    Profiles a window of batches in run_inference with the torch profiler. Writes a Chrome trace per model wrapper and
+    logs a top-N operator table along with data wait, copy and per-module totals.
+    """
+
+    def __init__(self, out_dir, start=2, batches=5, top=20):
+        self.out_dir = Path(out_dir)
+        self.start = start
+        self.batches = batches
+        self.top = top
+
+    def trace_ready(self, name):
+
+        def handler(prof):
+            if prof.step_num <= self.start:
+                # Stopped before any batch of the window was recorded
+                return
+
+            self.out_dir.mkdir(parents=True, exist_ok=True)
+            trace = self.out_dir.joinpath(f'{name}.json')
+            prof.export_chrome_trace(str(trace))
+            logger.info(f'Profiler trace for {name} written to {trace}')
+
+            averages = prof.key_averages()
+            sort_by = 'cuda_time_total' if torch.cuda.is_available() else 'cpu_time_total'
+            logger.info(f'Top {self.top} operators for {name}:\n{averages.table(sort_by=sort_by, row_limit=self.top)}')
+
+            totals = {e.key: e for e in averages if e.key in SUMMARY_KEYS}
+            for key in SUMMARY_KEYS:
+                if key in totals:
+                    logger.info(f'{name} {key}: cpu {totals[key].cpu_time_total / 1000:.1f} ms, '
+                                f'device {device_time(totals[key]) / 1000:.1f} ms, calls {totals[key].count}')
+
+        return handler
+
+    @contextmanager
+    def profile(self, name, model_wrapper):
+
+        """
+        Profile a run of inference.
+        :param name: Name of the trace (ie. 34loc)
+        :param model_wrapper: Model wrapper whose models get per-module ranges
+        :return: Context manager yielding the torch profiler. Call step() after each batch.
+        """
+
+        global enabled
+
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        handles = []
+        for model in getattr(model_wrapper, 'models', []):
+            handles += attach_module_hooks(model)
+
+        schedule = torch.profiler.schedule(wait=max(self.start - 1, 0),
+                                           warmup=min(self.start, 1),
+                                           active=self.batches,
+                                           repeat=1)
+        enabled = True
+        try:
+            with torch.profiler.profile(activities=activities,
+                                        schedule=schedule,
+                                        on_trace_ready=self.trace_ready(name)) as prof:
+                yield prof
+        finally:
+            enabled = False
+            for handle in handles:
+                handle.remove()
+
+        if prof.step_num < self.start + self.batches:
+            logger.warning(f'Only {prof.step_num} batches ran for {name}, fewer than the {self.start + self.batches} '
+                           f'needed for the profiling window (profile_start + profile_batches). '
+                           + ('No trace was written.' if prof.step_num <= self.start else 'The trace is partial.'))
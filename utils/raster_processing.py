@@ -1,25 +1,35 @@
+import json
 import random
+import time
 import string
 import subprocess
 import fiona
 import numpy as np
 import rasterio
-import rasterio.merge
 import rasterio.warp
 import rasterio.plot
 import rasterio.crs
+import rasterio.errors
 import handler
 import os
+import cv2
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from rasterio import windows
+from rasterio.enums import MaskFlags
 from rasterio.features import shapes
-from shapely.geometry import shape, mapping
+from shapely.geometry import box, shape, mapping
 from shapely.geometry.polygon import Polygon
+from shapely.ops import unary_union
+from shapely.prepared import prep
 from itertools import product
 from osgeo import gdal
 from tqdm import tqdm
 from pathlib import Path
 from loguru import logger
-from PIL import Image
+
+# Error for inputs with no CRS in their metadata and no CRS override. These are skipped rather than reported.
+NO_CRS = 'No CRS set'
 
 
 def get_reproj_res(pre_files, post_files, args):
@@ -70,7 +80,7 @@ def get_reproj_res(pre_files, post_files, args):
 
 
 # Todo: This should be able to be skipped by passing the res to reproject.
-def reproject(in_file, dest_file, in_crs, dest_crs, res):
+def reproject(in_file, dest_file, in_crs, dest_crs, res, bounds=None, resampling='near'):
 
     """
     Re-project images
@@ -79,88 +89,384 @@ def reproject(in_file, dest_file, in_crs, dest_crs, res):
     :param in_crs: crs of input file -- only valid if image does not contain crs in metadata
     :param dest_crs: destination crs
     :param res: tuple -- output resolution
+    :param bounds: bounds (left, bottom, right, top) in the destination crs to limit the output to
+    :param resampling: warp resampling
     :return: path to re-projected image
     """
 
     input_raster = gdal.Open(str(in_file))
 
+    if input_raster is None:
+        raise ValueError(f'Unable to open {in_file}')
+
     if input_raster.GetSpatialRef() is not None:
         in_crs = input_raster.GetSpatialRef()
 
     if in_crs is None:
-        raise ValueError('No CRS set')
+        raise ValueError(NO_CRS)
+
+    warped = gdal.Warp(str(dest_file), input_raster, dstSRS=dest_crs, srcSRS=in_crs, xRes=res[0], yRes=res[1],
+                       outputBounds=bounds, resampleAlg=resampling)
 
-    gdal.Warp(str(dest_file), input_raster, dstSRS=dest_crs, srcSRS=in_crs, xRes=res[0], yRes=res[1])
+    if warped is None:
+        raise ValueError(f'Warp failed: {gdal.GetLastErrorMsg()}')
+
+    # Flush to disk
+    warped = None
 
     return Path(dest_file).resolve()
 
 
-def create_mosaic(in_files, out_file):
+MOSAIC_CREATION_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+
+
+def get_sources(in_files, in_crs):
+
+    """
+    Check which input files can be warped.
+    :param in_files: list of paths to input files
+    :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+    :return: tuple of list of usable files and list of (file, error) for files that can not be used
+    """
+
+    sources = []
+    errors = []
+    for in_file in in_files:
+        input_raster = gdal.Open(str(in_file))
+        if input_raster is None:
+            errors.append((in_file, f'Unable to open {in_file}'))
+        elif input_raster.GetSpatialRef() is None and not in_crs:
+            errors.append((in_file, NO_CRS))
+        else:
+            sources.append(in_file)
+        input_raster = None
+
+    return sources, errors
+
+
+def warp_mosaic(in_files, out_file, in_crs, dest_crs, res, warp_memory=2048, threads='ALL_CPUS', bounds=None):
+
+    """
+    Re-project and mosaic input files in a single multithreaded warp, without intermediate files or holding the
+    mosaic in memory.
+    :param in_files: list of paths to input files. See get_sources.
+    :param out_file: path to output mosaic
+    :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+    :param dest_crs: destination crs
+    :param res: tuple -- output resolution
+    :param warp_memory: warp buffer size in MB
+    :param threads: number of warp and compression threads or ALL_CPUS
+    :param bounds: bounds (left, bottom, right, top) in the destination crs to limit the output to
+    :return: path to output file
+    """
+
+    # srcSRS overrides the CRS of every source so it is only passed when the files have none
+    first = gdal.Open(str(in_files[0]))
+    src_srs = in_crs if first.GetSpatialRef() is None else None
+    first = None
+
+    options = gdal.WarpOptions(format='GTiff',
+                               srcSRS=src_srs,
+                               dstSRS=dest_crs,
+                               xRes=res[0],
+                               yRes=res[1],
+                               outputBounds=bounds,
+                               multithread=True,
+                               warpMemoryLimit=warp_memory,
+                               warpOptions=[f'NUM_THREADS={threads}'],
+                               creationOptions=MOSAIC_CREATION_OPTIONS + [f'NUM_THREADS={threads}'])
+
+    warped = gdal.Warp(str(out_file), [str(f) for f in in_files], options=options)
+
+    if warped is None:
+        raise ValueError(f'Warp failed: {gdal.GetLastErrorMsg()}')
+
+    logger.debug(f'Mosaic warped from {len(in_files)} files at {out_file} with resolution: {res}')
+
+    # Flush to disk
+    warped = None
+
+    return Path(out_file).resolve()
+
+
+def get_bounds_index(in_files):
+
+    """
+    Reads bounds of input files without keeping them open.
+    :param in_files: list of paths to input files
+    :return: tuple of array of bounds (left, bottom, right, top) per file and meta of the first file
+    """
+
+    bounds = []
+    for idx, f in enumerate(in_files):
+        with rasterio.open(f) as src:
+            bounds.append(tuple(src.bounds))
+            if idx == 0:
+                meta = src.meta.copy()
+                res = src.res
+
+    return np.array(bounds), meta, res
+
+
+def read_block(in_files, index, block, out_transform, meta):
+
+    """
+    Fills one block of a mosaic from the sources that intersect it. Earlier sources take precedence where sources
+    overlap, as with rasterio.merge.
+    :param in_files: list of paths to input files
+    :param index: array of source bounds from get_bounds_index
+    :param block: window of the block in the mosaic
+    :param out_transform: transform of the mosaic
+    :param meta: meta of the mosaic
+    :return: tuple of block window and array
+    """
+
+    left, bottom, right, top = windows.bounds(block, out_transform)
+    hits = np.flatnonzero((index[:, 0] < right) & (index[:, 2] > left) & (index[:, 1] < top) & (index[:, 3] > bottom))
+
+    out = np.zeros((meta['count'], block.height, block.width), dtype=meta['dtype'])
+    if meta['nodata'] is not None:
+        out.fill(meta['nodata'])
+    filled = np.zeros(out.shape, dtype=bool)
+
+    for idx in hits:
+        with rasterio.open(in_files[idx]) as src:
+            src_bounds = (max(left, src.bounds.left), max(bottom, src.bounds.bottom),
+                          min(right, src.bounds.right), min(top, src.bounds.top))
+            dst_window = windows.from_bounds(*src_bounds, out_transform).round_offsets().round_lengths()
+            if dst_window.width < 1 or dst_window.height < 1 or not windows.intersect(dst_window, block):
+                continue
+            dst_window = dst_window.intersection(block)
+            row_off, col_off = int(dst_window.row_off - block.row_off), int(dst_window.col_off - block.col_off)
+            h, w = int(dst_window.height), int(dst_window.width)
+            src_window = src.window(*windows.bounds(dst_window, out_transform))
+            data = src.read(window=src_window, out_shape=(meta['count'], h, w), masked=True)
+
+        rows = slice(row_off, row_off + h)
+        cols = slice(col_off, col_off + w)
+        region = ~filled[:, rows, cols] & ~np.ma.getmaskarray(data)
+        out[:, rows, cols][region] = data.data[region]
+        filled[:, rows, cols] |= region
+
+    return block, out
+
+
+def create_mosaic(in_files, out_file, block_size=2048, workers=4):
 
     """
-    Creates mosaic from in_files.
+    Creates mosaic from in_files. The output is filled block by block so memory is bounded by the block size and
+    only the sources intersecting each block are opened.
     :param in_files: list of paths to input files
     :param out_file: path to output mosaic
+    :param block_size: edge length of the blocks filled at a time. A multiple of the 512 tile size.
+    :param workers: number of threads reading blocks
     :return: path to output file
     """
 
-    # This is some hacky, dumb shit
-    # There is a limit on how many file descriptors we can have open at once
-    # So we will up that limit for a bit and then set it back
-    if os.name == 'posix':
-        import resource
-        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-        if len(in_files) >= soft:
-            new_limit = len(in_files) * 2
-            resource.setrlimit(resource.RLIMIT_NOFILE, (new_limit, hard))
-            logger.debug(f'Hard limit changed from: {hard} to {new_limit}')
-            logger.debug(f'Soft limit: {soft}')
-    elif os.name == 'nt':
-        import win32file
-        soft = win32file._getmaxstdio()
-        if len(in_files) >= soft:
-            new_limit = len(in_files) * 2
-            win32file._setmaxstdio(new_limit)
-            logger.debug(f'Limit changed from {soft} to {new_limit}')
-
-    file_objs = []
-
-    for file in in_files:
-        src = rasterio.open(file)
-        file_objs.append(src)
-
-    mosaic, out_trans = rasterio.merge.merge(file_objs)
-
-    out_meta = src.meta.copy()
-
-    out_meta.update({"driver": "GTiff",
-                     "height": mosaic.shape[1],
-                     "width": mosaic.shape[2],
-                     "transform": out_trans
-                     }
-                    )
-
-    with rasterio.open(out_file, "w", **out_meta) as dest:
-        dest.write(mosaic)
+    index, meta, res = get_bounds_index(in_files)
+
+    # Output grid from the union of the source bounds at the resolution of the first source
+    left, bottom = index[:, 0].min(), index[:, 1].min()
+    right, top = index[:, 2].max(), index[:, 3].max()
+    out_transform = rasterio.transform.from_origin(left, top, res[0], res[1])
+    width = int(round((right - left) / res[0]))
+    height = int(round((top - bottom) / res[1]))
+
+    meta.update({"driver": "GTiff",
+                 "height": height,
+                 "width": width,
+                 "transform": out_transform,
+                 "tiled": True,
+                 "blockxsize": 512,
+                 "blockysize": 512,
+                 "compress": "deflate",
+                 "BIGTIFF": "IF_SAFER"
+                 }
+                )
+
+    full = windows.Window(0, 0, width, height)
+    blocks = [windows.Window(col, row, block_size, block_size).intersection(full)
+              for row in range(0, height, block_size) for col in range(0, width, block_size)]
+
+    # Blocks are read in parallel threads and written from this thread. Submitting a few blocks at a time keeps
+    # memory bounded when writing is slower than reading.
+    with rasterio.open(out_file, "w", **meta) as dest, ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(blocks), workers * 2):
+            for block, arr in executor.map(lambda b: read_block(in_files, index, b, out_transform, meta),
+                                           blocks[start:start + workers * 2]):
+                dest.write(arr, window=block)
         logger.debug(f'Mosaic created at {out_file} with resolution: {dest.res}')
 
-    # Reset soft limit
-    if os.name == 'posix':
-        import resource
-        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
-        if len(in_files) >= soft:
-            # Todo: this doesn't seem correct
-            resource.setrlimit(resource.RLIMIT_NOFILE, (len(in_files) * 2, hard))
-    elif os.name == 'nt':
-        import win32file
-        soft = win32file._getmaxstdio()
-        if len(in_files) >= soft:
-            win32file._setmaxstdio(len(in_files) * 2)
-    # Todo: log limit reset
+    return Path(out_file).resolve()
+
+
+def create_vrt(in_files, out_file):
+
+    """
+    Creates a virtual mosaic referencing in_files. Nothing is read, so this is instant and uses no memory.
+    :param in_files: list of paths to input files
+    :param out_file: path to output VRT
+    :return: path to output file
+    """
+
+    vrt = gdal.BuildVRT(str(out_file), [str(f) for f in in_files])
+
+    if vrt is None:
+        raise ValueError(f'Unable to build VRT: {gdal.GetLastErrorMsg()}')
+
+    logger.debug(f'VRT of {len(in_files)} files created at {out_file}')
+
+    # Flush to disk
+    vrt = None
+
+    return Path(out_file).resolve()
+
+
+def create_cog(in_file, out_file, resampling='average', threads='ALL_CPUS'):
+
+    """
+    Materializes a raster (ie. a VRT) as a Cloud-Optimized GeoTIFF with internal overviews.
+    :param in_file: path to input raster
+    :param out_file: path to output COG
+    :param resampling: overview resampling. Use nearest for categorical rasters.
+    :param threads: number of compression threads or ALL_CPUS
+    :return: path to output file
+    """
+
+    if gdal.GetDriverByName('COG') is not None:
+        cog = gdal.Translate(str(out_file), str(in_file), format='COG',
+                             creationOptions=['COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', f'NUM_THREADS={threads}',
+                                              f'RESAMPLING={resampling.upper()}', 'OVERVIEWS=AUTO'])
+        if cog is None:
+            raise ValueError(f'Unable to create COG: {gdal.GetLastErrorMsg()}')
+        cog = None
+
+    else:
+        # GDAL < 3.1 has no COG driver. Build overviews on a temporary tiled GeoTIFF and copy them in front of the data.
+        tmp_file = Path(out_file).with_suffix('.tmp.tif')
+        tmp = gdal.Translate(str(tmp_file), str(in_file), format='GTiff',
+                             creationOptions=MOSAIC_CREATION_OPTIONS + [f'NUM_THREADS={threads}'])
+        if tmp is None:
+            raise ValueError(f'Unable to create COG: {gdal.GetLastErrorMsg()}')
+        tmp.BuildOverviews(resampling.upper(), get_overview_levels(tmp.RasterXSize, tmp.RasterYSize))
+        cog = gdal.Translate(str(out_file), tmp, format='GTiff',
+                             creationOptions=MOSAIC_CREATION_OPTIONS + ['COPY_SRC_OVERVIEWS=YES', f'NUM_THREADS={threads}'])
+        tmp = None
+        cog = None
+        gdal.GetDriverByName('GTiff').Delete(str(tmp_file))
+
+    logger.debug(f'COG created at {out_file}')
 
     return Path(out_file).resolve()
 
 
+def get_overview_levels(width, height, min_size=256):
+
+    """
+    Calculates overview decimation levels down to the size of a single block.
+    :param width: raster width
+    :param height: raster height
+    :param min_size: smallest overview edge length
+    :return: list of decimation factors
+    """
+
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+
+    return levels
+
+
+def build_overviews(in_file, resampling='average', threads='ALL_CPUS', min_size=256):
+
+    """
+    Builds internal overviews of a GeoTIFF in place with levels from its size. Overview levels are computed in
+    parallel on GDAL >= 3.2.
+    :param in_file: path to GeoTIFF
+    :param resampling: overview resampling. Use nearest for categorical rasters.
+    :param threads: number of overview and compression threads or ALL_CPUS
+    :param min_size: smallest overview edge length
+    :return: list of decimation factors
+    """
+
+    ds = gdal.Open(str(in_file), gdal.GA_Update)
+    if ds is None:
+        raise ValueError(f'Unable to open {in_file}: {gdal.GetLastErrorMsg()}')
+
+    levels = get_overview_levels(ds.RasterXSize, ds.RasterYSize, min_size)
+    gdal.SetConfigOption('GDAL_NUM_THREADS', str(threads))
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+    try:
+        if levels and ds.BuildOverviews(resampling.upper(), levels) != 0:
+            raise ValueError(f'Unable to build overviews: {gdal.GetLastErrorMsg()}')
+    finally:
+        gdal.SetConfigOption('GDAL_NUM_THREADS', None)
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+        # Flush to disk
+        ds = None
+
+    logger.debug(f'Overviews {levels} built for {in_file}')
+
+    return levels
+
+
+def convert_to_cog(in_file, resampling='average', threads='ALL_CPUS'):
+
+    """
+    Rewrites a tiled GeoTIFF mosaic in place as a Cloud-Optimized GeoTIFF. Overviews are built on the mosaic first so
+    the COG keeps the levels from get_overview_levels and only the copy is left to the COG driver.
+    :param in_file: path to GeoTIFF
+    :param resampling: overview resampling. Use nearest for categorical rasters.
+    :param threads: number of overview and compression threads or ALL_CPUS
+    :return: path to output file
+    """
+
+    build_overviews(in_file, resampling, threads)
+
+    tmp_file = Path(in_file).with_suffix('.cog.tif')
+    if gdal.GetDriverByName('COG') is not None:
+        cog = gdal.Translate(str(tmp_file), str(in_file), format='COG',
+                             creationOptions=['COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER', f'NUM_THREADS={threads}',
+                                              f'RESAMPLING={resampling.upper()}', 'OVERVIEWS=AUTO'])
+    else:
+        cog = gdal.Translate(str(tmp_file), str(in_file), format='GTiff',
+                             creationOptions=MOSAIC_CREATION_OPTIONS + ['COPY_SRC_OVERVIEWS=YES', f'NUM_THREADS={threads}'])
+    if cog is None:
+        raise ValueError(f'Unable to create COG: {gdal.GetLastErrorMsg()}')
+    # Flush to disk
+    cog = None
+
+    os.replace(tmp_file, in_file)
+    logger.debug(f'{in_file} converted to COG')
+
+    return Path(in_file).resolve()
+
+
+def compress_mosaic(in_file, threads='ALL_CPUS'):
+
+    """
+    Rewrites an uncompressed tiled mosaic in place with MOSAIC_CREATION_OPTIONS
+    :param in_file: path to GeoTIFF
+    :param threads: number of compression threads or ALL_CPUS
+    :return: path to output file
+    """
+
+    tmp_file = Path(in_file).with_suffix('.compressed.tif')
+    out = gdal.Translate(str(tmp_file), str(in_file), format='GTiff',
+                         creationOptions=MOSAIC_CREATION_OPTIONS + ['SPARSE_OK=YES', f'NUM_THREADS={threads}'])
+    if out is None:
+        raise ValueError(f'Unable to compress mosaic: {gdal.GetLastErrorMsg()}')
+    # Flush to disk
+    out = None
+
+    os.replace(tmp_file, in_file)
+    logger.debug(f'{in_file} compressed')
+
+    return Path(in_file).resolve()
+
+
 def get_intersect(pre_mosaic, post_mosaic):
 
     """
@@ -187,6 +493,183 @@ def get_intersect(pre_mosaic, post_mosaic):
         return intersect
 
 
+def get_coverage(in_raster, max_size=1024):
+
+    """
+    Computes the area of a raster with valid data from its mask read at overview resolution. Pixels are valid if
+    they are not masked or, for rasters without nodata or alpha, if any band is non-zero.
+    :param in_raster: raster file
+    :param max_size: size in pixels of the longest side of the mask
+    :return: shapely geometry of the valid area in the raster CRS
+    """
+
+    with rasterio.open(in_raster) as src:
+        scale = max(src.width / max_size, src.height / max_size, 1)
+        out_shape = (max(int(src.height / scale), 1), max(int(src.width / scale), 1))
+        if all(MaskFlags.all_valid in flags for flags in src.mask_flag_enums):
+            valid = np.any(src.read(out_shape=(src.count, *out_shape)) != 0, axis=0)
+        else:
+            valid = src.dataset_mask(out_shape=out_shape) > 0
+        transform = src.transform * rasterio.Affine.scale(src.width / out_shape[1], src.height / out_shape[0])
+
+    polys = [shape(geom) for geom, _ in shapes(valid.astype(np.uint8), mask=valid, transform=transform)]
+    if not polys:
+        return Polygon()
+
+    # Decimated reads can miss narrow strips of data so the coverage is grown by a mask pixel
+    return unary_union(polys).buffer(max(abs(transform.a), abs(transform.e)))
+
+
+def get_coverage_intersect(pre_mosaic, post_mosaic, max_size=1024):
+
+    """
+    Computes the area where both mosaics have valid data. See get_coverage.
+    :param pre_mosaic: pre mosaic
+    :param post_mosaic: post mosaic
+    :param max_size: size in pixels of the longest side of each mask
+    :return: shapely geometry of the valid intersect
+    """
+
+    coverage = get_coverage(pre_mosaic, max_size).intersection(get_coverage(post_mosaic, max_size))
+    logger.debug(f'Coverage intersect bounds: {coverage.bounds}')
+
+    return coverage
+
+
+def get_footprints(in_files, in_crs, dst_crs):
+
+    """
+    Computes bounds of input rasters in the destination CRS without reprojecting them.
+    :param in_files: list of rasters
+    :param in_crs: crs of input files -- only valid if images do not contain crs in metadata
+    :param dst_crs: destination crs
+    :return: list of (file, bounds) with bounds in (left, bottom, right, top). Unreadable and non-geospatial files are
+    skipped.
+    """
+
+    footprints = []
+    for f in in_files:
+        try:
+            src = rasterio.open(f)
+        except rasterio.errors.RasterioIOError:
+            logger.debug(f'Skipping unreadable {f}')
+            continue
+
+        with src:
+            if src.crs:
+                src_crs = src.crs
+            elif in_crs:
+                src_crs = rasterio.crs.CRS({'init': in_crs})
+            else:
+                logger.debug(f'Skipping {f} with no CRS')
+                continue
+
+            bounds = rasterio.warp.transform_bounds(src_crs, rasterio.crs.CRS({'init': dst_crs}), *src.bounds, densify_pts=21)
+        footprints.append((f, bounds))
+
+    return footprints
+
+
+def get_footprint_intersect(pre_footprints, post_footprints):
+
+    """
+    Computes intersect of the union of pre footprints and the union of post footprints.
+    :param pre_footprints: list of (file, bounds) from get_footprints
+    :param post_footprints: list of (file, bounds) from get_footprints
+    :return: tuple of intersect in (left, bottom, right, top)
+    """
+
+    def union(footprints):
+        bounds = np.array([b for _, b in footprints])
+        return bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+
+    pre, post = union(pre_footprints), union(post_footprints)
+    intersect = tuple(float(x) for x in (max(pre[0], post[0]), max(pre[1], post[1]), min(pre[2], post[2]), min(pre[3], post[3])))
+    assert intersect[0] < intersect[2] and intersect[1] < intersect[3], logger.error('Input rasters do not intersect')
+    logger.debug(f'Calculated footprint intersect: {intersect}')
+
+    return intersect
+
+
+def get_super_tiles(intersect, width, height):
+
+    """
+    Splits bounds into a grid of super-tiles. Edge tiles are clipped to the bounds.
+    :param intersect: bounds to split in (left, bottom, right, top)
+    :param width: super-tile width in units of the bounds
+    :param height: super-tile height in units of the bounds
+    :return: list of super-tile bounds in (left, bottom, right, top), row major from the top left
+    """
+
+    left, bottom, right, top = intersect
+    tiles = []
+    for row_top in np.arange(top, bottom, -height):
+        for col_left in np.arange(left, right, width):
+            tiles.append((float(col_left),
+                          float(max(row_top - height, bottom)),
+                          float(min(col_left + width, right)),
+                          float(row_top)))
+
+    return tiles
+
+
+def snap_bounds(bounds, res):
+
+    """
+    Expands bounds to the global pixel grid of a resolution, like gdalwarp -tap, so rasters warped separately (ie. by
+    different super-tile workers) line up when stitched.
+    :param bounds: bounds in (left, bottom, right, top)
+    :param res: tuple -- resolution
+    :return: snapped bounds in (left, bottom, right, top)
+    """
+
+    # Tolerance keeps bounds already on the grid from growing a pixel through floating point error
+    eps = 1e-6
+    x_res, y_res = abs(res[0]), abs(res[1])
+
+    return (float(np.floor(bounds[0] / x_res + eps) * x_res),
+            float(np.floor(bounds[1] / y_res + eps) * y_res),
+            float(np.ceil(bounds[2] / x_res - eps) * x_res),
+            float(np.ceil(bounds[3] / y_res - eps) * y_res))
+
+
+def get_warp_bounds(footprint, clip, res):
+
+    """
+    Bounds to warp an input to: its footprint limited to the clip and snapped to the pixel grid
+    :param footprint: bounds of the input in the destination crs
+    :param clip: bounds on the pixel grid to limit the output to (ie. a super-tile)
+    :param res: tuple -- resolution
+    :return: bounds in (left, bottom, right, top)
+    """
+
+    return clip_bounds(snap_bounds(clip_bounds(footprint, clip), res), clip)
+
+
+def bounds_intersect(a, b):
+
+    """
+    Checks if two bounds overlap.
+    :param a: bounds in (left, bottom, right, top)
+    :param b: bounds in (left, bottom, right, top)
+    :return: True if the bounds overlap
+    """
+
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def clip_bounds(a, b):
+
+    """
+    Computes the overlap of two bounds.
+    :param a: bounds in (left, bottom, right, top)
+    :param b: bounds in (left, bottom, right, top)
+    :return: overlapping bounds in (left, bottom, right, top). Check bounds_intersect first.
+    """
+
+    return max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3])
+
+
 def check_dims(arr, w, h):
     """
     Check dimensions of output tiles and pad
@@ -206,16 +689,50 @@ def check_dims(arr, w, h):
     return result 
 
 
-def create_chips(in_raster, out_dir, intersect, tile_width=1024, tile_height=1024):
+def get_axis_layout(start, length, size, anchor=0, shift_edges=False):
 
     """
-    Creates chips from mosaic that fall inside the intersect
-    :param in_raster: mosaic to create chips from
-    :param out_dir: path to write chips
+    Lay out chips along one axis of the intersect window
+    :param start: first pixel of the intersect
+    :param length: number of pixels in the intersect
+    :param size: chip size
+    :param anchor: offset of the first grid line from start. Pixels before it form a partial first chip.
+    :param shift_edges: shift partial chips inside the intersect so they read real pixels instead of padding
+    :return: list of (window offset, window length, crop offset, crop length). Crops are relative to the window
+    and partition the intersect so overlapping chips each own a separate part of it.
+    """
+
+    end = start + length
+    lines = [start] + list(range(start + (anchor or size), end, size)) + [end]
+
+    layout = []
+    for cell_start, cell_end in zip(lines[:-1], lines[1:]):
+        if shift_edges:
+            offset = max(start, min(cell_start, end - size))
+            window_length = min(size, length)
+        else:
+            offset = cell_start
+            window_length = min(size, end - cell_start)
+        layout.append((offset, window_length, cell_start - offset, cell_end - cell_start))
+
+    return layout
+
+
+def get_chip_windows(in_raster, intersect, tile_width=1024, tile_height=1024, coverage=None, anchor=(0, 0),
+                     shift_edges=False):
+
+    """
+    Plans chips from mosaic that fall inside the intersect without reading them
+    :param in_raster: mosaic to plan chips from
     :param intersect: bounds of chips to create
     :param tile_width: width of tiles to chip
     :param tile_height: height of tiles to chip
-    :return: list of path to chips
+    :param coverage: optional shapely geometry of valid data. Chips outside it are left out.
+    :param anchor: column and row offset of the chip grid from the intersect corner. See plan_chip_layout.
+    :param shift_edges: shift the ragged right and bottom chips (and the first chips with an anchor) inside the
+    intersect so they read real pixels instead of zero padding. Overlapping chips own separate crops.
+    :return: list of (index, window, transform, crop) for each chip. Index is the position of the chip in the full
+    grid. crop is the (col_off, row_off, width, height) of the part of the chip that it produces outputs for.
     """
 
     def get_intersect_win(rio_obj):
@@ -235,53 +752,422 @@ def create_chips(in_raster, out_dir, intersect, tile_width=1024, tile_height=102
 
         return int_window
 
-    def get_tiles(ds, width, height):
+    chips = []
+    valid = prep(coverage) if coverage is not None else None
 
-        """
-        Create chip tiles generator
-        :param ds: rasterio dataset
-        :param width: tile width
-        :param height: tile height
-        :return: generator of rasterio windows and transforms for each tile to be created
-        """
+    with rasterio.open(in_raster) as inds:
+        intersect_window = get_intersect_win(inds)
+        cols = get_axis_layout(int(intersect_window.col_off), int(intersect_window.width), tile_width, anchor[0], shift_edges)
+        rows = get_axis_layout(int(intersect_window.row_off), int(intersect_window.height), tile_height, anchor[1], shift_edges)
 
-        intersect_window = get_intersect_win(ds)
-        offsets = product(range(intersect_window.col_off, intersect_window.width + intersect_window.col_off, width),
-                          range(intersect_window.row_off, intersect_window.height + intersect_window.row_off, height))
-        for col_off, row_off in offsets:
-            window = windows.Window(col_off=col_off, row_off=row_off, width=width, height=height).intersection(intersect_window)
-            transform = windows.transform(window, ds.transform)
-            yield window, transform
+        for idx, (col, row) in enumerate(product(cols, rows)):
+            window = windows.Window(col_off=col[0], row_off=row[0], width=col[1], height=row[1])
+            crop = (col[2], row[2], col[3], row[3])
+
+            # Chips keep their grid index so pre and post chips still pair up when some are skipped
+            cell = windows.Window(col[0] + crop[0], row[0] + crop[1], crop[2], crop[3])
+            if valid is not None and not valid.intersects(box(*windows.bounds(cell, inds.transform))):
+                continue
+
+            chips.append((idx, window, windows.transform(window, inds.transform), crop))
+
+    return chips
+
+
+def get_layout_area(chips, tile_width=1024, tile_height=1024):
+
+    """
+    Pixel area inferred for a chip layout
+    :param chips: list from get_chip_windows
+    :return: tuple of inferred pixels and zero padded pixels
+    """
+
+    inferred = len(chips) * tile_width * tile_height
+    return inferred, inferred - sum(int(window.width * window.height) for _, window, _, _ in chips)
+
+
+def plan_chip_layout(in_raster, intersect, tile_width=1024, tile_height=1024, coverage=None, steps=4):
+
+    """
+    Choose the chip grid anchor that needs the fewest chips to cover the valid data, with edge chips shifted inside
+    the intersect. Without coverage this is the intersect corner. Logs the inferred area against the plain grid.
+    :param in_raster: mosaic to plan chips from
+    :param intersect: bounds of chips to create
+    :param tile_width: width of tiles to chip
+    :param tile_height: height of tiles to chip
+    :param coverage: optional shapely geometry of valid data
+    :param steps: number of anchors tried along each axis
+    :return: tuple of column and row anchor for get_chip_windows
+    """
+
+    candidates = list(product(range(0, tile_width, tile_width // steps), range(0, tile_height, tile_height // steps)))
+    layouts = {anchor: get_chip_windows(in_raster, intersect, tile_width, tile_height, coverage, anchor, shift_edges=True)
+               for anchor in candidates}
+    # Ties keep the corner anchor
+    anchor = min(candidates, key=lambda a: len(layouts[a]))
+
+    grid = get_chip_windows(in_raster, intersect, tile_width, tile_height, coverage)
+    before, before_padding = get_layout_area(grid, tile_width, tile_height)
+    after, after_padding = get_layout_area(layouts[anchor], tile_width, tile_height)
+    logger.info(f'Chip layout: {len(layouts[anchor])} chips with anchor {anchor} infer {after} pixels '
+                f'({after_padding / max(after, 1):.1%} padding), '
+                f'plain grid: {len(grid)} chips infer {before} pixels ({before_padding / max(before, 1):.1%} padding)')
+
+    return anchor
+
+
+# Chip compression choices. Predictor 2 (horizontal differencing) helps all three on imagery.
+CHIP_COMPRESSION = ['deflate', 'lzw', 'zstd', 'none']
 
-    chips = []
+
+def get_chip_creation_options(compress='deflate', block_size=256):
+
+    """
+    Get GeoTIFF creation options for chips
+    :param compress: one of CHIP_COMPRESSION. none writes striped, uncompressed chips.
+    :param block_size: internal tile size
+    :return: dict of creation options
+    """
+
+    if compress == 'none':
+        return {}
+
+    return {'tiled': True, 'blockxsize': block_size, 'blockysize': block_size, 'compress': compress, 'predictor': 2}
+
+
+def write_chip(inds, window, out_file, tile_width=1024, tile_height=1024, creation_options=None):
+
+    """
+    Write a chip window of an open mosaic padded to the chip size
+    :param inds: rasterio dataset of the mosaic
+    :param window: rasterio window of the chip
+    :param out_file: path to write the chip
+    :param tile_width: width of tiles to chip
+    :param tile_height: height of tiles to chip
+    :param creation_options: optional dict of creation options (see get_chip_creation_options)
+    :return: path to chip
+    """
+
+    out_arr, meta = read_chip(inds, window, tile_width, tile_height, creation_options)
+    with rasterio.open(out_file, 'w', **meta) as outds:
+        outds.write(out_arr)
+
+    return Path(out_file).resolve()
+
+
+def read_chip(inds, window, tile_width=1024, tile_height=1024, creation_options=None):
+
+    """
+    Read a chip window of an open mosaic padded to the chip size
+    :param inds: rasterio dataset of the mosaic
+    :param window: rasterio window of the chip
+    :param tile_width: width of tiles to chip
+    :param tile_height: height of tiles to chip
+    :param creation_options: optional dict of creation options (see get_chip_creation_options)
+    :return: tuple of chip array and chip profile
+    """
+
+    meta = inds.meta.copy()
+    meta['transform'] = windows.transform(window, inds.transform)
+    meta['width'], meta['height'] = tile_width, tile_height
+    meta.update(creation_options or {})
+
+    chip_arr = inds.read(window=window)
+    out_arr = check_dims(chip_arr, tile_width, tile_height)
+    assert(out_arr.shape[1] == tile_width), logger.error('Tile dimensions not correct')
+    assert(out_arr.shape[2] == tile_height), logger.error('Tile dimensions not correct')
+
+    return out_arr, meta
+
+
+def get_valid_fraction(arr, nodata=None):
+
+    """
+    Fraction of pixels with data in any band
+    :param arr: array of (bands, height, width)
+    :param nodata: nodata value. 0 is treated as nodata if None.
+    :return: float from 0 to 1
+    """
+
+    return float(np.any(arr != (0 if nodata is None else nodata), axis=0).mean())
+
+
+def write_chips(in_raster, out_dir, chips, tile_width=1024, tile_height=1024, creation_options=None):
+
+    """
+    Write planned chips of a mosaic with one open dataset
+    :param in_raster: mosaic to create chips from
+    :param out_dir: path to write chips
+    :param chips: list from get_chip_windows
+    :return: list of path to chips
+    """
 
     with rasterio.open(in_raster) as inds:
+        return [write_chip(inds, window, out_dir.joinpath(f'{idx}_{out_dir.parts[-1]}.tif'), tile_width, tile_height,
+                           creation_options)
+                for idx, window, _, _ in chips]
 
-        meta = inds.meta.copy()
 
-        for idx, (window, transform) in enumerate(tqdm(get_tiles(inds, tile_width, tile_height))):
-            meta['transform'] = transform
-            meta['width'], meta['height'] = tile_width, tile_height
-            output_filename = f'{idx}_{out_dir.parts[-1]}.tif'
-            outpath = out_dir.joinpath(output_filename)
+def create_chips(in_raster, out_dir, intersect, tile_width=1024, tile_height=1024, coverage=None,
+                 creation_options=None, workers=4, chunk_size=32):
 
-            with rasterio.open(outpath, 'w', **meta) as outds:
-                chip_arr = inds.read(window=window)
-                out_arr = check_dims(chip_arr, tile_width, tile_height)
-                assert(out_arr.shape[1] == tile_width), logger.error('Tile dimensions not correct')
-                assert(out_arr.shape[2] == tile_height), logger.error('Tile dimensions not correct')
+    """
+    Creates chips from mosaic that fall inside the intersect
+    :param in_raster: mosaic to create chips from
+    :param out_dir: path to write chips
+    :param intersect: bounds of chips to create
+    :param tile_width: width of tiles to chip
+    :param tile_height: height of tiles to chip
+    :param coverage: optional shapely geometry of valid data. Chips outside it are not read or written.
+    :param creation_options: optional dict of creation options (see get_chip_creation_options)
+    :param workers: number of writer threads. GDAL releases the GIL while reading, compressing and writing.
+    :param chunk_size: number of chips written by a thread with one open dataset
+    :return: list of path to chips
+    """
 
-                outds.write(out_arr)
+    plan = get_chip_windows(in_raster, intersect, tile_width, tile_height, coverage)
+    chunks = [plan[start:start + chunk_size] for start in range(0, len(plan), chunk_size)]
 
-            chips.append(outpath.resolve())
+    chips = []
+    # Datasets can not be shared between threads so each chunk opens the mosaic
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for written in tqdm(executor.map(lambda chunk: write_chips(in_raster, out_dir, chunk, tile_width, tile_height,
+                                                                   creation_options), chunks),
+                            total=len(chunks)):
+            chips += written
 
     return chips
 
 
+# A planned or written chip pair. pre and post are chip files, or the mosaics when windows are set. valid is the
+# smaller fraction of pixels with data of the two chips, or None if they were not read.
+# crop is the part of the chip that it produces outputs for (see get_chip_windows).
+ChipRecord = namedtuple('ChipRecord', ['ident', 'pre', 'post', 'windows', 'profile', 'valid', 'crop'])
+
+
+def write_chip_pairs(pre_mosaic, post_mosaic, out_dir, chips, tile_width=1024, tile_height=1024, creation_options=None):
+
+    """
+    Write planned chip pairs with one open dataset per mosaic. Pairs that are empty in either mosaic are not written.
+    :param pre_mosaic: pre mosaic
+    :param post_mosaic: post mosaic
+    :param out_dir: path to write chips. Chips are written to pre and post subdirectories.
+    :param chips: list of (index, pre window, post window, crop)
+    :return: list of ChipRecord of written chips
+    """
+
+    def get_crop(arr, crop):
+        return arr[:, crop[1]:crop[1] + crop[3], crop[0]:crop[0] + crop[2]]
+
+    records = []
+    with rasterio.open(pre_mosaic) as pre_ds, rasterio.open(post_mosaic) as post_ds:
+        for idx, pre_window, post_window, crop in chips:
+            # Only the part of the chip it produces outputs for counts
+            pre_arr, pre_meta = read_chip(pre_ds, pre_window, tile_width, tile_height, creation_options)
+            pre_valid = get_valid_fraction(get_crop(pre_arr, crop), pre_ds.nodata)
+            if pre_valid == 0:
+                continue
+
+            post_arr, post_meta = read_chip(post_ds, post_window, tile_width, tile_height, creation_options)
+            post_valid = get_valid_fraction(get_crop(post_arr, crop), post_ds.nodata)
+            if post_valid == 0:
+                continue
+
+            files = []
+            for pre_post, arr, meta in (('pre', pre_arr, pre_meta), ('post', post_arr, post_meta)):
+                out_file = Path(out_dir).joinpath(pre_post).joinpath(f'{idx}_{pre_post}.tif')
+                with rasterio.open(out_file, 'w', **meta) as outds:
+                    outds.write(arr)
+                files.append(out_file.resolve())
+
+            records.append(ChipRecord(f'{idx}_pre', files[0], files[1], None, pre_meta, min(pre_valid, post_valid), crop))
+
+    return records
+
+
+def create_chip_pairs(pre_mosaic, post_mosaic, out_dir, intersect, tile_width=1024, tile_height=1024, coverage=None,
+                      creation_options=None, workers=4, chunk_size=32, anchor=(0, 0), shift_edges=False):
+
+    """
+    Creates pre and post chips that fall inside the intersect and have data in both mosaics. Emptiness is checked on
+    the arrays as they are chipped so empty chips are never written or read back.
+    :param pre_mosaic: pre mosaic
+    :param post_mosaic: post mosaic
+    :param out_dir: path to write chips. Chips are written to pre and post subdirectories.
+    :param intersect: bounds of chips to create
+    :param tile_width: width of tiles to chip
+    :param tile_height: height of tiles to chip
+    :param coverage: optional shapely geometry of valid data. Chips outside it are not read or written.
+    :param creation_options: optional dict of creation options (see get_chip_creation_options)
+    :param workers: number of writer threads
+    :param chunk_size: number of chip pairs written by a thread with one open dataset per mosaic
+    :param anchor: chip grid anchor. See get_chip_windows.
+    :param shift_edges: shift edge chips inside the intersect. See get_chip_windows.
+    :return: list of ChipRecord
+    """
+
+    for pre_post in ('pre', 'post'):
+        Path(out_dir).joinpath(pre_post).mkdir(parents=True, exist_ok=True)
+
+    # Chips are paired by grid index
+    post_windows = {idx: window for idx, window, _, _ in get_chip_windows(post_mosaic, intersect, tile_width, tile_height,
+                                                                          coverage, anchor, shift_edges)}
+    plan = [(idx, window, post_windows[idx], crop)
+            for idx, window, _, crop in get_chip_windows(pre_mosaic, intersect, tile_width, tile_height, coverage,
+                                                         anchor, shift_edges)
+            if idx in post_windows]
+    chunks = [plan[start:start + chunk_size] for start in range(0, len(plan), chunk_size)]
+
+    records = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for written in tqdm(executor.map(lambda chunk: write_chip_pairs(pre_mosaic, post_mosaic, out_dir, chunk,
+                                                                        tile_width, tile_height, creation_options),
+                                         chunks),
+                            total=len(chunks)):
+            records += written
+
+    logger.debug(f'Wrote {len(records)} of {len(plan)} chip pairs with data')
+
+    return records
+
+
+def write_chip_index(records, out_file):
+
+    """
+    Write chip records as JSON so a resumed run does not reopen the chips
+    :param records: list of ChipRecord
+    :param out_file: index file
+    :return: path to index
+    """
+
+    def to_json(record):
+        profile = record.profile.copy()
+        profile['crs'] = profile['crs'].to_wkt() if profile.get('crs') else None
+        profile['transform'] = list(profile['transform'])[:6]
+        return {**record._asdict(), 'pre': str(record.pre), 'post': str(record.post), 'profile': profile}
+
+    Path(out_file).write_text(json.dumps([to_json(r) for r in records]))
+
+    return Path(out_file).resolve()
+
+
+def read_chip_index(in_file):
+
+    """
+    Read chip records written by write_chip_index
+    :param in_file: index file
+    :return: list of ChipRecord
+    """
+
+    records = []
+    for record in json.loads(Path(in_file).read_text()):
+        profile = record['profile']
+        profile['crs'] = rasterio.crs.CRS.from_wkt(profile['crs']) if profile['crs'] else None
+        profile['transform'] = rasterio.Affine(*profile['transform'])
+        chip_windows = tuple(tuple(w) for w in record['windows']) if record['windows'] else None
+        records.append(ChipRecord(record['ident'], Path(record['pre']), Path(record['post']), chip_windows, profile,
+                                  record['valid'], tuple(record['crop'])))
+
+    return records
+
+
+def benchmark_chip_options(in_raster, out_dir, intersect, block_sizes=(256, 512), sample=8, tile_width=1024,
+                           tile_height=1024):
+
+    """
+    Time writing and reading back a sample of chips with each compression and block size. Chips are read back with
+    cv2 like the dataset so options that cv2 can not read are left out.
+    :param in_raster: mosaic to create chips from
+    :param out_dir: directory for the sample chips. Removed afterwards.
+    :param intersect: bounds of chips to create
+    :param block_sizes: internal tile sizes to try
+    :param sample: number of chips written with each option
+    :return: tuple of fastest creation options and dict of option name to seconds. The default options are returned
+    if no chips are planned or no option could be read back.
+    """
+
+    plan = get_chip_windows(in_raster, intersect, tile_width, tile_height)
+    plan = plan[::max(len(plan) // sample, 1)][:sample]
+
+    timings = {}
+    options = {}
+    with rasterio.open(in_raster) as inds:
+        for compress, block_size in product(CHIP_COMPRESSION, block_sizes):
+            name = compress if compress == 'none' else f'{compress}_{block_size}'
+            if name in options:
+                continue
+
+            creation_options = get_chip_creation_options(compress, block_size)
+            test_dir = Path(out_dir).joinpath(name)
+            test_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                t0 = time.perf_counter()
+                for idx, window, _, _ in plan:
+                    out_file = write_chip(inds, window, test_dir.joinpath(f'{idx}.tif'), tile_width, tile_height,
+                                          creation_options)
+                    assert cv2.imread(str(out_file), cv2.IMREAD_COLOR) is not None, 'Unreadable with cv2'
+                timings[name] = time.perf_counter() - t0
+                options[name] = creation_options
+            except Exception as ex:
+                logger.debug(f'Skipping chip option {name}: {ex}')
+            finally:
+                for f in test_dir.iterdir():
+                    f.unlink()
+                test_dir.rmdir()
+
+    if not timings:
+        logger.warning('No chip options could be benchmarked. Using the default chip options.')
+        return get_chip_creation_options(), timings
+
+    fastest = min(timings, key=timings.get)
+    logger.info(f'Fastest chip option {fastest}: ' + ', '.join(f'{k} {v:.3f}s' for k, v in sorted(timings.items(), key=lambda kv: kv[1])))
+
+    return options[fastest], timings
+
+
+# Overlay color of each damage class. 0 is background.
+DAMAGE_COLORS = {1: (255, 255, 255), 2: (229, 255, 50), 3: (255, 159, 0), 4: (255, 0, 0)}
+
+
+def get_overlay_lut(alpha=.6):
+
+    """
+    Lookup tables for blending the damage overlay
+    :param alpha: Desired alpha
+    :return: tuple of (3, 256) table of colors premultiplied by alpha and (256,) table of pre image weights
+    """
+
+    colors = np.zeros((3, 256), dtype=np.float32)
+    weights = np.ones(256, dtype=np.float32)
+    for value, color in DAMAGE_COLORS.items():
+        colors[:, value] = np.array(color) * alpha
+        weights[value] = 1 - alpha
+
+    return colors, weights
+
+
+def blend_overlay(base, overlay, alpha=.6):
+
+    """
+    Blends the damage overlay on the pre image with lookup tables indexed by the damage mask, band first like rasterio
+    so the result is written without transposing.
+    :param base: Pre image array of (bands, height, width). Single band images are used as grey.
+    :param overlay: uint8 damage mask of (height, width)
+    :param alpha: Desired alpha
+    :return: uint8 RGB array of (3, height, width)
+    """
+
+    colors, weights = get_overlay_lut(alpha)
+    base = base[:3] if base.shape[0] >= 3 else np.repeat(base[:1], 3, axis=0)
+    overlay = overlay.astype(np.uint8, copy=False)
+
+    return np.rint(base * weights[overlay] + colors[:, overlay]).astype(np.uint8)
+
+
 def create_composite(base, overlay, out_file, transforms, alpha=.6):
     """
     Creates alpha composite on an image from a numpy array.
-    :param base: Base image file
+    :param base: Base image file or array of (bands, height, width)
     :param overlay: Numpy array to overlay
     :param out_file: Destination file
     :param transforms: Geo profile
@@ -289,27 +1175,11 @@ def create_composite(base, overlay, out_file, transforms, alpha=.6):
     :return: Path object to overlay
     """
 
-    # Todo: This seems pretty inefficient...would be a good candidate for refactoring.
-    mask_map_img = np.zeros((overlay.shape[0], overlay.shape[1], 4), dtype=np.uint8)
-    mask_map_img[overlay == 1] = (255, 255, 255, 255 * alpha)
-    mask_map_img[overlay == 2] = (229, 255, 50, 255 * alpha)
-    mask_map_img[overlay == 3] = (255, 159, 0, 255 * alpha)
-    mask_map_img[overlay == 4] = (255, 0, 0, 255 * alpha)
-
-    over_img = Image.fromarray(mask_map_img)
-    pre_img = Image.open(base)
-    pre_img.putalpha(255)
-
-    comp = Image.alpha_composite(pre_img, over_img)
-    comp_arr = np.asarray(comp)
-    no_alpha = comp_arr[:,:,:3]
+    if not isinstance(base, np.ndarray):
+        with rasterio.open(base) as src:
+            base = src.read()
 
     with rasterio.open(out_file, 'w', **transforms) as dst:
-        # Go from (x, y, bands) to (bands, x, y)
-        no_alpha = np.flipud(no_alpha)
-        no_alpha = np.rot90(no_alpha, 3)
-        no_alpha = np.moveaxis(no_alpha, [0, 1, 2], [2, 1, 0])
-
-        dst.write(no_alpha)
+        dst.write(blend_overlay(base, overlay, alpha))
 
     return Path(out_file)
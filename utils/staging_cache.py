@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from loguru import logger
+from utils.manifest import get_identity
+
+
+class StagingCache(object):
+
+    """
+    Content-addressed cache of re-projected inputs. Files are keyed by the source file identity and every parameter
+    of the warp, so runs over the same or overlapping imagery reuse warped files and pre and post files with the same
+    name never collide. The least recently used files are evicted once the cache is over its size limit.
+    """
+
+    def __init__(self, cache_directory, max_gb=100):
+
+        """
+        :param cache_directory: Directory of cached files. May be shared by several runs.
+        :param max_gb: Size limit in GB
+        """
+
+        self.cache_directory = Path(cache_directory)
+        self.max_bytes = int(max_gb * 2 ** 30)
+        self.cache_directory.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def get_key(in_file, in_crs, dest_crs, res, bounds=None, resampling='near'):
+
+        """
+        Key of a re-projected file
+        :param in_file: Source file
+        :param in_crs: CRS override of the source
+        :param dest_crs: Destination CRS
+        :param res: Output resolution
+        :param bounds: Bounds the output is limited to
+        :param resampling: Warp resampling
+        :return: Hex digest
+        """
+
+        params = [get_identity(in_file), in_crs, dest_crs, [float(r) for r in res],
+                  None if bounds is None else [float(b) for b in bounds], resampling]
+
+        return hashlib.sha1(json.dumps(params).encode()).hexdigest()
+
+    def get_path(self, key):
+        return self.cache_directory.joinpath(key[:2]).joinpath(f'{key}.tif')
+
+    def get(self, key):
+
+        """
+        Get a cached file and mark it as recently used
+        :param key: Key from get_key
+        :return: Path to the file or None if it is not cached
+        """
+
+        path = self.get_path(key)
+        try:
+            # Only the access time is updated. The run manifest identifies files by size and mtime.
+            os.utime(path, ns=(time.time_ns(), path.stat().st_mtime_ns))
+        except FileNotFoundError:
+            return None
+
+        return path.resolve()
+
+    def put(self, key, func):
+
+        """
+        Create a file in the cache. The file is written under a temporary name and renamed so concurrent runs never
+        see a partial file.
+        :param key: Key from get_key
+        :param func: Function writing the file to the path it is given
+        :return: Path to the file
+        """
+
+        path = self.get_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'{key}.{uuid.uuid4().hex}.tmp.tif')
+        try:
+            func(tmp)
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+        return path.resolve()
+
+    def get_or_create(self, key, func):
+
+        """
+        Get a cached file or create it
+        :param key: Key from get_key
+        :param func: Function writing the file to the path it is given
+        :return: Path to the file
+        """
+
+        path = self.get(key)
+        if path is not None:
+            logger.debug(f'Using cached {path.name}')
+            return path
+
+        return self.put(key, func)
+
+    def evict(self, keep=()):
+
+        """
+        Remove the least recently used files until the cache is under its size limit
+        :param keep: Files in use that are not removed
+        :return: Number of files removed
+        """
+
+        keep = {Path(f).resolve() for f in keep}
+        files = []
+        for path in self.cache_directory.glob('*/*.tif'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Removed by another run
+                continue
+            files.append((max(stat.st_atime_ns, stat.st_mtime_ns), stat.st_size, path))
+
+        total = sum(f[1] for f in files)
+        removed = 0
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path.resolve() in keep or path.name.endswith('.tmp.tif'):
+                continue
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        if removed:
+            logger.info(f'Evicted {removed} files from the staging cache')
+
+        return removed
@@ -140,3 +140,24 @@ def agol_append(gis, src_feats, dest_fs, layer):
     logger.success(f'Appended {len(result.get("addResults"))} features to {layer.properties.name}')
 
     return True
+
+
+def agol_helper(args, polys):
+
+    """
+    Push damage polygons, their centroids and the AOI hull to the AGOL feature service.
+    :param args: Arguments with AGOL user, password and feature service.
+    :param polys: Polygons and damage values.
+    :return: True if successful.
+    """
+
+    if not polys:
+        logger.info('No polygons to append to ArcGIS')
+        return True
+
+    gis = connect_gis(args.agol_user, args.agol_password)
+    agol_append(gis, create_centroids(polys), args.agol_feature_service, 0)
+    agol_append(gis, create_damage_polys(polys), args.agol_feature_service, 1)
+    agol_append(gis, create_aoi_poly(polys), args.agol_feature_service, 2)
+
+    return True
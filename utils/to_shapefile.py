@@ -1,5 +1,26 @@
 import fiona
-from shapely.geometry import mapping
+from shapely.geometry import mapping, shape
+
+SCHEMA = {
+    'geometry': 'Polygon',
+    'properties': {'dmg': 'int'}
+}
+
+
+def to_record(polygon, px_val):
+
+    """
+    Create a shapefile record from a polygon and damage value
+    :param polygon: Shapely polygon.
+    :param px_val: Damage value.
+    :return: Record for fiona.
+    """
+
+    return {
+        'geometry': mapping(polygon),
+        'properties': {'dmg': int(px_val)}
+    }
+
 
 def create_shapefile(polygons, out_shapefile, dest_crs):
 
@@ -11,18 +32,22 @@ def create_shapefile(polygons, out_shapefile, dest_crs):
     :return: None
     """
 
-    shp_schema = {
-            'geometry': 'Polygon',
-            'properties': {'dmg': 'int'}
-        }
-
     # Write out all the multipolygons to the same file
-    with fiona.open(out_shapefile, 'w', 'ESRI Shapefile', shp_schema,
+    with fiona.open(out_shapefile, 'w', 'ESRI Shapefile', SCHEMA,
                     dest_crs) as shp:
         for polygon, px_val in polygons:
-            shp.write({
-                'geometry': mapping(polygon),
-                'properties': {'dmg': int(px_val)}
-            })
+            shp.write(to_record(polygon, px_val))
+
+    return out_shapefile
+
+
+def read_shapefile(in_shapefile):
+
+    """
+    Read polygons from a shapefile created by create_shapefile
+    :param in_shapefile: Shapefile to read.
+    :return: Shapely polygons and damage values.
+    """
 
-    return out_shapefile
\ No newline at end of file
+    with fiona.open(in_shapefile) as shp:
+        return [(shape(feat['geometry']), feat['properties']['dmg']) for feat in shp]
@@ -1,5 +1,6 @@
 import numpy as np
 import cv2
+from skimage.morphology import square, dilation
 
 #### Augmentations
 def shift_image(img, shift_pnt):
@@ -170,4 +171,28 @@ def iou(im1, im2, empty_score=1.0):
     # Compute Dice coefficient
     intersection = np.logical_and(im1, im2)
 
-    return intersection.sum() / im_sum
\ No newline at end of file
+    return intersection.sum() / im_sum
+
+
+def get_masks(loc_preds, preds, thresholds=(0.38, 0.13, 0.14)):
+    """
+    Combine localization and damage probabilities into final localization and damage masks.
+    :param loc_preds: Localization probabilities of shape (H, W) in range [0, 1]
+    :param preds: Damage probabilities of shape (H, W, 5) in range [0, 1]
+    :param thresholds: Localization thresholds (any building, minor/major damage, any damage)
+    :return: Tuple of uint8 localization and damage masks
+    """
+    _thr = thresholds
+
+    msk_dmg = preds[..., 1:].argmax(axis=2) + 1
+    msk_loc = (1 * ((loc_preds > _thr[0]) | ((loc_preds > _thr[1]) & (msk_dmg > 1) & (msk_dmg < 4)) | ((loc_preds > _thr[2]) & (msk_dmg > 1)))).astype('uint8')
+
+    msk_dmg = msk_dmg * msk_loc
+    _msk = (msk_dmg == 2)
+    if _msk.sum() > 0:
+        _msk = dilation(_msk, square(5))
+        msk_dmg[_msk & msk_dmg == 1] = 2
+
+    msk_dmg = msk_dmg.astype('uint8')
+
+    return msk_loc, msk_dmg
@@ -0,0 +1,68 @@
+import fiona
+from loguru import logger
+from utils import to_shapefile
+
+
+class VectorWriter(object):
+
+    """
+    Appends damage polygons to an open shapefile as chips are postprocessed so the damage layer can be viewed while
+    the run continues. Features are flushed to disk every commit_every chips and each flushed batch is optionally
+    pushed to ArcGIS online.
+    """
+
+    def __init__(self, out_shapefile, dest_crs, commit_every=50, push=None):
+
+        """
+        :param out_shapefile: Destination shapefile. Overwritten if it exists.
+        :param dest_crs: Destination CRS.
+        :param commit_every: Number of chips between flushes.
+        :param push: Optional function called with each flushed batch of polygons (ie. an AGOL append).
+        """
+
+        self.commit_every = commit_every
+        self.push = push
+        self.polygons = []
+        self.pending = []
+        self.chips = 0
+        self.dst = fiona.open(out_shapefile, 'w', 'ESRI Shapefile', to_shapefile.SCHEMA, dest_crs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, polygons):
+
+        """
+        Append polygons for a chip.
+        :param polygons: Shapely polygons and damage values.
+        """
+
+        self.dst.writerecords([to_shapefile.to_record(polygon, px_val) for polygon, px_val in polygons])
+        self.pending += polygons
+        self.chips += 1
+        if self.chips % self.commit_every == 0:
+            self.commit()
+
+    def commit(self):
+
+        """
+        Flush pending features to disk and push them if a push function was given.
+        """
+
+        self.dst.flush()
+        if self.push is not None and self.pending:
+            try:
+                self.push(self.pending)
+            except Exception as ex:
+                # The features are still in the shapefile so a failed push does not stop the run
+                logger.error(f'Failed to push {len(self.pending)} polygons: {ex}')
+        self.polygons += self.pending
+        self.pending = []
+        logger.debug(f'Committed {len(self.polygons)} polygons from {self.chips} chips')
+
+    def close(self):
+        self.commit()
+        self.dst.close()
@@ -0,0 +1,337 @@
+import json
+import math
+import os
+import shutil
+import numpy as np
+import rasterio
+import rasterio.crs
+import rasterio.transform
+import rasterio.warp
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+from pathlib import Path
+from PIL import Image
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from loguru import logger
+
+
+TILE_SIZE = 256
+
+# Half the width of the Web Mercator world in metres
+ORIGIN = 20037508.342789244
+
+WEB_MERCATOR = rasterio.crs.CRS.from_epsg(3857)
+
+# Source type, resampling when rendering the highest zoom and when building parent tiles
+SOURCES = {'overlay': (Resampling.bilinear, Image.BILINEAR),
+           'damage': (Resampling.nearest, Image.NEAREST)}
+
+# Damage classes to RGBA. No damage is transparent.
+DAMAGE_PALETTE = np.array([(0, 0, 0, 0),
+                           (255, 255, 255, 255),
+                           (229, 255, 50, 255),
+                           (255, 159, 0, 255),
+                           (255, 0, 0, 255)] + [(0, 0, 0, 0)] * 251, dtype=np.uint8)
+
+
+def get_tile_size(zoom):
+    return 2 * ORIGIN / 2 ** zoom
+
+
+def get_tile_transform(x, y, zoom):
+
+    """
+    Transform of an XYZ tile in Web Mercator
+    :param x: tile column
+    :param y: tile row
+    :param zoom: zoom level
+    :return: affine transform
+    """
+
+    size = get_tile_size(zoom)
+
+    return rasterio.transform.from_origin(-ORIGIN + x * size, ORIGIN - y * size, size / TILE_SIZE, size / TILE_SIZE)
+
+
+def get_tile_range(bounds, zoom):
+
+    """
+    XYZ tiles covering bounds
+    :param bounds: bounds (left, bottom, right, top) in Web Mercator
+    :param zoom: zoom level
+    :return: tuple of (min x, min y, max x, max y), inclusive
+    """
+
+    size = get_tile_size(zoom)
+    last = 2 ** zoom - 1
+
+    def clamp(v):
+        return min(max(int(v), 0), last)
+
+    left, bottom, right, top = bounds
+    # Tiles only touching the right or bottom edge are not included
+    return (clamp(math.floor((left + ORIGIN) / size)),
+            clamp(math.floor((ORIGIN - top) / size)),
+            clamp(math.ceil((right + ORIGIN) / size) - 1),
+            clamp(math.ceil((ORIGIN - bottom) / size) - 1))
+
+
+def get_tiles(bounds, zoom):
+    min_x, min_y, max_x, max_y = get_tile_range(bounds, zoom)
+    return set(product(range(min_x, max_x + 1), range(min_y, max_y + 1)))
+
+
+def get_zoom_range(in_raster, min_zoom=None, max_zoom=None):
+
+    """
+    Zoom levels for a raster. The highest zoom is the first with tile pixels no larger than the raster pixels. The
+    lowest zoom is the highest that covers the raster with a single tile.
+    :param in_raster: raster
+    :param min_zoom: lowest zoom override
+    :param max_zoom: highest zoom override
+    :return: tuple of (lowest zoom, highest zoom) and bounds in Web Mercator
+    """
+
+    with rasterio.open(in_raster) as src:
+        bounds = rasterio.warp.transform_bounds(src.crs, WEB_MERCATOR, *src.bounds, densify_pts=21)
+        res = max((bounds[2] - bounds[0]) / src.width, (bounds[3] - bounds[1]) / src.height)
+
+    if max_zoom is None:
+        max_zoom = min(max(int(math.ceil(math.log2(2 * ORIGIN / (TILE_SIZE * res)))), 0), 24)
+
+    if min_zoom is None:
+        min_zoom = max_zoom
+        while min_zoom > 0 and len(get_tiles(bounds, min_zoom)) > 1:
+            min_zoom -= 1
+
+    return (min(min_zoom, max_zoom), max_zoom), bounds
+
+
+def get_tile_path(out_dir, x, y, zoom, tile_format):
+    return Path(out_dir).joinpath(str(zoom)).joinpath(str(x)).joinpath(f'{y}.{tile_format}')
+
+
+def to_rgba(arr, mask, source):
+
+    """
+    Convert a tile read from the source to RGBA
+    :param arr: array of (bands, height, width)
+    :param mask: dataset mask of (height, width). 0 where there is no data.
+    :param source: overlay or damage
+    :return: RGBA array of (height, width, 4)
+    """
+
+    if source == 'damage':
+        rgba = DAMAGE_PALETTE[arr[0]]
+        return np.dstack([rgba[..., :3], np.minimum(rgba[..., 3], mask)])
+
+    rgb = np.moveaxis(arr[:3] if arr.shape[0] >= 3 else np.repeat(arr[:1], 3, axis=0), 0, -1)
+    # Areas outside the source and chips that were never written are masked. Black pixels with data stay opaque.
+    alpha = np.where(mask > 0, 255, 0).astype(np.uint8)
+
+    return np.dstack([rgb, alpha])
+
+
+def save_tile(rgba, path, tile_format):
+
+    """
+    Write a tile. Fully transparent tiles are not written and replace an existing tile.
+    :param rgba: RGBA array of (height, width, 4)
+    :param path: tile path
+    :param tile_format: png or webp
+    :return: True if the tile was written
+    """
+
+    if not rgba[..., 3].any():
+        if path.is_file():
+            path.unlink()
+        return False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written next to the tile and renamed so viewers never get a partial tile
+    tmp = path.with_suffix(f'.tmp.{tile_format}')
+    Image.fromarray(rgba, 'RGBA').save(tmp, format=tile_format.upper(), **({'lossless': True} if tile_format == 'webp' else {}))
+    os.replace(tmp, path)
+
+    return True
+
+
+def render_tiles(in_raster, out_dir, tiles, zoom, source='overlay', tile_format='png'):
+
+    """
+    Render tiles of the highest zoom from the source raster. Run in a worker process over a block of tiles so the
+    source is opened once per block.
+    :param in_raster: overlay or damage raster
+    :param out_dir: pyramid directory
+    :param tiles: list of (x, y)
+    :param zoom: zoom level
+    :param source: overlay or damage
+    :param tile_format: png or webp
+    :return: number of tiles written
+    """
+
+    written = 0
+    with rasterio.open(in_raster) as src:
+        for x, y in tiles:
+            # The alpha band carries the source mask through the warp
+            with WarpedVRT(src, crs=WEB_MERCATOR, transform=get_tile_transform(x, y, zoom), width=TILE_SIZE,
+                           height=TILE_SIZE, resampling=SOURCES[source][0], add_alpha=True) as vrt:
+                arr = vrt.read(list(range(1, src.count + 1)))
+                mask = vrt.dataset_mask()
+            written += save_tile(to_rgba(arr, mask, source), get_tile_path(out_dir, x, y, zoom, tile_format), tile_format)
+
+    return written
+
+
+def reduce_tile(canvas):
+
+    """
+    Halve an RGBA canvas by averaging 2x2 pixels. Colors are averaged with premultiplied alpha so transparent pixels do
+    not darken the edges of the data, and alpha is the coverage of the 2x2 pixels so small areas of data are not faded
+    out over the zoom levels.
+    :param canvas: RGBA array of (height, width, 4) with even height and width
+    :return: RGBA array of (height / 2, width / 2, 4)
+    """
+
+    height, width = canvas.shape[0] // 2, canvas.shape[1] // 2
+    blocks = canvas.reshape(height, 2, width, 2, 4).astype(np.float32)
+    alpha = blocks[..., 3:]
+    weight = alpha.sum(axis=(1, 3))
+    rgb = (blocks[..., :3] * alpha).sum(axis=(1, 3)) / np.maximum(weight, 1)
+
+    return np.dstack([np.round(rgb), alpha.max(axis=(1, 3))]).astype(np.uint8)
+
+
+def build_parents(out_dir, tiles, zoom, source='overlay', tile_format='png'):
+
+    """
+    Build tiles from the four child tiles of the next zoom. Run in a worker process over a block of tiles.
+    :param out_dir: pyramid directory
+    :param tiles: list of (x, y) at zoom
+    :param zoom: zoom level of the parents
+    :param source: overlay or damage
+    :param tile_format: png or webp
+    :return: number of tiles written
+    """
+
+    written = 0
+    for x, y in tiles:
+        canvas = np.zeros((TILE_SIZE * 2, TILE_SIZE * 2, 4), dtype=np.uint8)
+        for dx, dy in product(range(2), range(2)):
+            child = get_tile_path(out_dir, x * 2 + dx, y * 2 + dy, zoom + 1, tile_format)
+            if child.is_file():
+                with Image.open(child) as img:
+                    canvas[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = np.asarray(img.convert('RGBA'))
+
+        resampling = SOURCES[source][1]
+        if resampling == Image.NEAREST:
+            rgba = np.asarray(Image.fromarray(canvas, 'RGBA').resize((TILE_SIZE, TILE_SIZE), resampling))
+        else:
+            rgba = reduce_tile(canvas)
+        written += save_tile(rgba, get_tile_path(out_dir, x, y, zoom, tile_format), tile_format)
+
+    return written
+
+
+def get_blocks(tiles, block_size=16):
+
+    """
+    Partition tiles into square blocks of tile ranges for the worker processes
+    :param tiles: iterable of (x, y)
+    :param block_size: block edge length in tiles
+    :return: list of lists of (x, y)
+    """
+
+    blocks = defaultdict(list)
+    for x, y in sorted(tiles):
+        blocks[(x // block_size, y // block_size)].append((x, y))
+
+    return list(blocks.values())
+
+
+def read_metadata(out_dir):
+    metadata = Path(out_dir).joinpath('metadata.json')
+    if not metadata.is_file():
+        return None
+
+    with open(metadata) as f:
+        return json.load(f)
+
+
+def create_tiles(in_raster, out_dir, source='overlay', tile_format='png', min_zoom=None, max_zoom=None,
+                 changed=None, workers=4):
+
+    """
+    Create a Web Mercator XYZ tile pyramid. The highest zoom is rendered from the raster and each lower zoom is built
+    from the one above it, with blocks of tiles spread over a process pool. Fully transparent tiles are skipped.
+    :param in_raster: overlay mosaic, or damage mosaic rendered with DAMAGE_PALETTE
+    :param out_dir: pyramid directory. Tiles are written to out_dir/z/x/y.
+    :param source: overlay or damage
+    :param tile_format: png or webp
+    :param min_zoom: lowest zoom. Computed from the raster extent if None.
+    :param max_zoom: highest zoom. Computed from the raster resolution if None.
+    :param changed: bounds (left, bottom, right, top) in the raster CRS of areas that changed since the pyramid was
+    last created. Only tiles covering them are updated. Everything is rendered if None or if the pyramid was created
+    with other settings.
+    :param workers: number of worker processes
+    :return: path to the TileJSON metadata of the pyramid
+    """
+
+    out_dir = Path(out_dir)
+    (min_zoom, max_zoom), bounds = get_zoom_range(in_raster, min_zoom, max_zoom)
+    settings = {'source': source, 'format': tile_format, 'minzoom': min_zoom, 'maxzoom': max_zoom}
+
+    metadata = read_metadata(out_dir)
+    if changed is not None and (metadata is None or {k: metadata.get(k) for k in settings} != settings):
+        logger.info('Web tiles were created with other settings. Rendering all tiles.')
+        changed = None
+
+    if changed is None:
+        tiles = get_tiles(bounds, max_zoom)
+        # Tiles from an earlier pyramid would otherwise be left behind outside the new extent or zoom range
+        for zoom_dir in out_dir.glob('*'):
+            if zoom_dir.is_dir() and zoom_dir.name.isdigit():
+                shutil.rmtree(zoom_dir)
+    else:
+        with rasterio.open(in_raster) as src:
+            src_crs = src.crs
+        tiles = set()
+        for b in changed:
+            tiles |= get_tiles(rasterio.warp.transform_bounds(src_crs, WEB_MERCATOR, *b, densify_pts=21), max_zoom)
+
+    # Invalidated until the pyramid is complete so an interrupted update is rendered in full next time
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if metadata is not None:
+        out_dir.joinpath('metadata.json').unlink()
+
+    logger.info(f'Rendering {len(tiles)} web tiles at zoom {max_zoom}')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        zoom = max_zoom
+        blocks = get_blocks(tiles)
+        written = sum(executor.map(render_tiles, [in_raster] * len(blocks), [out_dir] * len(blocks), blocks,
+                                   [zoom] * len(blocks), [source] * len(blocks), [tile_format] * len(blocks)))
+        logger.debug(f'Wrote {written} of {len(tiles)} tiles at zoom {zoom}')
+
+        while zoom > min_zoom:
+            zoom -= 1
+            tiles = {(x // 2, y // 2) for x, y in tiles}
+            blocks = get_blocks(tiles)
+            written = sum(executor.map(build_parents, [out_dir] * len(blocks), blocks, [zoom] * len(blocks),
+                                       [source] * len(blocks), [tile_format] * len(blocks)))
+            logger.debug(f'Wrote {written} of {len(tiles)} tiles at zoom {zoom}')
+
+    lonlat = rasterio.warp.transform_bounds(WEB_MERCATOR, 'EPSG:4326', *bounds, densify_pts=21)
+    metadata = dict(settings,
+                    tilejson='2.2.0',
+                    scheme='xyz',
+                    tiles=[f'{{z}}/{{x}}/{{y}}.{tile_format}'],
+                    bounds=list(lonlat),
+                    center=[(lonlat[0] + lonlat[2]) / 2, (lonlat[1] + lonlat[3]) / 2, max_zoom])
+    with open(out_dir.joinpath('metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+    logger.info(f'Web tiles for zoom {min_zoom} to {max_zoom} created in {out_dir}')
+
+    return out_dir.joinpath('metadata.json')
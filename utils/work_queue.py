@@ -0,0 +1,262 @@
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from loguru import logger
+
+
+class WorkQueue(object):
+
+    """
+    File based work queue on a shared filesystem. Each work item is a JSON file that moves between the pending,
+    claimed, done and failed directories. Claiming is an atomic rename, so any number of processes on any number of
+    nodes can pull from the same queue without a server.
+    """
+
+    STATES = ('pending', 'claimed', 'done', 'failed')
+
+    def __init__(self, queue_directory):
+        self.queue_directory = Path(queue_directory)
+        self.plan_file = self.queue_directory.joinpath('plan.json')
+
+    def get_dir(self, state):
+        return self.queue_directory.joinpath(state)
+
+    def lock(self, name, stale=None):
+
+        """
+        Take a named lock. Only the first caller across all nodes gets it. Locks are never released, but a lock older
+        than stale seconds is taken over, ie. from a planner that crashed.
+        :param name: Lock name
+        :param stale: Seconds after which an existing lock is taken over. Never if None.
+        :return: True if the lock was taken by this caller
+        """
+
+        self.queue_directory.mkdir(parents=True, exist_ok=True)
+        lock_file = self.queue_directory.joinpath(f'{name}.lock')
+        try:
+            fd = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if stale is None or not self.is_stale(lock_file, stale):
+                return False
+            # Renamed first so only one caller breaks the lock
+            stale_file = lock_file.with_suffix(f'.{uuid.uuid4().hex}.stale')
+            try:
+                os.rename(lock_file, stale_file)
+            except FileNotFoundError:
+                return False
+            stale_file.unlink()
+            logger.warning(f'Taking over stale {name} lock in {self.queue_directory}')
+            return self.lock(name)
+        os.write(fd, f'{socket.gethostname()}:{os.getpid()}'.encode())
+        os.close(fd)
+        return True
+
+    @staticmethod
+    def is_stale(path, timeout):
+        try:
+            return time.time() - path.stat().st_mtime > timeout
+        except FileNotFoundError:
+            return False
+
+    def create(self, items, meta, stale=None):
+
+        """
+        Register work items. Only the first caller creates the queue; later calls are ignored unless the planner that
+        took the plan lock did not finish within stale seconds.
+        :param items: List of dicts, each with a unique 'id'
+        :param meta: Dict of run wide parameters shared by all workers
+        :param stale: Seconds after which an unfinished plan is taken over. Never if None.
+        :return: True if the queue was created by this call
+        """
+
+        if self.plan_file.is_file() or not self.lock('plan', stale):
+            logger.info(f'Work queue already planned at {self.queue_directory}')
+            return False
+
+        for state in self.STATES:
+            self.get_dir(state).mkdir(parents=True, exist_ok=True)
+
+        for item in items:
+            dest = self.get_dir('pending').joinpath(f'{item["id"]}.json')
+            tmp = dest.with_suffix('.tmp')
+            tmp.write_text(json.dumps(item))
+            os.replace(tmp, dest)
+
+        # Written last so workers only start once every item is registered
+        tmp = self.plan_file.with_suffix('.tmp')
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self.plan_file)
+        logger.info(f'Registered {len(items)} work items in {self.queue_directory}')
+
+        return True
+
+    @property
+    def meta(self):
+        return json.loads(self.plan_file.read_text())
+
+    def wait_for_plan(self, poll=5, timeout=None, stale=None):
+
+        """
+        Block until the queue has been planned.
+        :param poll: Seconds between checks
+        :param timeout: Seconds to wait in total. Forever if None.
+        :param stale: Seconds after which a plan lock without a plan is from a crashed planner. Never if None.
+        :return: Run wide parameters
+        """
+
+        start = time.time()
+        lock_file = self.queue_directory.joinpath('plan.lock')
+        while not self.plan_file.is_file():
+            if timeout is not None and time.time() - start > timeout:
+                raise TimeoutError(f'No work queue planned at {self.queue_directory}')
+            if stale is not None and self.is_stale(lock_file, stale) and not self.plan_file.is_file():
+                raise TimeoutError(f'Planner of {self.queue_directory} did not finish. Run the planner again.')
+            time.sleep(poll)
+        return self.meta
+
+    def claim(self):
+
+        """
+        Claim the next pending item.
+        :return: Item dict or None if no items are pending
+        """
+
+        for pending in sorted(self.get_dir('pending').glob('*.json')):
+            claimed = self.get_dir('claimed').joinpath(pending.name)
+            try:
+                os.rename(pending, claimed)
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+            os.utime(claimed)
+            return json.loads(claimed.read_text())
+
+        return None
+
+    def heartbeat(self, item_id):
+
+        """
+        Mark a claimed item as still being worked on.
+        """
+
+        os.utime(self.get_dir('claimed').joinpath(f'{item_id}.json'))
+
+    @contextmanager
+    def keep_alive(self, item_id, interval):
+
+        """
+        Heartbeat a claimed item from a background thread while it is being worked on.
+        :param item_id: Item id
+        :param interval: Seconds between heartbeats
+        """
+
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                try:
+                    self.heartbeat(item_id)
+                except FileNotFoundError:
+                    return
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def complete(self, item_id, result=None):
+
+        """
+        Move a claimed item to done.
+        :param item_id: Item id
+        :param result: Optional dict stored with the item
+        :return: False if the claim was lost (see finish)
+        """
+
+        return self.finish(item_id, 'done', result)
+
+    def fail(self, item_id, error):
+
+        """
+        Move a claimed item to failed and record the error.
+        :return: False if the claim was lost (see finish)
+        """
+
+        return self.finish(item_id, 'failed', {'error': str(error)})
+
+    def finish(self, item_id, state, result=None):
+
+        """
+        Move a claimed item to done or failed.
+        :param item_id: Item id
+        :param state: done or failed
+        :param result: Optional dict stored with the item
+        :return: False if the claim was lost, ie. the item was requeued by requeue_stale after missed heartbeats
+        """
+
+        claimed = self.get_dir('claimed').joinpath(f'{item_id}.json')
+        # Renamed first so requeue_stale can not move the item while it is being finished
+        finishing = claimed.with_suffix(f'.{uuid.uuid4().hex}.finishing')
+        try:
+            os.rename(claimed, finishing)
+        except FileNotFoundError:
+            logger.warning(f'Lost claim on work item {item_id}')
+            return False
+
+        item = json.loads(finishing.read_text())
+        item.update(result or {})
+        item['worker'] = f'{socket.gethostname()}:{os.getpid()}'
+        dest = self.get_dir(state).joinpath(claimed.name)
+        tmp = dest.with_suffix('.tmp')
+        tmp.write_text(json.dumps(item))
+        os.replace(tmp, dest)
+        finishing.unlink()
+
+        return True
+
+    def requeue_stale(self, timeout):
+
+        """
+        Return claimed items without a heartbeat for timeout seconds to pending, ie. from crashed workers.
+        :param timeout: Seconds since the last heartbeat
+        :return: Number of items requeued
+        """
+
+        count = 0
+        now = time.time()
+        for claimed in self.get_dir('claimed').glob('*.json'):
+            try:
+                if now - claimed.stat().st_mtime > timeout:
+                    os.rename(claimed, self.get_dir('pending').joinpath(claimed.name))
+                    count += 1
+            except FileNotFoundError:
+                continue
+
+        if count:
+            logger.warning(f'Requeued {count} stale work items')
+
+        return count
+
+    def items(self, state):
+        return [json.loads(f.read_text()) for f in sorted(self.get_dir(state).glob('*.json'))]
+
+    def status(self):
+
+        """
+        Count items in each state.
+        :return: Dict of state to count
+        """
+
+        return {state: len(list(self.get_dir(state).glob('*.json'))) for state in self.STATES}
+
+    def is_finished(self):
+        status = self.status()
+        return status['pending'] == 0 and status['claimed'] == 0
@@ -566,6 +566,19 @@ class Res34_Unet_Double(nn.Module):
                 m.bias.data.zero_()
 
 
+class Res34_Unet_Student(Res34_Unet_Double):
+    """
+    Joint localization and damage model distilled from the full ensemble.
+    Output channel 0 is localization, channels 1-5 are damage.
+    """
+    def __init__(self, pretrained=True, **kwargs):
+        super(Res34_Unet_Student, self).__init__(pretrained=pretrained, **kwargs)
+
+        self.res = nn.Conv2d(self.conv10.layer[0].out_channels * 2, 6, 1, stride=1, padding=0)
+        nn.init.kaiming_normal_(self.res.weight.data)
+        self.res.bias.data.zero_()
+
+
 class SeNet154_Unet_Loc(nn.Module):
     def __init__(self, pretrained='imagenet', **kwargs):
         super(SeNet154_Unet_Loc, self).__init__()